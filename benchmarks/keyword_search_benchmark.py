@@ -0,0 +1,91 @@
+import random
+import re
+import string
+import time
+from collections import defaultdict
+from generators_commit_analysis.advanced_search import AdvancedCommitSearcher
+
+# Run from the project root: python -m benchmarks.keyword_search_benchmark
+
+KEYWORD_COUNTS = (10, 100, 1000)
+MESSAGE_COUNT = 2000
+OPTION_SETS = (
+    {"match_whole_word": False, "match_case": False, "contained_words": True, "same_words": True},
+    {"match_whole_word": True, "match_case": False, "contained_words": True, "same_words": True},
+    {"match_whole_word": False, "match_case": True, "contained_words": False, "same_words": False},
+)
+
+
+def per_keyword_search(searcher, commit_message):
+    """The per-keyword loop AdvancedCommitSearcher used before the compiled matcher, kept as the reference."""
+    keyword_counts = defaultdict(int)
+    found_keywords = set()
+    search_message = commit_message if searcher.match_case else commit_message.lower()
+
+    for keyword in searcher.keywords:
+        keyword_to_search = keyword if searcher.match_case else keyword.lower()
+        if searcher.match_whole_word:
+            if re.search(rf'\b{re.escape(keyword_to_search)}\b', search_message):
+                found_keywords.add(keyword_to_search)
+                keyword_counts[keyword] += 1
+        elif keyword_to_search in search_message:
+            found_keywords.add(keyword_to_search)
+            keyword_counts[keyword] += search_message.count(keyword_to_search)
+    return found_keywords, keyword_counts
+
+
+def make_keywords(count, rng):
+    # Coin-like names with shared stems so some keywords contain others
+    stems = ["coin", "crypto", "currency", "chain", "token", "cash", "byte", "bit", "gold", "net"]
+    keywords = set(stems[:min(count, len(stems))])
+    while len(keywords) < count:
+        prefix = "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 6)))
+        keywords.add(prefix.capitalize() + rng.choice(stems))
+    return tuple(sorted(keywords))
+
+
+def make_messages(keywords, count, rng):
+    words = ["fix", "update", "merge", "branch", "refactor", "add", "remove", "tests", "docs", "wallet", "build"]
+    messages = []
+    for _ in range(count):
+        message = [rng.choice(words) for _ in range(rng.randint(5, 40))]
+        if rng.random() < 0.2:
+            message.insert(rng.randrange(len(message)), rng.choice(keywords))
+        messages.append(" ".join(message))
+    return messages
+
+
+def time_search(search, searcher, messages):
+    start = time.perf_counter()
+    results = [search(searcher, message) for message in messages]
+    return time.perf_counter() - start, results
+
+
+def main():
+    rng = random.Random(42)
+    for keyword_count in KEYWORD_COUNTS:
+        keywords = make_keywords(keyword_count, rng)
+        messages = make_messages(keywords, MESSAGE_COUNT, rng)
+        for options in OPTION_SETS:
+            searcher = AdvancedCommitSearcher(keywords, **options)
+
+            def compiled_search(searcher, message):
+                # Same intermediate values as the reference, before the same_words/contained_words pass
+                search_message = message if searcher.match_case else message.lower()
+                matches = searcher.matcher.scan(search_message, whole_word=searcher.match_whole_word)
+                keyword_counts = defaultdict(int)
+                for pattern, count in matches.items():
+                    for _, keyword in searcher.keyword_patterns[pattern]:
+                        keyword_counts[keyword] += count
+                return set(matches), keyword_counts
+
+            reference_time, reference = time_search(per_keyword_search, searcher, messages)
+            compiled_time, compiled = time_search(compiled_search, searcher, messages)
+            assert reference == compiled, "compiled matcher disagrees with the per-keyword loop"
+
+            print(f"{keyword_count:>5} keywords {options}: per-keyword {reference_time:.3f}s, "
+                  f"compiled {compiled_time:.3f}s, speedup x{reference_time / compiled_time:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+import json
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from itertools import islice
+from urllib.parse import urlparse, parse_qs
+
+# The aliased history fields GraphQLRetriever sends, the stand-in answers those queries only
+HISTORY_FIELD = re.compile(r"(\w+): repository\(owner: \$owner, name: \$(\w+)\).*?"
+                           r"history\(first: \$first, after: \$(\w+), since: \$(\w+)\)")
+
+
+FILES_PER_PAGE = 300
+
+
+class MockGitHub:
+    # Local stand-in for the parts of the GitHub REST API CommitRetriever uses: the organisation repository list and
+    # the commit list of a repository, with page/per_page/since, Link rel="last", ETag/If-None-Match and rate limit
+    # headers. GET /repos/{org}/{repo}/commits/{sha} returns the files of a commit with their patches,
+    # FILES_PER_PAGE per page like GitHub. POST /graphql answers the repository listing and batched history queries
+    # of GraphQLRetriever, with offsets as cursors. latency adds a fixed delay per request to mimic network round
+    # trips, the (path, page) pairs of fail_pages are answered with a 502 to test how failed requests are handled
+    # (GraphQL queries are page 1). ("/graphql/<repo>", page) fails that page of one history in a GraphQL query the
+    # way GitHub reports a timeout: a null alias next to the data of the others and an error naming it
+    def __init__(self, org, latency=0.0):
+        self.org = org
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = None
+        self.positions = {}
+        self.fail_pages = set()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                mock.handle(self)
+
+            def do_POST(self):
+                mock.handle_graphql(self)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def page(self, path, query):
+        # Returns (items of the page, number of pages, version of the listing for the ETag) or None for a 404
+        page = int(query.get("page", ["1"])[0])
+        per_page = int(query.get("per_page", ["30"])[0])
+        since = query.get("since", [None])[0]
+        parts = path.strip("/").split("/")
+
+        if len(parts) == 3 and parts[0] == "orgs" and parts[1] == self.org.name and parts[2] == "repos":
+            names = self.org.repo_names()
+            items = [{"name": name} for name in names[(page - 1) * per_page:page * per_page]]
+            return items, max(1, -(-len(names) // per_page)), len(names)
+
+        if len(parts) == 4 and parts[0] == "repos" and parts[1] == self.org.name and parts[3] == "commits":
+            if parts[2] not in self.org.repo_names():
+                return None
+            repo_index = self.org.repo_names().index(parts[2])
+            if since is None:
+                count = self.org.commits_per_repo
+                positions = islice(self.org.newest_positions(), (page - 1) * per_page, page * per_page)
+                items = [self.org.commit(repo_index, position) for position in positions]
+            else:
+                matching = list(self.org.commits(repo_index, since))
+                count = len(matching)
+                items = matching[(page - 1) * per_page:page * per_page]
+            return items, max(1, -(-count // per_page)), self.org.commits_per_repo
+
+        if len(parts) == 5 and parts[0] == "repos" and parts[1] == self.org.name and parts[3] == "commits":
+            if parts[2] not in self.org.repo_names():
+                return None
+            repo_index = self.org.repo_names().index(parts[2])
+            position = self.commit_position(repo_index, parts[4])
+            if position is None:
+                return None
+            files = self.org.commit_files(repo_index, position)
+            item = {"sha": parts[4], "files": files[(page - 1) * FILES_PER_PAGE:page * FILES_PER_PAGE]}
+            return item, max(1, -(-len(files) // FILES_PER_PAGE)), self.org.commits_per_repo
+        return None
+
+    def commit_position(self, repo_index, sha):
+        # SHAs are hashes of the position, the positions of a repository are looked up once
+        with self.lock:
+            if repo_index not in self.positions:
+                self.positions[repo_index] = {self.org.commit(repo_index, position)["sha"]: position
+                                              for position in range(self.org.commits_per_repo)}
+            return self.positions[repo_index].get(sha)
+
+    def handle(self, request):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+
+        parsed = urlparse(request.path)
+        query = parse_qs(parsed.query)
+        if (parsed.path, int(query.get("page", ["1"])[0])) in self.fail_pages:
+            self.respond(request, 502, b'{"message": "Server Error"}')
+            return
+        result = self.page(parsed.path, query)
+        if result is None:
+            self.respond(request, 404, b'{"message": "Not Found"}')
+            return
+
+        items, last_page, version = result
+        etag = f'"{hash((parsed.path, parsed.query, version)) & 0xffffffff:x}"'
+        if request.headers.get("If-None-Match") == etag:
+            self.respond(request, 304, b"", {"ETag": etag})
+            return
+
+        headers = {"ETag": etag, "Content-Type": "application/json"}
+        if last_page > 1:
+            # rel="next" is left out on the last page like GitHub does
+            params = {key: values[0] for key, values in query.items()}
+            page = int(params.get("page", 1))
+            links = []
+            for rel, number in (("next", page + 1), ("last", last_page)):
+                if number <= last_page:
+                    params["page"] = number
+                    link_query = "&".join(f"{key}={value}" for key, value in params.items())
+                    links.append(f'<{self.url}{parsed.path}?{link_query}>; rel="{rel}"')
+            headers["Link"] = ", ".join(links)
+        self.respond(request, 200, json.dumps(items).encode(), headers)
+
+    def head(self, repo_index):
+        if not self.org.commits_per_repo:
+            return None
+        return self.org.commit(repo_index, self.org.commits_per_repo - 1)["sha"]
+
+    @staticmethod
+    def history_node(commit):
+        # GraphQL shape of a REST payload, the REST author object has a login but no name
+        author, committer = commit["commit"]["author"], commit["commit"]["committer"]
+        return {
+            "oid": commit["sha"],
+            "message": commit["commit"]["message"],
+            "author": dict(author, user={"name": (commit.get("author") or {}).get("name")}),
+            "committer": committer,
+        }
+
+    def history(self, repo_index, first, after, since):
+        start = int(after or 0)
+        if since is None:
+            count = self.org.commits_per_repo
+            commits = [self.org.commit(repo_index, position)
+                       for position in islice(self.org.newest_positions(), start, start + first)]
+        else:
+            matching = list(self.org.commits(repo_index, since))
+            count = len(matching)
+            commits = matching[start:start + first]
+        return {
+            "pageInfo": {"hasNextPage": start + first < count, "endCursor": str(start + first)},
+            "nodes": [self.history_node(commit) for commit in commits],
+        }
+
+    def graphql(self, query, variables):
+        first = variables.get("first", 100)
+        data = {"rateLimit": {"cost": 1, "remaining": 1000000000, "resetAt": "2099-01-01T00:00:00Z"}}
+        errors = []
+        names = self.org.repo_names()
+        if "organization(login: $org)" in query:
+            start = int(variables.get("after") or 0)
+            data["organization"] = {"repositories": {
+                "pageInfo": {"hasNextPage": start + first < len(names), "endCursor": str(start + first)},
+                "nodes": [{"name": name, "defaultBranchRef": {"target": {"oid": self.head(index)}}}
+                          for index, name in enumerate(names[start:start + first], start)],
+            }}
+        for alias, name, after, since in HISTORY_FIELD.findall(query):
+            repo_name = variables.get(name)
+            if repo_name not in names:
+                data[alias] = None
+                errors.append({"type": "NOT_FOUND", "path": [alias],
+                               "message": f"Could not resolve to a Repository with the name '{repo_name}'."})
+                continue
+            if (f"/graphql/{repo_name}", int(variables.get(after) or 0) // first + 1) in self.fail_pages:
+                data[alias] = None
+                errors.append({"type": "TIMEOUT", "path": [alias], "message": "Timeout on validation of query"})
+                continue
+            history = self.history(names.index(repo_name), first, variables.get(after), variables.get(since))
+            data[alias] = {"defaultBranchRef": {"target": {"history": history}}}
+        return {"data": data, "errors": errors} if errors else {"data": data}
+
+    def handle_graphql(self, request):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+
+        body = json.loads(request.rfile.read(int(request.headers.get("Content-Length", 0))))
+        if (urlparse(request.path).path, 1) in self.fail_pages:
+            self.respond(request, 502, b'{"message": "Server Error"}')
+            return
+        if urlparse(request.path).path != "/graphql":
+            self.respond(request, 404, b'{"message": "Not Found"}')
+            return
+        payload = self.graphql(body["query"], body.get("variables") or {})
+        self.respond(request, 200, json.dumps(payload).encode(), {"Content-Type": "application/json"})
+
+    def respond(self, request, status, body, headers=None):
+        request.send_response(status)
+        # A budget large enough that the scheduler never waits, benchmarks measure our side only
+        request.send_header("X-RateLimit-Limit", "1000000000")
+        request.send_header("X-RateLimit-Remaining", "1000000000")
+        request.send_header("X-RateLimit-Reset", str(int(time.time()) + 3600))
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
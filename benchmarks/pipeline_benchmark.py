@@ -0,0 +1,334 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from benchmarks.mock_github import MockGitHub
+from benchmarks.synthetic_org import SyntheticOrg
+from generators_commit_analysis.advanced_search import AdvancedCommitSearcher
+from generators_commit_analysis.commit_retriever import CommitRetriever
+from generators_commit_analysis.commit_store import CommitStore
+from generators_commit_analysis.commit_warehouse import CommitWarehouse
+from generators_commit_analysis.create_xlsm import ExcelCreator
+from generators_commit_analysis.graphql_retriever import GraphQLRetriever
+from generators_commit_analysis.keyword_index import KeywordIndex
+from generators_commit_analysis.pipeline import SinglePassPipeline
+from generators_commit_analysis.simple_analysis import CommitAnalyzer
+
+# Run from the project root: python -m benchmarks.pipeline_benchmark --scale small
+# Results are written to benchmarks/results/ as JSON, compare two runs with --compare BASE.json NEW.json
+
+SCALES = {
+    "small": {"repos": 20, "commits_per_repo": 500},   # 10k commits
+    "medium": {"repos": 50, "commits_per_repo": 2000},   # 100k commits
+    "large": {"repos": 100, "commits_per_repo": 10000},   # 1M commits
+}
+KEYWORD_SET_SIZES = (10, 100, 1000)
+RETRIEVAL_BACKENDS = ("rest", "graphql")
+STAGES = ("retrieval", "simple_analysis", "advanced_search", "keyword_index", "warehouse", "create_xlsm",
+          "single_pass")
+
+
+def measure(function, setup=None, memory=True):
+    # Wall time of one untraced run, then the Python heap peak of a second run under tracemalloc (tracing slows the
+    # code down, so the two are not taken together). setup runs before each and is not measured
+    argument = setup() if setup else None
+    start = time.perf_counter()
+    function(argument)
+    seconds = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        argument = setup() if setup else None
+        tracemalloc.start()
+        try:
+            function(argument)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return seconds, peak
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class PipelineBenchmark:
+    def __init__(self, org, work_dir, stages=STAGES, keyword_set_sizes=KEYWORD_SET_SIZES, memory=True,
+                 retrieval_workers=8, analysis_workers=None, latency=0.0):
+        self.org = org
+        self.work_dir = work_dir
+        self.stages = stages
+        self.keyword_set_sizes = keyword_set_sizes
+        self.memory = memory
+        self.retrieval_workers = retrieval_workers
+        self.analysis_workers = analysis_workers or os.cpu_count() or 1
+        self.latency = latency
+        self.results = []
+        self.store = None
+
+    def path(self, *names):
+        return os.path.join(self.work_dir, *names)
+
+    def fresh_dir(self, name):
+        path = self.path(name)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        return path + "/"
+
+    def record(self, stage, function, setup=None, **params):
+        # Stage output goes to a buffer, only the measurements are printed
+        with contextlib.redirect_stdout(io.StringIO()):
+            seconds, peak = measure(function, setup, self.memory)
+        result = {
+            "stage": stage,
+            "params": params,
+            "commits": self.org.total_commits,
+            "seconds": round(seconds, 4),
+            "peak_memory_mb": round(peak / 2 ** 20, 2) if peak is not None else None,
+        }
+        self.results.append(result)
+        memory = f", peak {result['peak_memory_mb']} MB" if peak is not None else ""
+        print(f"{stage:<28} {json.dumps(params):<42} {seconds:>9.3f}s{memory}")
+        return result
+
+    def searcher(self, keyword_count, workers=1, fuzzy_distance=0):
+        return AdvancedCommitSearcher(self.org.keywords[:keyword_count], workers=workers, fuzzy_distance=fuzzy_distance)
+
+    # --- Stages ---
+    def bench_retrieval(self):
+        mock = MockGitHub(self.org, latency=self.latency).start()
+        base_commits = self.org.commits_per_repo
+        try:
+            def retriever(backend):
+                retriever_class = GraphQLRetriever if backend == "graphql" else CommitRetriever
+                return retriever_class(self.org.name, "benchmark-token", base_url=mock.url,
+                                       workers=self.retrieval_workers, requests_per_hour=10 ** 9, burst=10 ** 6)
+
+            for backend in RETRIEVAL_BACKENDS:
+                self.record("retrieval_full",
+                            lambda path: retriever(backend).retrieve_commits("organization_commits/", path),
+                            lambda: self.fresh_dir("retrieval"), backend=backend, workers=self.retrieval_workers)
+
+            # Grow every repository by 1% and fetch only what is new, starting from a copy of the full retrieval
+            with contextlib.redirect_stdout(io.StringIO()):
+                retriever("rest").retrieve_commits("organization_commits/", self.fresh_dir("retrieval_base"))
+            new_commits = max(1, base_commits // 100)
+            self.org.commits_per_repo = base_commits + new_commits
+
+            def copy_base():
+                path = self.path("retrieval")
+                shutil.rmtree(path, ignore_errors=True)
+                shutil.copytree(self.path("retrieval_base"), path)
+                return path + "/"
+
+            for backend in RETRIEVAL_BACKENDS:
+                self.record("retrieval_incremental",
+                            lambda path: retriever(backend).retrieve_commits("organization_commits/", path,
+                                                                             incremental=True),
+                            copy_base, backend=backend, workers=self.retrieval_workers,
+                            new_commits_per_repo=new_commits)
+        finally:
+            self.org.commits_per_repo = base_commits
+            mock.stop()
+
+    def bench_simple_analysis(self):
+        for workers in sorted({1, self.analysis_workers}):
+            self.record("simple_analysis", lambda _: CommitAnalyzer(self.store, workers=workers).analyze_commits(),
+                        workers=workers)
+
+    def bench_advanced_search(self):
+        for keyword_count in self.keyword_set_sizes:
+            searcher = self.searcher(keyword_count)
+            self.record("advanced_search", lambda _: searcher.process_commits(self.store), keywords=keyword_count)
+            fuzzy = self.searcher(keyword_count, fuzzy_distance=1)
+            self.record("advanced_search_fuzzy", lambda _: fuzzy.process_commits(self.store), keywords=keyword_count)
+
+    def bench_keyword_index(self):
+        def build(path):
+            index = KeywordIndex(path + "index.sqlite")
+            index.update(self.store)
+            index.close()
+
+        self.record("keyword_index_update", build, lambda: self.fresh_dir("index"))
+        build(self.fresh_dir("index_built"))
+        index = KeywordIndex(self.path("index_built", "index.sqlite"))
+        for keyword_count in self.keyword_set_sizes:
+            searcher = self.searcher(keyword_count)
+            self.record("advanced_search_index", lambda _: searcher.process_commits(self.store, index),
+                        keywords=keyword_count)
+            fuzzy = self.searcher(keyword_count, fuzzy_distance=1)
+            self.record("advanced_search_index_fuzzy", lambda _: fuzzy.process_commits(self.store, index),
+                        keywords=keyword_count)
+        index.close()
+
+    def bench_warehouse(self):
+        def build(path):
+            warehouse = CommitWarehouse(path + "warehouse.sqlite")
+            warehouse.update(self.store)
+            warehouse.close()
+
+        self.record("warehouse_update", build, lambda: self.fresh_dir("warehouse"))
+        build(self.fresh_dir("warehouse_built"))
+        warehouse = CommitWarehouse(self.path("warehouse_built", "warehouse.sqlite"))
+        self.record("warehouse_analysis", lambda _: CommitAnalyzer(self.store, warehouse=warehouse).analyze_commits())
+        for keyword_count in self.keyword_set_sizes:
+            searcher = self.searcher(keyword_count)
+            self.record("advanced_search_warehouse", lambda _: searcher.process_commits(self.store, warehouse),
+                        keywords=keyword_count)
+        warehouse.close()
+
+    def report_files(self):
+        # The reports the export reads, produced once outside the measurements
+        path = self.fresh_dir("reports")
+        analysis = CommitAnalyzer(self.store).analyze_commits()
+        with contextlib.redirect_stdout(io.StringIO()):
+            CommitAnalyzer.print_and_save_results(*analysis, output_file="commit_analysis.txt", file_path=path)
+        self.searcher(self.keyword_set_sizes[0]).search_and_save_results(self.store, file_path=path)
+        return path
+
+    def excel_creator(self, path, streaming):
+        return ExcelCreator(commits_store=os.path.relpath(self.store.store_path, path) + "/",
+                            analysis_file="commit_analysis.txt", keyword_search_file="keyword_search_results.json",
+                            excel_file="project_analysis.xlsm", file_path=path, streaming=streaming)
+
+    def bench_create_xlsm(self):
+        path = self.report_files()
+        for streaming in (True, False):
+            def setup():
+                if os.path.exists(path + "project_analysis.xlsm"):
+                    os.remove(path + "project_analysis.xlsm")
+
+            self.record("create_xlsm", lambda _: self.excel_creator(path, streaming).create_workbook(), setup,
+                        streaming=streaming)
+
+    def bench_single_pass(self):
+        path = self.report_files()
+
+        def setup():
+            if os.path.exists(path + "project_analysis.xlsm"):
+                os.remove(path + "project_analysis.xlsm")
+
+        def single_pass(_):
+            SinglePassPipeline(self.store, self.excel_creator(path, True),
+                               searcher=self.searcher(self.keyword_set_sizes[0])).run(file_path=path)
+
+        self.record("single_pass", single_pass, setup, keywords=self.keyword_set_sizes[0])
+
+    def run(self):
+        if "retrieval" in self.stages:
+            self.bench_retrieval()
+        # Every other stage reads a store generated directly, which is what a full retrieval writes
+        print(f"Generating a store of {self.org.total_commits} commits...")
+        self.store = self.org.write_store(self.path("organization_commits") + "/")
+        self.store = CommitStore(self.store.store_path)
+        for stage in self.stages:
+            if stage != "retrieval":
+                getattr(self, f"bench_{stage}")()
+        return self.results
+
+
+def compare(base_file, new_file):
+    with open(base_file, "r") as file:
+        base = json.load(file)
+    with open(new_file, "r") as file:
+        new = json.load(file)
+
+    def key(result):
+        return result["stage"], json.dumps(result["params"], sort_keys=True)
+
+    base_results = {key(result): result for result in base["results"]}
+    print(f"{base.get('git_commit')} -> {new.get('git_commit')}")
+    if base.get("org") != new.get("org"):
+        print("Warning: the runs used different synthetic organisations, the ratios are not like for like")
+    for result in new["results"]:
+        old = base_results.get(key(result))
+        if old is None:
+            print(f"{result['stage']:<28} {key(result)[1]:<42} {result['seconds']:>9.3f}s (new)")
+            continue
+        ratio = result["seconds"] / old["seconds"] if old["seconds"] else float("inf")
+        memory = ""
+        if result["peak_memory_mb"] is not None and old["peak_memory_mb"]:
+            memory = f", memory x{result['peak_memory_mb'] / old['peak_memory_mb']:.2f}"
+        print(f"{result['stage']:<28} {key(result)[1]:<42} {old['seconds']:>9.3f}s -> {result['seconds']:>9.3f}s "
+              f"(x{ratio:.2f}{memory})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every pipeline stage on a synthetic organisation")
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--repos", type=int, help="Overrides the repository count of the scale")
+    parser.add_argument("--commits-per-repo", type=int, help="Overrides the commits per repository of the scale")
+    parser.add_argument("--message-words", type=float, default=8, help="Median words per commit message")
+    parser.add_argument("--message-sigma", type=float, default=0.8, help="Spread of the log-normal message length")
+    parser.add_argument("--keyword-density", type=float, default=0.05, help="Share of messages with a keyword")
+    parser.add_argument("--contributors", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--stages", default=",".join(STAGES), help="Comma separated subset of " + ",".join(STAGES))
+    parser.add_argument("--keyword-sets", default=",".join(map(str, KEYWORD_SET_SIZES)))
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every mock API request")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc runs")
+    parser.add_argument("--output", help="Result file, benchmarks/results/pipeline_<scale>_<commit>.json by default")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="Compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    stages = [stage for stage in args.stages.split(",") if stage]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+    scale = dict(SCALES[args.scale])
+    if args.repos:
+        scale["repos"] = args.repos
+    if args.commits_per_repo:
+        scale["commits_per_repo"] = args.commits_per_repo
+    org = SyntheticOrg(message_words=args.message_words, message_sigma=args.message_sigma,
+                       keyword_density=args.keyword_density, contributors=args.contributors, seed=args.seed, **scale)
+    keyword_set_sizes = tuple(int(size) for size in args.keyword_sets.split(",") if size)
+
+    work_dir = tempfile.mkdtemp(prefix="pipeline_benchmark_")
+    try:
+        benchmark = PipelineBenchmark(org, work_dir, stages, keyword_set_sizes, memory=not args.no_memory,
+                                      latency=args.latency)
+        results = benchmark.run()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    commit = git_commit()
+    output = {
+        "benchmark": "pipeline",
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": commit,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "scale": args.scale,
+        "org": org.config(),
+        "memory": "tracemalloc peak of Python allocations in a separate run" if not args.no_memory else None,
+        "results": results,
+    }
+    results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+    output_file = args.output or os.path.join(results_dir, f"pipeline_{args.scale}_{(commit or 'unknown')[:10]}.json")
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    with open(output_file, "w") as file:
+        json.dump(output, file, indent=4)
+    print(f"Results saved to {output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import hashlib
+import itertools
+import math
+import random
+from datetime import datetime, timedelta, timezone
+from benchmarks.keyword_search_benchmark import make_keywords
+from generators_commit_analysis.commit_store import CommitStore
+
+WORDS = (
+    "fix", "update", "merge", "branch", "refactor", "add", "remove", "tests", "docs", "wallet", "build", "bump",
+    "version", "release", "config", "cleanup", "typo", "readme", "support", "handle", "error", "rpc", "sync", "node",
+    "peer", "block", "fee", "mining", "daemon", "gui", "translation", "script", "deps", "ci", "crash", "memory",
+)
+
+
+class SyntheticOrg:
+    # A reproducible organisation. Every commit is derived from (seed, repository, position) alone, so the mock API
+    # and the store writer generate pages on demand instead of holding the organisation in memory, and growing the
+    # organisation (more commits per repository) leaves the existing commits unchanged
+    def __init__(self, repos=20, commits_per_repo=500, message_words=8, message_sigma=0.8, keyword_density=0.05,
+                 contributors=50, keyword_pool=1000, days=3 * 365, seed=42, name="synthetic-org"):
+        self.name = name
+        self.repos = repos
+        self.commits_per_repo = commits_per_repo
+        self.message_words = message_words  # Median words per message, lengths are log-normally distributed
+        self.message_sigma = message_sigma
+        self.keyword_density = keyword_density  # Share of messages mentioning one of the keywords
+        self.contributors = contributors
+        self.seed = seed
+        self.keywords = make_keywords(keyword_pool, random.Random(seed))
+        # Activity is skewed like in real organisations, contributor k commits about 1 / (k + 1) as often as the first
+        self.cum_weights = list(itertools.accumulate(1 / (k + 1) for k in range(contributors)))
+        self.start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        self.interval = timedelta(days=days) / commits_per_repo
+
+    def config(self):
+        return {
+            "repos": self.repos, "commits_per_repo": self.commits_per_repo, "message_words": self.message_words,
+            "message_sigma": self.message_sigma, "keyword_density": self.keyword_density,
+            "contributors": self.contributors, "keyword_pool": len(self.keywords), "seed": self.seed,
+        }
+
+    @property
+    def total_commits(self):
+        return self.repos * self.commits_per_repo
+
+    def repo_names(self):
+        return [f"repo-{index:04d}" for index in range(self.repos)]
+
+    def commit_date(self, position, rng):
+        # Dates grow with the position, the jitter stays inside the interval so newest first is also date order
+        date = self.start + self.interval * (position + rng.random())
+        return date.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def commit(self, repo_index, position):
+        # GitHub API shaped payload
+        rng = random.Random((self.seed * 1000003 + repo_index) * 1000000007 + position)
+        length = max(1, round(rng.lognormvariate(math.log(self.message_words), self.message_sigma)))
+        words = [rng.choice(WORDS) for _ in range(length)]
+        if rng.random() < self.keyword_density:
+            words.insert(rng.randrange(length + 1), rng.choice(self.keywords))
+        author = rng.choices(range(self.contributors), cum_weights=self.cum_weights)[0]
+        committer = author if rng.random() < 0.9 else rng.choices(range(self.contributors),
+                                                                   cum_weights=self.cum_weights)[0]
+        date = self.commit_date(position, rng)
+        return {
+            "sha": hashlib.sha1(f"{self.seed}:{repo_index}:{position}".encode()).hexdigest(),
+            "commit": {
+                "message": " ".join(words).capitalize(),
+                "author": {"name": f"Developer {author}", "email": f"dev{author}@example.com", "date": date},
+                "committer": {"name": f"Developer {committer}", "email": f"dev{committer}@example.com", "date": date},
+            },
+            "author": {"login": f"dev{author}"},
+        }
+
+    def commit_files(self, repo_index, position, files=3, hunk_lines=6):
+        # GitHub API shaped files of a commit, each with a unified diff patch. Changed lines mention a keyword about
+        # as often as messages do
+        rng = random.Random(((self.seed * 1000003 + repo_index) * 1000000007 + position) * 31 + 7)
+        result = []
+        for number in range(rng.randint(1, files)):
+            added, removed, lines = 0, 0, [f"@@ -1,{hunk_lines} +1,{hunk_lines} @@"]
+            for _ in range(hunk_lines):
+                words = [rng.choice(WORDS) for _ in range(rng.randint(2, 8))]
+                if rng.random() < self.keyword_density:
+                    words.insert(rng.randrange(len(words) + 1), rng.choice(self.keywords))
+                prefix = rng.choice("+- ")
+                added += prefix == "+"
+                removed += prefix == "-"
+                lines.append(prefix + " ".join(words))
+            result.append({
+                "filename": f"src/{rng.choice(WORDS)}_{number}.py",
+                "status": "modified" if removed else "added",
+                "additions": added,
+                "deletions": removed,
+                "patch": "\n".join(lines),
+            })
+        return result
+
+    def newest_positions(self, since=None):
+        # Positions newest first, stopping once a whole interval is older than since
+        since_date = datetime.fromisoformat(since.replace("Z", "+00:00")) if since else None
+        for position in range(self.commits_per_repo - 1, -1, -1):
+            if since_date is not None and self.start + self.interval * (position + 1) < since_date:
+                return
+            yield position
+
+    def commits(self, repo_index, since=None):
+        for position in self.newest_positions(since):
+            commit = self.commit(repo_index, position)
+            if since is None or commit["commit"]["committer"]["date"] >= since:
+                yield commit
+
+    def write_store(self, store_path):
+        # The store a full retrieval of the organisation would produce, without going through HTTP
+        store = CommitStore(store_path)
+        store.set_repos(self.repo_names())
+        for repo_index, repo_name in enumerate(self.repo_names()):
+            with store.open_repo(repo_name) as writer:
+                writer.write(self.commits(repo_index))
+        return store
@@ -1,70 +1,219 @@
-from openai import OpenAI
+from openai import AsyncOpenAI
+import asyncio
+import hashlib
 import json
-
-# Set your OpenAI API key
-# openai.api_key = 'your_openai_api_key_here'
-
-# File path for the commit messages JSON
-organization_commits_file = '../generated_files/organization_commits.json'
-
-client = OpenAI()
-
-
-def load_commit_messages(file_path):
-    """Load commit messages from the organization_commits.json file."""
-    with open(file_path, 'r') as file:
-        commits_data = json.load(file)
-
-    # Extract all commit messages
-    messages = []
-    for repo, commits in commits_data.items():
-        for commit in commits:
-            commit_message = commit.get("commit", {}).get("message", "")
-            if commit_message:
-                messages.append((repo, commit_message))
-
-    return messages
-
-
-def generate_report(messages):
-    """Generate a report using GPT based on the commit messages."""
-    generated_report = ""
-
-    # Combine all commit messages into a single input for GPT
-    for repo, message in messages:
-        generated_report += f"Repository: {repo}\nCommit Message: {message}\n\n"
-
-    # Make API call to GPT to generate a report
-    response = client.chat.completions.create(
-        model="GPT-3.5 Turbo",
-        messages=[
-            {"role": "system", "content": "You are an AI that generates project reports based on commit messages."},
-            {"role": "user",
-             "content": f"Here are the commit messages:\n\n{generated_report}\n\nPlease generate a detailed report for this project and each repository."}
-        ]
-    )
-
-    # Extract the generated report
-    generated_report = response['choices'][0]['message']['content']
-
-    return generated_report
-
-
-def save_report(generated_report, file_path):
-    """Save the generated report to a text file."""
+import os
+from settings import settings
+from generators_commit_analysis.commit_store import CommitStore
+
+try:
+    import tiktoken
+except ImportError:  # Without tiktoken token counts are estimated from the text length
+    tiktoken = None
+
+# Bump when the prompts change, so summaries cached for the old prompts are not reused
+PROMPT_VERSION = 1
+
+SYSTEM_PROMPT = "You are an AI that generates project reports based on commit messages."
+
+
+def count_tokens(text, model):
+    """Count the tokens of text for model, about four characters per token when tiktoken is not installed."""
+    if tiktoken is not None:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+        return len(encoding.encode(text))
+    return len(text) // 4 + 1
+
+
+def load_commit_messages(commits_store):
+    """Yield (repo, [(sha, message), ...]) for every repository of the commit store, oldest first, empty messages left
+    out. A full retrieval writes the newest commits first and an incremental one appends them, so the store order is
+    not used: oldest first, new commits fall into the last chunk whichever way they were stored."""
+    for repo, commits in commits_store.items():
+        dated = sorted((commit.committer_date or "", commit.sha or "", commit.message)
+                       for commit in commits if commit.message)
+        yield repo, [(sha, message) for _, sha, message in dated]
+
+
+def chunk_commits(repo, commits, max_tokens, model):
+    """Split the commits of a repository into consecutive chunks of at most max_tokens tokens of messages."""
+    chunks = []
+    shas, lines, tokens = [], [], 0
+    for sha, message in commits:
+        line = f"- {message.strip()}\n"
+        line_tokens = count_tokens(line, model)
+        if line_tokens > max_tokens:
+            # A single oversized message is cut down to the budget rather than given a chunk it cannot fit in
+            line = line[:max_tokens * len(line) // line_tokens] + "\n"
+            line_tokens = max_tokens
+        if lines and tokens + line_tokens > max_tokens:
+            chunks.append({"repo": repo, "shas": shas, "text": "".join(lines)})
+            shas, lines, tokens = [], [], 0
+        shas.append(sha)
+        lines.append(line)
+        tokens += line_tokens
+    if lines:
+        chunks.append({"repo": repo, "shas": shas, "text": "".join(lines)})
+    return chunks
+
+
+def chunk_key(chunk, model):
+    """Cache key of a chunk summary. Chunks run oldest first, so only the last chunk changes when commits are added."""
+    payload = json.dumps([PROMPT_VERSION, model, chunk["repo"], chunk["shas"]])
+    return "chunk:" + hashlib.sha256(payload.encode()).hexdigest()
+
+
+def prompt_key(prompt, model):
+    """Cache key of a reduce step, which only depends on the summaries it merges."""
+    payload = json.dumps([PROMPT_VERSION, model, prompt])
+    return "reduce:" + hashlib.sha256(payload.encode()).hexdigest()
+
+
+def group_by_tokens(texts, max_tokens, model):
+    """Group texts into runs of at most max_tokens tokens, at least two texts per group so every round shrinks."""
+    groups = []
+    group, tokens = [], 0
+    for text in texts:
+        text_tokens = count_tokens(text, model)
+        if len(group) >= 2 and tokens + text_tokens > max_tokens:
+            groups.append(group)
+            group, tokens = [], 0
+        group.append(text)
+        tokens += text_tokens
+    if len(group) == 1 and groups:
+        groups[-1].append(group[0])
+    elif group:
+        groups.append(group)
+    return groups
+
+
+class ReportEngine:
+    """Map-reduce report: chunk summaries are requested concurrently and cached on disk, then merged per repository
+    and into the organisation report."""
+
+    def __init__(self, client, model, max_chunk_tokens=3000, max_concurrency=4, cache_file=None):
+        self.client = client
+        self.model = model
+        self.max_chunk_tokens = max_chunk_tokens
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.cache_file = cache_file
+        self.cache = {}
+        if cache_file and os.path.exists(cache_file):
+            with open(cache_file, 'r') as file:
+                self.cache = json.load(file)
+        self.requests = 0
+        self.reused = 0
+
+    def save_cache(self):
+        """Save the cached summaries next to the target first, so an interrupted run keeps the previous cache."""
+        if not self.cache_file:
+            return
+        tmp_file = self.cache_file + ".tmp"
+        with open(tmp_file, 'w') as file:
+            json.dump(self.cache, file)
+        os.replace(tmp_file, self.cache_file)
+
+    async def complete(self, key, prompt):
+        """Return the model answer to prompt, from the cache when the same key was answered before."""
+        if key in self.cache:
+            self.reused += 1
+            return self.cache[key]
+
+        async with self.semaphore:
+            response = await self.client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt}
+                ]
+            )
+        self.requests += 1
+        self.cache[key] = response.choices[0].message.content
+        return self.cache[key]
+
+    async def summarize_chunk(self, chunk):
+        """Map step: summarize the commit messages of one chunk."""
+        prompt = (f"Here are commit messages from the repository {chunk['repo']}:\n\n{chunk['text']}\n"
+                  f"Summarize the work they describe: features, fixes, refactors and other notable changes.")
+        return await self.complete(chunk_key(chunk, self.model), prompt)
+
+    async def reduce(self, summaries, make_prompt, at_least_once=False):
+        """Reduce step: merge summaries, in several rounds when they do not fit in one request."""
+        while len(summaries) > 1 or at_least_once:
+            at_least_once = False
+            groups = group_by_tokens(summaries, self.max_chunk_tokens, self.model)
+            prompts = [make_prompt("\n\n".join(group)) for group in groups]
+            summaries = await asyncio.gather(*(self.complete(prompt_key(prompt, self.model), prompt)
+                                               for prompt in prompts))
+        return summaries[0]
+
+    async def summarize_repo(self, repo, chunks):
+        """Summarize every chunk of a repository concurrently and merge them into the repository summary."""
+        summaries = await asyncio.gather(*(self.summarize_chunk(chunk) for chunk in chunks))
+        return await self.reduce(list(summaries), lambda text: (
+            f"Here are summaries of consecutive parts of the commit history of the repository {repo}:\n\n{text}\n\n"
+            f"Merge them into a single summary of the repository."))
+
+    async def generate_report(self, commits_store):
+        """Generate the organisation report and the summary of each repository."""
+        repo_chunks = {}
+        for repo, commits in load_commit_messages(commits_store):
+            chunks = chunk_commits(repo, commits, self.max_chunk_tokens, self.model)
+            if chunks:
+                repo_chunks[repo] = chunks
+        if not repo_chunks:
+            return "No commit messages found.", {}
+
+        try:
+            summaries = await asyncio.gather(*(self.summarize_repo(repo, chunks)
+                                               for repo, chunks in repo_chunks.items()))
+            repo_summaries = dict(zip(repo_chunks, summaries))
+            report = await self.reduce(
+                [f"Repository: {repo}\n{summary}" for repo, summary in repo_summaries.items()],
+                lambda text: (f"Here are summaries of the repositories of the project:\n\n{text}\n\n"
+                              f"Please generate a detailed report for this project and each repository."),
+                at_least_once=True)
+        finally:
+            # Summaries that came back before a failure are kept for the next run
+            self.save_cache()
+
+        return report, repo_summaries
+
+
+def save_report(generated_report, repo_summaries, file_path):
+    """Save the generated report, followed by the summary of each repository, to a text file."""
     with open(file_path, 'w') as file:
         file.write(generated_report)
+        if repo_summaries:
+            file.write("\n\nRepository summaries:\n\n")
+            for repo, summary in repo_summaries.items():
+                file.write(f"Repository: {repo}\n{summary}\n\n")
+
+
+async def main():
+    # Run from the project root with: python -m generators_ai_powered.ai_commit_report
+    file_path = settings["files"]["file_path"]
+    client = AsyncOpenAI(api_key=settings["base_settings"]["gpt_key"], base_url=settings["ai_report"]["base_url"])
+    engine = ReportEngine(
+        client,
+        settings["ai_report"]["model"],
+        max_chunk_tokens=settings["ai_report"]["max_chunk_tokens"],
+        max_concurrency=settings["ai_report"]["max_concurrency"],
+        cache_file=file_path + settings["files"]["ai_report_cache_file"]
+    )
 
+    # Generate a report from the commit store
+    report, repo_summaries = await engine.generate_report(CommitStore(file_path + settings["files"]["commits_store"]))
 
-if __name__ == "__main__":
-    # Load commit messages from the JSON file
-    commit_messages = load_commit_messages(organization_commits_file)
+    # Save the generated report to a file
+    report_file_path = file_path + settings["files"]["ai_report_file"]
+    save_report(report, repo_summaries, report_file_path)
 
-    # Generate a report using GPT
-    report = generate_report(commit_messages)
+    print(f"Report saved to {report_file_path} ({engine.requests} requests, {engine.reused} summaries reused)")
 
-    # Save the generated report to a file
-    report_file_path = '../generated_files/ai_commit_report.txt'
-    save_report(report, report_file_path)
 
-    print(f"Report saved to {report_file_path}")
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,190 @@
+import json
+from generators_commit_analysis.metrics import metrics
+
+try:
+    import numpy as np
+except ImportError:  # Only the activity analysis needs NumPy
+    np = None
+
+
+class ActivityAnalyzer:
+    # Commit activity over time. Commits are reduced to three columns while they stream past: the commit date as
+    # datetime64 and integer codes for the repository and the author. Every statistic is then a bincount or unique
+    # over those columns, so the analysis costs one pass over the commits plus a few vectorized operations
+    def __init__(self, period="month", rolling_window=3, hotspot_periods=3, batch_size=100000):
+        if np is None:
+            raise ImportError("The activity analysis needs NumPy, install it with: pip install numpy")
+        if period not in ("week", "month"):
+            raise ValueError(f"period must be 'week' or 'month', got {period!r}")
+        self.period = period
+        self.rolling_window = rolling_window
+        self.hotspot_periods = hotspot_periods
+        self.batch_size = batch_size
+
+        self.repo_codes = {}
+        self.author_codes = {}
+        self.columns = []  # (dates, repos, authors) arrays, one per batch
+        self.dates, self.repos, self.authors = [], [], []
+
+    # --- Collecting ---
+    def add_repo(self, repo):
+        return self.repo_codes.setdefault(repo, len(self.repo_codes))
+
+    def add_commit(self, repo, commit):
+        # GitHub dates are UTC ("...Z"), the first 19 characters are what datetime64 parses
+        self.dates.append(commit.committer_date[:19] if commit.committer_date else "NaT")
+        self.repos.append(self.add_repo(repo))
+        author = commit.author_email or commit.author_name or "unknown"
+        self.authors.append(self.author_codes.setdefault(author, len(self.author_codes)))
+        if len(self.dates) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.dates:
+            metrics.count("commits_collected", len(self.dates))
+            self.columns.append((np.array(self.dates, dtype="datetime64[s]"), np.array(self.repos, dtype=np.int64),
+                                 np.array(self.authors, dtype=np.int64)))
+            self.dates, self.repos, self.authors = [], [], []
+
+    def collect(self, commits_data):
+        for repo, commits in commits_data.items():
+            # Repositories without commits are still listed
+            self.add_repo(repo)
+            for commit in commits:
+                self.add_commit(repo, commit)
+
+    # --- Analysis ---
+    def period_numbers(self, dates):
+        # Months since 1970-01, or weeks since the Monday before 1970-01-01 (a Thursday)
+        if self.period == "month":
+            return dates.astype("datetime64[M]").astype(np.int64)
+        return (dates.astype("datetime64[D]").astype(np.int64) + 3) // 7
+
+    def period_labels(self, first, count):
+        numbers = np.arange(first, first + count)
+        if self.period == "month":
+            return [str(label) for label in numbers.astype("datetime64[M]")]
+        return [str(label) for label in (numbers * 7 - 3).astype("datetime64[D]")]
+
+    def analyze(self):
+        self.flush()
+        if self.columns:
+            dates, repos, authors = (np.concatenate(column) for column in zip(*self.columns))
+        else:
+            dates, repos, authors = np.array([], dtype="datetime64[s]"), np.array([], dtype=np.int64), \
+                np.array([], dtype=np.int64)
+
+        # Commits without a date are left out of the time buckets
+        dated = ~np.isnat(dates)
+        dates, repos, authors = dates[dated], repos[dated], authors[dated]
+        repo_count, author_count = len(self.repo_codes), len(self.author_codes)
+
+        periods = self.period_numbers(dates)
+        first_period = int(periods.min()) if len(periods) else 0
+        period_count = int(periods.max()) - first_period + 1 if len(periods) else 0
+        periods -= first_period
+        labels = self.period_labels(first_period, period_count)
+
+        # Per period: commits, distinct authors, authors seen for the first time and authors last seen the period before
+        commits_per_period = np.bincount(periods, minlength=period_count)
+        author_periods = np.unique(authors * period_count + periods)
+        pair_authors, pair_periods = author_periods // max(period_count, 1), author_periods % max(period_count, 1)
+        active_authors = np.bincount(pair_periods, minlength=period_count)
+        first_index = np.unique(pair_authors, return_index=True)[1]
+        last_index = np.append(first_index[1:] - 1, len(pair_authors) - 1) if len(first_index) else first_index
+        author_first, author_last = pair_periods[first_index], pair_periods[last_index]
+        new_authors = np.bincount(author_first, minlength=period_count)
+        churned_authors = np.bincount(author_last + 1, minlength=period_count + 1)[:period_count]
+
+        cumulative = np.concatenate(([0], np.cumsum(commits_per_period)))
+        ends = np.arange(1, period_count + 1)
+        starts = np.maximum(ends - self.rolling_window, 0)
+        rolling_commits = (cumulative[ends] - cumulative[starts]) / (ends - starts) if period_count else cumulative[:0]
+
+        # Per repository: a repository x period histogram, distinct authors and the recent trend
+        repo_period = np.bincount(repos * period_count + periods,
+                                  minlength=repo_count * period_count).reshape(repo_count, period_count)
+        repo_authors = np.bincount(np.unique(repos * max(author_count, 1) + authors) // max(author_count, 1),
+                                   minlength=repo_count)
+        window = self.hotspot_periods
+        recent = repo_period[:, max(period_count - window, 0):].sum(axis=1)
+        previous = repo_period[:, max(period_count - 2 * window, 0):max(period_count - window, 0)].sum(axis=1)
+        repo_active = repo_period > 0
+        repo_first = np.where(repo_active.any(axis=1), repo_active.argmax(axis=1), -1)
+        repo_last = np.where(repo_active.any(axis=1), period_count - 1 - repo_active[:, ::-1].argmax(axis=1), -1)
+
+        # Per author
+        author_commits = np.bincount(authors, minlength=author_count)
+        author_repos = np.bincount(np.unique(authors * max(repo_count, 1) + repos) // max(repo_count, 1),
+                                   minlength=author_count)
+        author_active = np.bincount(pair_authors, minlength=author_count)
+        author_first_period = np.full(author_count, -1)
+        author_last_period = np.full(author_count, -1)
+        author_first_period[pair_authors[first_index]] = author_first
+        author_last_period[pair_authors[first_index]] = author_last
+
+        def label(index):
+            return labels[index] if index >= 0 else None
+
+        repo_names = list(self.repo_codes)
+        author_names = list(self.author_codes)
+        return {
+            "period": self.period,
+            "rolling_window": self.rolling_window,
+            "hotspot_periods": self.hotspot_periods,
+            "periods": [
+                {
+                    "period": labels[index],
+                    "commits": int(commits_per_period[index]),
+                    "active_authors": int(active_authors[index]),
+                    "new_authors": int(new_authors[index]),
+                    "churned_authors": int(churned_authors[index]),
+                    "rolling_commits": round(float(rolling_commits[index]), 2),
+                }
+                for index in range(period_count)
+            ],
+            # Hotspots first: most commits in the recent periods, ties in store order
+            "repositories": [
+                {
+                    "repository": repo_names[index],
+                    "commits": int(repo_period[index].sum()),
+                    "authors": int(repo_authors[index]),
+                    "first_period": label(int(repo_first[index])),
+                    "last_period": label(int(repo_last[index])),
+                    "recent_commits": int(recent[index]),
+                    "previous_commits": int(previous[index]),
+                    "growth": int(recent[index] - previous[index]),
+                    "commits_per_period": repo_period[index].tolist(),
+                }
+                for index in np.argsort(-recent, kind="stable")
+            ],
+            "authors": [
+                {
+                    "author": author_names[index],
+                    "commits": int(author_commits[index]),
+                    "repositories": int(author_repos[index]),
+                    "first_period": label(int(author_first_period[index])),
+                    "last_period": label(int(author_last_period[index])),
+                    "active_periods": int(author_active[index]),
+                }
+                for index in np.argsort(-author_commits, kind="stable")
+            ],
+        }
+
+    @staticmethod
+    def print_and_save_results(activity, output_file="activity_analysis.json", file_path=""):
+        with open(file_path + output_file, "w") as result_file:
+            json.dump(activity, result_file, indent=4)
+
+        periods = activity["periods"]
+        print(f"Activity Analysis Report ({len(periods)} {activity['period']}s):\n")
+        for period in periods[-activity["hotspot_periods"]:]:
+            print(f"Period: {period['period']}\n"
+                  f" - Commits: {period['commits']}\n"
+                  f" - Active authors: {period['active_authors']}\n"
+                  f" - New authors: {period['new_authors']}\n"
+                  f" - Churned authors: {period['churned_authors']}\n")
+        print(f"Hotspot repositories (last {activity['hotspot_periods']} {activity['period']}s):")
+        for repo in activity["repositories"][:5]:
+            print(f" - {repo['repository']}: {repo['recent_commits']} commits ({repo['growth']:+d})")
+        print()
@@ -1,11 +1,43 @@
 import json
-import re
+import time
 from collections import defaultdict
+from itertools import groupby
+from generators_commit_analysis.keyword_matcher import KeywordMatcher
+from generators_commit_analysis.fuzzy_matcher import FuzzyMatcher
+from generators_commit_analysis.parallel import split_work, run_parallel
+from generators_commit_analysis.shared_commits import SharedCommits, StringPool
+from generators_commit_analysis.result_sink import ResultSink
+from generators_commit_analysis.metrics import metrics, total_commits
+
+_worker_searcher = None
+_worker_keep_all = False
+
+
+def init_search_worker(searcher, keep_all=False):
+    # Each worker process receives the searcher (and compiles its matcher) once, not once per unit. A worker sends
+    # back the top_k results of its unit, or all of them (keep_all) when the parent streams every match
+    global _worker_searcher, _worker_keep_all
+    _worker_searcher = searcher
+    _worker_keep_all = keep_all
+
+
+def search_unit(unit):
+    # A unit is part of one repository, it holds every SHA once
+    results = _worker_searcher.open_results(keep_all=_worker_keep_all, unique_shas=True)
+    _worker_searcher.search_repo(unit.repo_name, unit.commits(), results=results)
+    return _worker_searcher.kept_results(results)
+
+
+def search_patch_unit(unit):
+    results = _worker_searcher.open_results(keep_all=_worker_keep_all, unique_shas=True)
+    _worker_searcher.search_patch_repo(unit.repo_name, unit.commits(), results=results)
+    return _worker_searcher.kept_results(results)
 
 
 class AdvancedCommitSearcher:
     def __init__(self, keywords, exclude_repos=(), include_committer=True, include_author=True,
-                 match_whole_word=False, match_case=False, contained_words=False, same_words=True):
+                 match_whole_word=False, match_case=False, contained_words=False, same_words=True,
+                 workers=1, chunk_size=50000, fuzzy_distance=0, sort_by=("total_instances",), top_k=None):
         self.keywords = keywords
         self.exclude_repos = exclude_repos
         self.include_committer = include_committer
@@ -14,28 +46,54 @@ class AdvancedCommitSearcher:
         self.match_case = match_case
         self.contained_words = contained_words
         self.same_words = same_words
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.fuzzy_distance = fuzzy_distance
+        self.sort_by = sort_by  # Result fields in priority order, each highest first, see ResultSink
+        self.top_k = top_k  # Best results kept, None keeps every one
+        self.strings = StringPool()
 
-    def keyword_search_in_commit(self, commit_message):
+        # Keywords are compiled once, each message is then scanned in a single pass
+        self.keyword_patterns = defaultdict(list)
+        for index, keyword in enumerate(self.keywords):
+            keyword_to_search = keyword if self.match_case else keyword.lower()
+            self.keyword_patterns[keyword_to_search].append((index, keyword))
+        self.matcher = KeywordMatcher(self.keyword_patterns)
+
+        # Which keywords contain which depends only on the keyword list, so it is worked out once as bitmasks:
+        # keyword_containers[pattern] has the bit of every other keyword that contains pattern
+        self.keyword_bits = {pattern: 1 << bit for bit, pattern in enumerate(self.keyword_patterns)}
+        self.keyword_containers = defaultdict(int)
+        for pattern in self.keyword_patterns:
+            for contained in self.matcher.scan(pattern):
+                if contained != pattern:
+                    self.keyword_containers[contained] |= self.keyword_bits[pattern]
+
+        # Words within fuzzy_distance edits of a keyword count as instances of it, see FuzzyMatcher
+        self.fuzzy = FuzzyMatcher(self.keyword_patterns, fuzzy_distance) if fuzzy_distance > 0 else None
+
+    def keyword_search_in_commit(self, commit_message, fuzzy=None):
+        # fuzzy holds the typos FuzzyMatcher.scan found in the message, counted with the exact matches
         keyword_counts = defaultdict(int)
         total_instances = 0
         found_keywords = set()
 
         search_message = commit_message if self.match_case else commit_message.lower()
 
-        def is_whole_word_match(word, message):
-            return bool(re.search(rf'\b{re.escape(word)}\b', message))
-
-        for keyword in self.keywords:
-            keyword_to_search = keyword if self.match_case else keyword.lower()
-
+        matches = self.matcher.scan(search_message, whole_word=self.match_whole_word)
+        for keyword_to_search, variants in (fuzzy or {}).items():
             if self.match_whole_word:
-                if is_whole_word_match(keyword_to_search, search_message):
-                    found_keywords.add(keyword_to_search)
-                    keyword_counts[keyword] += 1
+                matches[keyword_to_search] = 1  # Whole word mode reports each keyword found once
             else:
-                if keyword_to_search in search_message:
-                    found_keywords.add(keyword_to_search)
-                    keyword_counts[keyword] += search_message.count(keyword_to_search)
+                matches[keyword_to_search] = matches.get(keyword_to_search, 0) + sum(
+                    count for _, count in variants.values())
+
+        # Visit the matched keywords in settings order so the counts come out in the same order as before
+        hits = sorted((index, keyword, keyword_to_search) for keyword_to_search in matches
+                      for index, keyword in self.keyword_patterns[keyword_to_search])
+        for _, keyword, keyword_to_search in hits:
+            found_keywords.add(keyword_to_search)
+            keyword_counts[keyword] += matches[keyword_to_search]
 
         if self.same_words:
             for keyword in found_keywords:
@@ -45,12 +103,10 @@ class AdvancedCommitSearcher:
             total_instances = sum(keyword_counts.values())
 
         if not self.contained_words:
-            found_keywords_sorted = sorted(found_keywords, key=len, reverse=True)
-            to_remove = set()
-            for i in range(len(found_keywords_sorted)):
-                for j in range(i + 1, len(found_keywords_sorted)):
-                    if found_keywords_sorted[j] in found_keywords_sorted[i]:
-                        to_remove.add(found_keywords_sorted[j])
+            found_mask = 0
+            for word in found_keywords:
+                found_mask |= self.keyword_bits[word]
+            to_remove = {word for word in found_keywords if self.keyword_containers[word] & found_mask}
 
             for word in to_remove:
                 if word in keyword_counts:
@@ -59,55 +115,263 @@ class AdvancedCommitSearcher:
 
         return total_instances, keyword_counts
 
-    def process_commits(self, commits_data):
-        results = {}
+    def search_commit(self, repo, commit):
+        # Returns (commit_hash, result) when the commit mentions a keyword, otherwise None
+        commit_message = commit.message or ""
+        fuzzy = self.fuzzy.scan(commit_message, self.match_whole_word) if self.fuzzy is not None else None
+        total_instances, keyword_counts = self.keyword_search_in_commit(commit_message, fuzzy)
+        if total_instances <= 0:
+            return None
 
-        for repo, commits in commits_data.items():
-            if repo in self.exclude_repos:
+        result = {
+            "repo": repo,
+            "repos": [repo],
+            "commit": {
+                "message": commit_message,
+                "unique_finds": len(keyword_counts),
+                "instances": keyword_counts,
+                "total_instances": total_instances,
+                "commit_date": commit.committer_date or "unknown"
+            }
+        }
+
+        if self.include_committer:
+            result["commit"]["committer"] = commit.committer_name or "unknown"
+
+        if self.include_author:
+            result["commit"]["author"] = commit.account_name or "unknown"
+
+        if fuzzy:
+            result["commit"]["fuzzy_matches"] = self.fuzzy_matches(fuzzy, keyword_counts)
+
+        return commit.sha or "unknown", result
+
+    def fuzzy_matches(self, fuzzy, keyword_counts):
+        # keyword -> the typos of it found in the message, for the keywords still counted
+        matches = {}
+        for keyword_to_search, variants in fuzzy.items():
+            for _, keyword in self.keyword_patterns[keyword_to_search]:
+                if keyword in keyword_counts:
+                    matches[keyword] = [{"variant": variant, "distance": distance, "count": count}
+                                        for variant, (distance, count) in variants.items()]
+        return matches
+
+    def changed_lines(self, patch):
+        # Added and removed lines of a unified diff that mention a keyword, context lines and hunk headers are skipped.
+        # GitHub patches carry no file headers, so every line starting with + or - is a change
+        added, removed = [], []
+        for line in patch.splitlines():
+            if not line or line[0] not in "+-":
+                continue
+            text = line[1:]
+            if self.matcher.scan(text if self.match_case else text.lower(), whole_word=self.match_whole_word):
+                (added if line[0] == "+" else removed).append(text)
+        return added, removed
+
+    def search_patch(self, repo, record):
+        # Returns (commit_hash, result) when a changed line mentions a keyword, otherwise None. Instances are counted
+        # with the same options as messages, per file and over all the matching lines of the commit
+        files = {}
+        matched_lines = []
+        for filename, status, _, _, patch in record.files:
+            # Patches are missing for binary files and very large diffs. Most patches mention no keyword, they are
+            # rejected by one scan of the whole text before being split into lines
+            if not patch or not self.matcher.scan(patch if self.match_case else patch.lower(),
+                                                  whole_word=self.match_whole_word):
                 continue
+            added, removed = self.changed_lines(patch)
+            if not added and not removed:
+                continue
+            total_instances, keyword_counts = self.keyword_search_in_commit("\n".join(added + removed))
+            files[filename] = {
+                "status": status,
+                "added_lines": len(added),
+                "removed_lines": len(removed),
+                "unique_finds": len(keyword_counts),
+                "instances": keyword_counts,
+                "total_instances": total_instances
+            }
+            matched_lines.extend(added + removed)
+
+        if not files:
+            return None
+
+        total_instances, keyword_counts = self.keyword_search_in_commit("\n".join(matched_lines))
+        return record.sha or "unknown", {
+            "repo": repo,
+            "repos": [repo],
+            "commit": {
+                "files": files,
+                "unique_finds": len(keyword_counts),
+                "instances": keyword_counts,
+                "total_instances": total_instances,
+                "added_lines": sum(file["added_lines"] for file in files.values()),
+                "removed_lines": sum(file["removed_lines"] for file in files.values())
+            }
+        }
 
-            for commit in commits:
-                commit_message = commit.get("commit", {}).get("message", "")
-                commit_date = commit.get("commit", {}).get("committer", {}).get("date", "unknown")
-                total_instances, keyword_counts = self.keyword_search_in_commit(commit_message)
-
-                if total_instances > 0:
-                    commit_hash = commit.get("sha", "unknown")
-                    results[commit_hash] = {
-                        "repo": repo,
-                        "commit": {
-                            "message": commit_message,
-                            "unique_finds": len(keyword_counts),
-                            "instances": keyword_counts,
-                            "total_instances": total_instances,
-                            "commit_date": commit_date
-                        }
-                    }
-
-                    if self.include_committer:
-                        committer_info = commit.get("commit", {}).get("committer", {})
-                        committer_name = committer_info.get("name", "unknown") if committer_info else "unknown"
-                        results[commit_hash]["commit"]["committer"] = committer_name
-
-                    if self.include_author:
-                        author_info = commit.get("author", {})
-                        author_name = author_info.get("name", "unknown") if author_info else "unknown"
-                        results[commit_hash]["commit"]["author"] = author_name
+    def search_repo(self, repo, commits, report_every=10000, results=None):
+        return self.scan_repo(repo, commits, self.search_commit, "commits", "keyword_search", report_every, results)
 
+    def search_patch_repo(self, repo, records, report_every=10000, results=None):
+        return self.scan_repo(repo, records, self.search_patch, "patches", "patch_search", report_every, results)
+
+    def scan_repo(self, repo, records, search, counted, timer, report_every=10000, results=None):
+        # Matches go to results, the sink of the run or the one of a worker unit, or to a new dict
+        if results is None:
+            results = {}
+
+        # Time spent matching keywords is told apart from the time spent reading and decoding the records
+        clock = time.perf_counter
+        scanned, matched, search_seconds = 0, 0, 0.0
+        for record in records:
+            start = clock()
+            found = search(repo, record)
+            search_seconds += clock() - start
+            if found is not None:
+                self.add_result(results, *found)
+                matched += 1
+            scanned += 1
+            if scanned % report_every == 0:
+                metrics.count(f"{counted}_scanned", report_every)
+
+        metrics.add_time(timer, search_seconds)
+        metrics.count(f"{counted}_scanned", scanned % report_every)
+        metrics.count(f"{counted}_matched", matched)
         return results
 
+    def add_result(self, results, sha, result):
+        # A SHA found in several repositories (forks, mirrors) keeps the result of the first one and lists them all.
+        # Repeated names and dates are interned, the results of a broad search stay in memory until they are saved
+        found = results.get(sha)
+        if found is not None:
+            if result["repo"] not in found["repos"]:
+                found["repos"].append(self.strings(result["repo"]))
+            return
+        if sha in results:
+            return  # Dropped from a top_k sink, it was already counted and streamed
+        result["repo"] = self.strings(result["repo"])
+        result["repos"] = [result["repo"]]
+        commit = result["commit"]
+        for field in ("commit_date", "committer", "author"):
+            if field in commit:
+                commit[field] = self.strings(commit[field])
+        results[sha] = result
+
+    def merge_results(self, results, repo_results):
+        for sha, result in repo_results.items():
+            self.add_result(results, sha, result)
+
+    def open_results(self, shared=None, stream_file=None, keep_all=False, unique_shas=False):
+        # Sink the results are collected in, stream_file also gets each one (with every repository holding it) as soon
+        # as it is found. keep_all ignores top_k. SHAs are given once when shared commits are searched once, or when
+        # unique_shas says so. Closed by save_results
+        repos = None
+        if shared is not None:
+            def repos(sha, result):
+                return shared.repos(sha, result["repo"], self.exclude_repos)
+        return ResultSink(self.sort_by, None if keep_all else self.top_k, stream_file, repos,
+                          unique_shas or shared is not None)
+
+    @staticmethod
+    def streams(results):
+        # Whether every match has to reach the parent, the top_k of each unit is enough otherwise
+        return getattr(results, "stream", None) is not None
+
     @staticmethod
-    def sort_results(results, sort_by_total_instances=True, sort_by_unique_findings=False):
-        if sort_by_total_instances:
-            return dict(sorted(results.items(), key=lambda item: item[1]["commit"]["total_instances"], reverse=True))
-        elif sort_by_unique_findings:
-            return dict(sorted(results.items(), key=lambda item: item[1]["commit"]["unique_finds"], reverse=True))
+    def kept_results(results):
+        # What a worker sends back: the kept results in the order found, without the SHAs the sink dropped
+        return dict(results.items())
+
+    def references(self, shared=None):
+        # repo -> SHAs left to an earlier repository, so each commit is searched once
+        return shared.references(self.exclude_repos) if shared is not None else {}
+
+    def list_repos(self, results, shared=None):
+        # References to a shared SHA were not scanned, the repositories holding it come from the shared commits
+        if shared is not None:
+            for sha, result in results.items():
+                result["repos"] = [self.strings(repo) for repo in shared.repos(sha, result["repo"], self.exclude_repos)]
         return results
 
+    def process_commits(self, commits_data, index=None, shared=None, results=None):
+        # shared (SharedCommits) lets every SHA be scanned once, in the first repository holding it
+        if results is None:
+            results = self.open_results(shared)
+        references = self.references(shared)
+
+        # The keyword index narrows the search down to candidate commits, which are then checked like in a scan
+        if index is not None:
+            repo_order = [repo for repo, _ in commits_data.items()]
+            candidates = index.candidate_commits(self.keywords, self.match_whole_word, self.exclude_repos, repo_order,
+                                                 fuzzy=self.fuzzy)
+            if candidates is not None:
+                metrics.progress("commits_scanned")
+                for repo, group in groupby(candidates, key=lambda candidate: candidate[0]):
+                    skip = references.get(repo, ())
+                    self.search_repo(repo, (commit for _, commit in group if commit.sha not in skip), results=results)
+                return self.list_repos(results, shared)
+            print("Some keywords cannot be answered from the index, scanning all commits instead")
+
+        metrics.progress("commits_scanned", total_commits(commits_data) - sum(map(len, references.values())))
+
+        # Shard results are merged in repository order, so a SHA found in several repos ends up as in a serial run.
+        # The best top_k of the run are among the best top_k of each unit, ties rank in the order found either way
+        if self.workers > 1:
+            units = split_work(commits_data, self.chunk_size, self.exclude_repos, references=references)
+            for shard_results in run_parallel(search_unit, units, self.workers, init_search_worker,
+                                              (self, self.streams(results))):
+                self.merge_results(results, shard_results)
+            return self.list_repos(results, shared)
+
+        for repo, commits in commits_data.items():
+            if repo in self.exclude_repos:
+                continue
+            commits = SharedCommits.owned(commits_data, repo, commits, references.get(repo))
+            self.search_repo(repo, commits, results=results)
+
+        return self.list_repos(results, shared)
+
+    def process_patches(self, patches, shared=None, results=None):
+        # patches is a PatchStore, which holds every SHA once: records are read one commit at a time (one chunk per
+        # worker), so the diffs never sit in memory together. shared lists the other repositories holding a commit
+        if results is None:
+            results = self.open_results(shared, unique_shas=True)
+        metrics.progress("patches_scanned", sum(patches.count(repo) for repo in patches.repo_names()
+                                                if repo not in self.exclude_repos))
+
+        if self.workers > 1:
+            units = split_work(patches, self.chunk_size, self.exclude_repos)
+            for shard_results in run_parallel(search_patch_unit, units, self.workers, init_search_worker,
+                                              (self, self.streams(results))):
+                self.merge_results(results, shard_results)
+            return self.list_repos(results, shared)
+
+        for repo, records in patches.items():
+            if repo in self.exclude_repos:
+                continue
+            self.search_patch_repo(repo, records, results=results)
+
+        return self.list_repos(results, shared)
+
     def search_and_save_results(self, commits_data, output_file="keyword_search_results.json", file_path="",
-                                sort_by_total_instances=True, sort_by_unique_findings=False):
-        results = self.process_commits(commits_data)
-        sorted_results = self.sort_results(results, sort_by_total_instances, sort_by_unique_findings)
+                                index=None, shared=None, stream_file=None):
+        # stream_file (NDJSON) gets every match as it is found, output_file the top_k best in sort_by order
+        results = self.process_commits(commits_data, index, shared, self.open_results(shared, stream_file))
+        return self.save_results(results, output_file, file_path)
+
+    def search_and_save_patches(self, patches, output_file="patch_search_results.json", file_path="", shared=None,
+                                stream_file=None):
+        # The patch store holds every SHA once
+        results = self.process_patches(patches, shared, self.open_results(shared, stream_file, unique_shas=True))
+        return self.save_results(results, output_file, file_path)
+
+    def save_results(self, results, output_file="keyword_search_results.json", file_path=""):
+        # results is the ResultSink of the search
+        results.close()
+        sorted_results = results.sorted_results()
 
         with open(file_path + output_file, "w") as result_file:
             json.dump(sorted_results, result_file, indent=4)
+
+        return sorted_results
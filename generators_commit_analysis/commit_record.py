@@ -0,0 +1,56 @@
+class CommitRecord:
+    # Only the fields the analysis stages read, the full REST payload is kept in raw when asked for
+    __slots__ = (
+        "sha", "message",
+        "author_name", "author_email", "author_date",
+        "committer_name", "committer_email", "committer_date",
+        "account_name", "raw"
+    )
+
+    def __init__(self, sha=None, message=None, author_name=None, author_email=None, author_date=None,
+                 committer_name=None, committer_email=None, committer_date=None, account_name=None, raw=None):
+        self.sha = sha
+        self.message = message
+        self.author_name = author_name
+        self.author_email = author_email
+        self.author_date = author_date
+        self.committer_name = committer_name
+        self.committer_email = committer_email
+        self.committer_date = committer_date
+        self.account_name = account_name  # "name" of the GitHub user object next to the git commit
+        self.raw = raw
+
+    @classmethod
+    def from_api(cls, payload, keep_raw=False):
+        commit = payload.get("commit") or {}
+        author = commit.get("author") or {}
+        committer = commit.get("committer") or {}
+        account = payload.get("author") or {}
+        return cls(
+            sha=payload.get("sha"),
+            message=commit.get("message"),
+            author_name=author.get("name"),
+            author_email=author.get("email"),
+            author_date=author.get("date"),
+            committer_name=committer.get("name"),
+            committer_email=committer.get("email"),
+            committer_date=committer.get("date"),
+            account_name=account.get("name"),
+            raw=payload if keep_raw else None
+        )
+
+    @classmethod
+    def from_row(cls, row, keep_raw=False):
+        # Rows are positional lists in __slots__ order, dicts are raw payloads written by older versions
+        if isinstance(row, dict):
+            return cls.from_api(row, keep_raw)
+        return cls(*row)
+
+    def to_row(self):
+        row = [getattr(self, field) for field in self.__slots__]
+        if row[-1] is None:
+            row.pop()  # raw is only written when it was retained
+        return row
+
+    def __repr__(self):
+        return f"CommitRecord(sha={self.sha!r}, message={(self.message or '')[:40]!r})"
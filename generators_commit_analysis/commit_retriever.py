@@ -1,30 +1,77 @@
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+from generators_commit_analysis.rate_limiter import RequestScheduler
+from generators_commit_analysis.commit_store import CommitStore
+from generators_commit_analysis.patch_store import PatchStore, PatchRecord
+from generators_commit_analysis.metrics import metrics
+import threading
+import warnings
 import json
-import time
+import os
+
+
+class RetrievalError(Exception):
+    pass
 
 
 class CommitRetriever:
-    def __init__(self, org_name, token, base_url="https://api.github.com", per_page=100, timeout=1):
+    def __init__(self, org_name, token, base_url="https://api.github.com", per_page=100, workers=1,
+                 token_pool=(), requests_per_hour=5000, burst=100, max_retries=5, keep_raw=False, timeout=None):
         self.org_name = org_name
         self.token = token
         self.base_url = base_url
         self.per_page = per_page
+        self.workers = max(1, workers)
+        self.keep_raw = keep_raw
+        # Deprecated: the fixed sleep between pages was replaced by the scheduler, timeout is accepted and ignored
         self.timeout = timeout
+        if timeout is not None:
+            warnings.warn("CommitRetriever timeout is deprecated and ignored, requests are spaced by the rate limit "
+                          "scheduler (see requests_per_hour and burst)", DeprecationWarning, stacklevel=2)
 
         self.repos_url = f"{self.base_url}/orgs/{self.org_name}/repos"
+        # Authorization is added per request by the scheduler, which rotates across the token pool
         self.headers = {
-            "Authorization": f"token {self.token}",
             "Accept": "application/vnd.github.v3+json"
         }
+        self.scheduler = RequestScheduler(
+            (self.token,) + tuple(token_pool),
+            requests_per_hour=requests_per_hour,
+            burst=burst,
+            max_retries=max_retries
+        )
+
+        # Shared keep-alive session, sized for the repo workers plus the page workers
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.workers * 2)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.page_executor = None
+
+    @staticmethod
+    def get_last_page(response):
+        # GitHub announces the number of pages in the Link header, missing when everything fits in one page
+        last_link = response.links.get("last")
+        if not last_link:
+            return None
+        page = parse_qs(urlparse(last_link["url"]).query).get("page")
+        return int(page[0]) if page else None
 
     def get_all_repos(self):
+        # The listing decides which shards are kept, so an incomplete one raises RetrievalError instead of being
+        # returned: repositories missing from it would have their commits deleted from the store
         repos = []
         page = 1
         while True:
-            response = requests.get(self.repos_url, headers=self.headers, params={"page": page, "per_page": self.per_page})
+            response = self.scheduler.request(self.session, self.repos_url,
+                                              params={"page": page, "per_page": self.per_page})
             if response.status_code != 200:
                 print(f"Error fetching repos: {response.status_code}, {response.text}")
-                break
+                raise RetrievalError(f"Could not list the repositories of {self.org_name} (page {page})")
             page_data = response.json()
             if not page_data:
                 break
@@ -32,37 +79,243 @@ class CommitRetriever:
             page += 1
         return repos
 
-    def get_commits_for_repo(self, repo_name):
-        commits = []
-        page = 1
-        while True:
-            commits_url = f"{self.base_url}/repos/{self.org_name}/{repo_name}/commits"
-            response = requests.get(commits_url, headers=self.headers, params={"page": page, "per_page": self.per_page})
-            if response.status_code != 200:
-                print(f"Error fetching commits for {repo_name}: {response.status_code}, {response.text}")
-                break
+    def get_commits_page(self, repo_name, page, since=None):
+        commits_url = f"{self.base_url}/repos/{self.org_name}/{repo_name}/commits"
+        params = {"page": page, "per_page": self.per_page}
+        if since:
+            params["since"] = since
+        response = self.scheduler.request(self.session, commits_url, params=params)
+        if response.status_code == 409:
+            # GitHub answers 409 for a repository without commits
+            return [], response
+        if response.status_code != 200:
+            print(f"Error fetching commits for {repo_name}: {response.status_code}, {response.text}")
+            return None, None
+        with metrics.timer("json_parse"):
             page_data = response.json()
+        metrics.count("commits_downloaded", len(page_data))
+        return page_data, response
+
+    def iter_commit_pages(self, repo_name, since=None):
+        # A page that cannot be fetched fails the whole repository with RetrievalError, the commits after it would
+        # otherwise be missing from a history that looks complete
+        page_data, response = self.get_commits_page(repo_name, 1, since)
+        if page_data is None:
+            raise RetrievalError(f"Could not fetch page 1 of the commits of {repo_name}")
+        if not page_data:
+            return
+        yield page_data
+
+        last_page = self.get_last_page(response)
+        if self.page_executor and last_page:
+            # Page count is known up front, so the remaining pages are fetched in parallel and kept in order
+            pages = range(2, last_page + 1)
+            for page, (page_data, _) in zip(pages, self.page_executor.map(
+                    lambda page: self.get_commits_page(repo_name, page, since), pages)):
+                if page_data is None:
+                    raise RetrievalError(f"Could not fetch page {page} of the commits of {repo_name}")
+                if page_data:
+                    yield page_data
+            return
+
+        page = 2
+        while True:
+            page_data, _ = self.get_commits_page(repo_name, page, since)
+            if page_data is None:
+                raise RetrievalError(f"Could not fetch page {page} of the commits of {repo_name}")
             if not page_data:
                 break
-            commits.extend(page_data)
+            yield page_data
             page += 1
-            time.sleep(self.timeout)  # To avoid hitting rate limits
+
+    def get_commits_for_repo(self, repo_name, since=None):
+        commits = []
+        for page_data in self.iter_commit_pages(repo_name, since):
+            commits.extend(page_data)
         return commits
 
-    def retrieve_commits(self, output_file="organization_commits.json", file_path=""):
-        all_data = {}
+    def get_head_commit(self, repo_name, etag=None):
+        # Conditional request for the newest commit only, a 304 answer does not count against the rate limit (the
+        # scheduler gives its budget back)
+        commits_url = f"{self.base_url}/repos/{self.org_name}/{repo_name}/commits"
+        headers = {"If-None-Match": etag} if etag else None
+        response = self.scheduler.request(self.session, commits_url, params={"per_page": 1}, headers=headers)
+        if response.status_code == 304:
+            return None, etag, True
+        if response.status_code == 409:
+            return None, etag, False
+        if response.status_code != 200:
+            print(f"Error fetching commits for {repo_name}: {response.status_code}, {response.text}")
+            raise RetrievalError(f"Could not fetch the newest commit of {repo_name}")
+        page_data = response.json()
+        return (page_data[0] if page_data else None), response.headers.get("ETag"), False
+
+    @staticmethod
+    def get_repo_state(newest_commit, etag=None):
+        if not newest_commit:
+            return {"sha": None, "date": None, "etag": etag}
+        return {
+            "sha": newest_commit.get("sha"),
+            "date": newest_commit.get("commit", {}).get("committer", {}).get("date"),
+            "etag": etag
+        }
+
+    def fetch_repo(self, repo_name, store):
+        # Pages go straight into the repository shard, only the newest commit is kept for the state. A failed page
+        # aborts the new shard, the previous one (if any) is kept
+        print(f"Fetching commits for repository: {repo_name}")
+        newest_commit = None
+        with store.open_repo(repo_name) as writer:
+            for page_data in self.iter_commit_pages(repo_name):
+                newest_commit = newest_commit or page_data[0]
+                with metrics.timer("store_write"):
+                    writer.write(page_data)
+        return self.get_repo_state(newest_commit)
+
+    def update_repo(self, repo_name, repo_state, store):
+        if not repo_state or not repo_state.get("sha") or not os.path.exists(store.shard_path(repo_name)):
+            return self.fetch_repo(repo_name, store)
+
+        head, etag, not_modified = self.get_head_commit(repo_name, repo_state.get("etag"))
+        if not_modified or (head and head.get("sha") == repo_state["sha"]):
+            print(f"No new commits for repository: {repo_name}")
+            return dict(repo_state, etag=etag)
+        if head is None:
+            return repo_state
+
+        # since= is inclusive, so commits we already hold are filtered out by SHA before appending. Nothing is appended
+        # unless every page arrived, the state then still points at the commits we hold
+        print(f"Fetching new commits for repository: {repo_name} since {repo_state['date']}")
+        known_shas = {commit.sha for commit in store.iter_commits(repo_name)}
+        new_commits = [commit for commit in self.get_commits_for_repo(repo_name, since=repo_state["date"])
+                       if commit.get("sha") not in known_shas]
+        store.append_commits(repo_name, new_commits)
+        return self.get_repo_state(new_commits[0] if new_commits else head, etag)
+
+    @staticmethod
+    def load_json(path, default):
+        if not os.path.exists(path):
+            return default
+        with open(path, "r") as json_file:
+            return json.load(json_file)
+
+    @staticmethod
+    def write_json_atomic(path, data, indent=None):
+        # Write next to the target and swap it in, so a crash never leaves a half written file behind
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as json_file:
+            json.dump(data, json_file, indent=indent)
+        os.replace(tmp_path, path)
+
+    def retrieve_commits(self, store_dir="organization_commits/", file_path="", incremental=False,
+                         state_file="retrieve_state.json"):
+        state_path = file_path + state_file
+        store = CommitStore(file_path + store_dir, keep_raw=self.keep_raw)
+
+        # Incremental runs start from the previous state, any run resumes the repos an interrupted run finished
+        state = self.load_json(state_path, {})
+        completed = store.start_run()
+        state_lock = threading.Lock()
+        failed = []
+
+        def process_repo(repo_name):
+            if repo_name in completed:
+                print(f"Already retrieved in the interrupted run: {repo_name}")
+                return
+
+            try:
+                repo_state = self.update_repo(repo_name, state.get(repo_name) if incremental else None, store)
+            except RetrievalError as e:
+                # Left out of this run's state and not marked completed, the next run fetches it again
+                print(f"Giving up on repository {repo_name} for this run: {e}")
+                failed.append(repo_name)
+                metrics.count("repositories_failed")
+                return
+            with state_lock:
+                state[repo_name] = repo_state
+                self.write_json_atomic(state_path, state, indent=4)
+            store.mark_completed(repo_name)
+            metrics.count("repositories_retrieved")
+
         repos = self.get_all_repos()
 
         print(f"Found {len(repos)} repositories.")
 
-        for repo in repos:
-            repo_name = repo["name"]
-            print(f"Fetching commits for repository: {repo_name}")
-            commits = self.get_commits_for_repo(repo_name)
-            all_data[repo_name] = commits
+        # Shards of repositories no longer listed are removed, the listing is complete once get_all_repos returns
+        repo_names = [repo["name"] for repo in repos]
+        store.set_repos(repo_names)
+        metrics.progress("repositories_retrieved", len(repo_names))
+        if self.workers > 1:
+            # Repositories are spread over one pool, their extra pages over another so repo workers never starve
+            with ThreadPoolExecutor(max_workers=self.workers) as repo_executor, \
+                    ThreadPoolExecutor(max_workers=self.workers) as page_executor:
+                self.page_executor = page_executor
+                try:
+                    list(repo_executor.map(process_repo, repo_names))
+                finally:
+                    self.page_executor = None
+        else:
+            for repo_name in repo_names:
+                process_repo(repo_name)
+
+        store.finish_run()
+
+        if failed:
+            print(f"{len(failed)} repositories could not be retrieved and are kept as they were: {', '.join(failed)}")
+        print(f"All {store.total_count()} commits have been saved to {store_dir}")
+        self.scheduler.print_report()
+
+    # --- Patches ---
+    def get_commit_files(self, repo_name, sha):
+        # Files changed by one commit with their patches, GitHub lists them 300 per page (3000 at most)
+        commit_url = f"{self.base_url}/repos/{self.org_name}/{repo_name}/commits/{sha}"
+        files = []
+        page = 1
+        while True:
+            response = self.scheduler.request(self.session, commit_url, params={"page": page} if page > 1 else None)
+            if response.status_code != 200:
+                print(f"Error fetching files of commit {sha} in {repo_name}: {response.status_code}, {response.text}")
+                return None
+            with metrics.timer("json_parse"):
+                files.extend(response.json().get("files") or ())
+            if "next" not in response.links:
+                break
+            page += 1
+        metrics.count("patches_downloaded")
+        return PatchRecord.from_api(sha, files)
+
+    def retrieve_patches(self, store_dir="organization_commits/", patch_dir="commit_patches/", file_path="",
+                         since=None, batch_size=100):
+        # Optional stage after retrieve_commits: caches the files and patches of every commit of the store that has
+        # none yet, dated since or later when given (one request per commit, so large organisations want a bound).
+        # Requests run on the retriever's workers and each batch is appended as it completes, an interrupted run
+        # picks up where it stopped. Commits that failed are fetched again by the next run
+        store = CommitStore(file_path + store_dir)
+        patches = PatchStore(file_path + patch_dir)
+        patches.set_repos(store.repo_names())
+
+        # Cached by SHA, a commit shared by forks and mirrors is fetched once
+        cached = {sha for repo_name in patches.repo_names() for sha in patches.iter_shas(repo_name)}
+        print(f"Found {len(cached)} cached commit patches.")
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for repo_name in store.repo_names():
+                wanted = []
+                for commit in store.iter_commits(repo_name):
+                    if not commit.sha or commit.sha in cached:
+                        continue
+                    if since is None or (commit.committer_date or "") >= since:
+                        cached.add(commit.sha)
+                        wanted.append(commit.sha)
+                if not wanted:
+                    continue
 
-        # Save all data to a JSON file
-        with open(file_path + output_file, "w") as json_file:
-            json.dump(all_data, json_file, indent=4)
+                print(f"Fetching patches of {len(wanted)} commits for repository: {repo_name}")
+                for start in range(0, len(wanted), batch_size):
+                    batch = wanted[start:start + batch_size]
+                    records = executor.map(lambda sha: self.get_commit_files(repo_name, sha), batch)
+                    with metrics.timer("store_write"):
+                        patches.append_commits(repo_name, [record for record in records if record is not None])
 
-        print(f"All commits have been saved to {output_file}")
+        print(f"All {patches.total_count()} commit patches have been saved to {patch_dir}")
+        self.scheduler.print_report()
@@ -0,0 +1,268 @@
+from generators_commit_analysis.commit_record import CommitRecord
+from bisect import bisect_right
+from itertools import islice
+import threading
+import gzip
+import json
+import os
+
+
+class RepoCommits:
+    # Lazy view over one repository shard, every iteration streams the file again
+    def __init__(self, store, repo_name):
+        self.store = store
+        self.repo_name = repo_name
+
+    def __iter__(self):
+        return self.store.iter_commits(self.repo_name)
+
+    def __len__(self):
+        return self.store.count(self.repo_name)
+
+
+class ShardWriter:
+    # Writes a new gzip member every member_rows rows and notes where it starts, see CommitStore.members
+    def __init__(self, store, repo_name):
+        self.store = store
+        self.repo_name = repo_name
+        self.tmp_path = store.shard_path(repo_name) + ".tmp"
+        self.raw = open(self.tmp_path, "wb")
+        self.file = None
+        self.count = 0
+        self.members = []
+
+    def write(self, commits):
+        for commit in commits:
+            if self.count % self.store.member_rows == 0:
+                self.start_member()
+            self.file.write(self.store.encode(commit))
+            self.count += 1
+
+    def start_member(self):
+        if self.file is not None:
+            self.file.close()
+        self.members.append([self.count, self.raw.tell()])
+        self.file = gzip.open(self.raw, "wt", encoding="utf-8", compresslevel=self.store.compresslevel)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        self.raw.close()
+
+    def commit(self):
+        self.close()
+        os.replace(self.tmp_path, self.store.shard_path(self.repo_name))
+        self.store.set_repo(self.repo_name, self.count, new_generation=True, members=self.members)
+
+    def abort(self):
+        self.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+class CommitStore:
+    def __init__(self, store_path, compresslevel=6, keep_raw=False, member_rows=10000):
+        self.store_path = store_path
+        self.compresslevel = compresslevel
+        self.keep_raw = keep_raw
+        # Rows per gzip member of a shard. Readers starting at a row seek to the member holding it, so commit ranges
+        # of a large repository (parallel work units of chunk_size rows, a multiple of this) cost what they read
+        self.member_rows = member_rows
+        self.manifest_path = os.path.join(store_path, "manifest.json")
+        self.lock = threading.Lock()
+        self.manifest = self.load_manifest()
+
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    def load_manifest(self):
+        if not self.exists():
+            return {"format": "record", "repos": {}}
+        with open(self.manifest_path, "r") as manifest_file:
+            return json.load(manifest_file)
+
+    def save_manifest(self):
+        # Called with the lock held, the manifest is swapped in atomically so it always matches the shards
+        os.makedirs(self.store_path, exist_ok=True)
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=4)
+        os.replace(tmp_path, self.manifest_path)
+
+    def shard_path(self, repo_name):
+        return os.path.join(self.store_path, f"{repo_name}.ndjson.gz")
+
+    def encode(self, commit):
+        # Raw API payloads are projected to a CommitRecord at ingest
+        if not isinstance(commit, CommitRecord):
+            commit = CommitRecord.from_api(commit, self.keep_raw)
+        return json.dumps(commit.to_row(), separators=(",", ":")) + "\n"
+
+    @staticmethod
+    def decode(row, keep_raw=False):
+        return CommitRecord.from_row(row, keep_raw)
+
+    # --- Reading ---
+    def repo_names(self):
+        return list(self.manifest["repos"])
+
+    def count(self, repo_name):
+        return self.manifest["repos"].get(repo_name, {}).get("count", 0)
+
+    def generation(self, repo_name):
+        return self.manifest["repos"].get(repo_name, {}).get("generation", 0)
+
+    def total_count(self):
+        return sum(repo["count"] for repo in self.manifest["repos"].values())
+
+    def members(self, repo_name):
+        # [first row, byte offset] of each gzip member of the shard. Shards written before members were recorded are
+        # one stream read from the start
+        repo = self.manifest["repos"].get(repo_name, {})
+        return repo.get("members") or [[0, 0]]
+
+    def iter_commits(self, repo_name, start=0, stop=None, keep_raw=False, skip=None):
+        # skip holds SHAs whose rows are passed over without being decoded
+        shard_path = self.shard_path(repo_name)
+        if not os.path.exists(shard_path):
+            return
+        # Reading starts at the member holding row start, the members after it are read back transparently as one
+        # stream and the lines before start in its member are not parsed
+        members = self.members(repo_name)
+        first_row, offset = members[max(bisect_right(members, [start, float("inf")]) - 1, 0)]
+        with open(shard_path, "rb") as raw:
+            raw.seek(offset)
+            with gzip.open(raw, "rt", encoding="utf-8") as shard:
+                for line in islice(shard, start - first_row, None if stop is None else stop - first_row):
+                    if skip and self.row_sha(line) in skip:
+                        continue
+                    if line.strip():
+                        yield self.decode(json.loads(line), keep_raw)
+
+    @staticmethod
+    def row_sha(line):
+        # A record row starts with its quoted 40 character SHA, None for anything else (raw payloads, missing SHA)
+        if line.startswith('["') and line[42:44] == '",':
+            return line[2:42]
+        return None
+
+    def iter_shas(self, repo_name):
+        shard_path = self.shard_path(repo_name)
+        if not os.path.exists(shard_path):
+            return
+        with gzip.open(shard_path, "rt", encoding="utf-8") as shard:
+            for line in shard:
+                sha = self.row_sha(line)
+                if sha is not None:
+                    yield sha
+                elif line.strip():
+                    yield self.decode(json.loads(line)).sha
+
+    def items(self):
+        # Same shape as the old {repo: [commits]} dict, but nothing is loaded until a repo is iterated
+        for repo_name in self.repo_names():
+            yield repo_name, RepoCommits(self, repo_name)
+
+    def iter_all(self):
+        for repo_name in self.repo_names():
+            for commit in self.iter_commits(repo_name):
+                yield repo_name, commit
+
+    # --- Writing ---
+    def set_repos(self, repo_names):
+        # Keep the organisation order, drop repositories that no longer exist
+        with self.lock:
+            os.makedirs(self.store_path, exist_ok=True)
+            old_repos = self.manifest["repos"]
+            self.manifest["repos"] = {
+                repo_name: old_repos.get(repo_name, {"count": 0, "generation": 0}) for repo_name in repo_names
+            }
+            for repo_name in set(old_repos) - set(repo_names):
+                if os.path.exists(self.shard_path(repo_name)):
+                    os.remove(self.shard_path(repo_name))
+            self.save_manifest()
+
+    def set_repo(self, repo_name, count, new_generation=False, members=None):
+        # members lists the gzip members of a new shard, or those appended to the current one
+        with self.lock:
+            repo = self.manifest["repos"].setdefault(repo_name, {"count": 0, "generation": 0})
+            if new_generation:
+                repo["generation"] += 1
+                repo["members"] = []
+            if members:
+                # A shard written before members were recorded starts with one member holding its first rows
+                if repo["count"] and not repo.get("members"):
+                    repo["members"] = [[0, 0]]
+                repo.setdefault("members", []).extend(members)
+            repo["count"] = count
+            self.save_manifest()
+
+    def open_repo(self, repo_name):
+        # Replaces the repository shard once the writer is committed, pages are written as they arrive
+        os.makedirs(self.store_path, exist_ok=True)
+        return ShardWriter(self, repo_name)
+
+    def append_commits(self, repo_name, commits):
+        # Appended as new gzip members of at most member_rows rows each
+        if not commits:
+            return
+        count = self.count(repo_name)
+        members = []
+        with open(self.shard_path(repo_name), "ab") as shard:
+            offset = shard.tell()
+            for start in range(0, len(commits), self.member_rows):
+                lines = "".join(self.encode(commit) for commit in commits[start:start + self.member_rows])
+                member = gzip.compress(lines.encode("utf-8"), compresslevel=self.compresslevel)
+                members.append([count + start, offset])
+                shard.write(member)
+                offset += len(member)
+            shard.flush()
+            os.fsync(shard.fileno())
+        self.set_repo(repo_name, count + len(commits), members=members)
+
+    # --- Checkpoints ---
+    def start_run(self):
+        # Repositories finished by an interrupted run are listed until finish_run is called
+        with self.lock:
+            completed = set(self.manifest.setdefault("run_completed", []))
+            self.save_manifest()
+        return completed
+
+    def mark_completed(self, repo_name):
+        with self.lock:
+            self.manifest.setdefault("run_completed", []).append(repo_name)
+            self.save_manifest()
+
+    def finish_run(self):
+        with self.lock:
+            self.manifest.pop("run_completed", None)
+            self.save_manifest()
+
+    def import_json(self, json_path):
+        # One-off conversion of a legacy organization_commits.json dump
+        with open(json_path, "r") as json_file:
+            commits_data = json.load(json_file)
+        self.set_repos(list(commits_data))
+        for repo_name, commits in commits_data.items():
+            with self.open_repo(repo_name) as writer:
+                writer.write(commits)
+
+    def is_compact(self):
+        return self.manifest.get("format") == "record"
+
+    def compact(self):
+        # Rewrites shards holding raw API payloads (stores written before CommitRecord) as compact records
+        for repo_name in self.repo_names():
+            with self.open_repo(repo_name) as writer:
+                writer.write(self.iter_commits(repo_name, keep_raw=self.keep_raw))
+        with self.lock:
+            self.manifest["format"] = "record"
+            self.save_manifest()
@@ -0,0 +1,184 @@
+import sqlite3
+from generators_commit_analysis.commit_record import CommitRecord
+
+COMMIT_COLUMNS = ("sha", "message", "author_name", "author_email", "author_date", "committer_name", "committer_email",
+                  "committer_date", "account_name")
+
+
+class CommitWarehouse:
+    # The commit store loaded into SQLite, so analyses run as indexed queries instead of Python passes over every
+    # commit. Messages are also in an FTS5 trigram table, which answers substring keyword searches
+    def __init__(self, warehouse_file):
+        self.warehouse_file = warehouse_file
+        self.connection = sqlite3.connect(warehouse_file)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS repos (
+                repo TEXT PRIMARY KEY,
+                ordinal INTEGER NOT NULL,
+                generation INTEGER NOT NULL,
+                count INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS commits (
+                commit_id INTEGER PRIMARY KEY,
+                repo TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                sha TEXT,
+                message TEXT,
+                author_name TEXT,
+                author_email TEXT,
+                author_date TEXT,
+                committer_name TEXT,
+                committer_email TEXT,
+                committer_date TEXT,
+                account_name TEXT,
+                ascii_message INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS commits_repo ON commits (repo, position);
+            CREATE INDEX IF NOT EXISTS commits_sha ON commits (sha);
+            CREATE INDEX IF NOT EXISTS commits_author_email ON commits (author_email, repo);
+            CREATE INDEX IF NOT EXISTS commits_committer_email ON commits (committer_email, repo);
+            CREATE INDEX IF NOT EXISTS commits_committer_date ON commits (committer_date);
+            CREATE INDEX IF NOT EXISTS commits_non_ascii ON commits (ascii_message) WHERE ascii_message = 0;
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(
+                message, content='commits', content_rowid='commit_id', tokenize='trigram case_sensitive 0'
+            );
+        """)
+
+    def close(self):
+        self.connection.close()
+
+    # --- Loading ---
+    def update(self, store, batch_size=5000):
+        # Same rules as KeywordIndex.update: shards only grow within a generation, so only new commits are loaded
+        loaded = {repo: (generation, count) for repo, generation, count
+                  in self.connection.execute("SELECT repo, generation, count FROM repos")}
+        repo_names = list(store.repo_names())
+        added = 0
+
+        for repo in set(loaded) - set(repo_names):
+            self.drop_repo(repo)
+
+        for ordinal, repo in enumerate(repo_names):
+            generation, count = loaded.get(repo, (None, 0))
+            if generation != store.generation(repo):
+                self.drop_repo(repo)
+                count = 0
+            elif count >= store.count(repo):
+                self.connection.execute("UPDATE repos SET ordinal = ? WHERE repo = ?", (ordinal, repo))
+                continue
+
+            batch = []
+            loaded_count = count
+            for position, commit in enumerate(store.iter_commits(repo, start=count), start=count):
+                batch.append((position, commit))
+                loaded_count = position + 1
+                if len(batch) >= batch_size:
+                    self.add_commits(repo, batch)
+                    batch = []
+            self.add_commits(repo, batch)
+
+            added += loaded_count - count
+            self.connection.execute("INSERT OR REPLACE INTO repos VALUES (?, ?, ?, ?)",
+                                    (repo, ordinal, store.generation(repo), loaded_count))
+            self.connection.commit()
+
+        if added:
+            self.connection.execute("ANALYZE")
+        self.connection.commit()
+        return added
+
+    def drop_repo(self, repo):
+        # External content FTS rows are removed by replaying the text they were built from
+        self.connection.execute("INSERT INTO messages (messages, rowid, message) "
+                                "SELECT 'delete', commit_id, message FROM commits WHERE repo = ?", (repo,))
+        self.connection.execute("DELETE FROM commits WHERE repo = ?", (repo,))
+        self.connection.execute("DELETE FROM repos WHERE repo = ?", (repo,))
+
+    def add_commits(self, repo, batch):
+        if not batch:
+            return
+        next_commit_id = self.connection.execute("SELECT COALESCE(MAX(commit_id), 0) + 1 FROM commits").fetchone()[0]
+        rows = []
+        for commit_id, (position, commit) in enumerate(batch, start=next_commit_id):
+            rows.append((commit_id, repo, position) + tuple(getattr(commit, column) for column in COMMIT_COLUMNS)
+                        + (int((commit.message or "").isascii()),))
+
+        self.connection.executemany(f"INSERT INTO commits VALUES ({','.join('?' * 13)})", rows)
+        self.connection.executemany("INSERT INTO messages (rowid, message) VALUES (?, ?)",
+                                    ((row[0], row[4]) for row in rows))
+
+    # --- Analysis ---
+    def query(self, sql, params=()):
+        # Ad hoc queries over the commits and repos tables, rows are streamed from the cursor
+        return self.connection.execute(sql, params)
+
+    def analyze_commits(self, deduplicate=False):
+        # Same result as CommitAnalyzer.analyze_commits, empty emails are not counted there either. deduplicate counts
+        # a commit held by several repositories once in the total
+        repo_analysis = [
+            {
+                'repository': repo,
+                'commit_count': commit_count,
+                'committer_count': committer_count,
+                'author_count': author_count,
+            }
+            for repo, commit_count, committer_count, author_count in self.connection.execute("""
+                SELECT repos.repo, COUNT(commits.commit_id), COUNT(DISTINCT NULLIF(commits.committer_email, '')),
+                       COUNT(DISTINCT NULLIF(commits.author_email, ''))
+                FROM repos LEFT JOIN commits ON commits.repo = repos.repo
+                GROUP BY repos.repo ORDER BY repos.ordinal
+            """)
+        ]
+        total_commits, total_committers, total_authors = self.connection.execute(f"""
+            SELECT {"COUNT(DISTINCT sha) + COUNT(*) - COUNT(sha)" if deduplicate else "COUNT(*)"},
+                   COUNT(DISTINCT NULLIF(committer_email, '')), COUNT(DISTINCT NULLIF(author_email, ''))
+            FROM commits
+        """).fetchone()
+        return repo_analysis, total_commits, total_committers, total_authors
+
+    def commits_per_author(self, repo=None, since=None, until=None):
+        # Commits per author email, optionally for one repository and a committer date range (ISO strings)
+        conditions, params = [], []
+        if repo is not None:
+            conditions.append("repo = ?")
+            params.append(repo)
+        if since is not None:
+            conditions.append("committer_date >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("committer_date < ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self.connection.execute(
+            f"SELECT author_email, COUNT(*) FROM commits {where} GROUP BY author_email ORDER BY COUNT(*) DESC",
+            params).fetchall()
+
+    # --- Searching ---
+    @staticmethod
+    def can_serve(keyword):
+        # The trigram tokenizer only matches substrings of three characters or more, and folds case like str.lower
+        # only for ASCII
+        return len(keyword) >= 3 and keyword.isascii()
+
+    def candidate_commits(self, keywords, whole_word, exclude_repos=(), repo_order=None, fuzzy=None):
+        # Same contract as KeywordIndex.candidate_commits, so the searcher takes either. Case folding in FTS5 and
+        # str.lower only agree on ASCII, so commits with other characters in the message are always candidates.
+        # The full text index has no trigrams, fuzzy searches scan the commits
+        if fuzzy is not None or not keywords or not all(self.can_serve(keyword) for keyword in keywords):
+            return None
+
+        match = " OR ".join('"' + keyword.replace('"', '""') + '"' for keyword in keywords)
+        rows = self.connection.execute("""
+            SELECT commits.repo, commits.sha, commits.message, commits.committer_date, commits.committer_name,
+                   commits.account_name
+            FROM commits JOIN repos ON repos.repo = commits.repo
+            WHERE commits.commit_id IN (SELECT rowid FROM messages WHERE messages MATCH ?)
+               OR commits.ascii_message = 0
+            ORDER BY repos.ordinal, commits.position
+        """, (match,))
+
+        # repo_order is unused, the warehouse keeps the store order itself
+        return ((repo, CommitRecord(sha=sha, message=message, committer_date=committer_date,
+                                    committer_name=committer_name, account_name=account_name))
+                for repo, sha, message, committer_date, committer_name, account_name in rows
+                if repo not in exclude_repos)
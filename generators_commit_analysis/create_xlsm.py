@@ -1,20 +1,70 @@
 import openpyxl
 from openpyxl.styles import PatternFill, Border, Side, Alignment, Font, NamedStyle
+from openpyxl.cell import Cell, WriteOnlyCell
 from datetime import datetime
+from generators_commit_analysis.commit_store import CommitStore
+from generators_commit_analysis.metrics import metrics
+from itertools import chain
+from xml.etree import ElementTree
+import posixpath
+import zipfile
 import json
+import re
 import os
 
+SHEET_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+RELATIONSHIP_ID = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id"
+
+
+class ColumnWidths:
+    # Widths are tracked while rows are produced, with the same formula as ExcelCreator.adjust_column_width
+    def __init__(self, max_width_px):
+        self.max_width_px = max_width_px
+        self.lengths = []
+
+    def track(self, row):
+        for index, value in enumerate(row):
+            if isinstance(value, Cell):
+                value = value.value
+            if index >= len(self.lengths):
+                self.lengths.append(0)
+            if value is not None:
+                self.lengths[index] = max(self.lengths[index], len(str(value)))
+
+    def apply(self, sheet):
+        for index, max_length in enumerate(self.lengths, 1):
+            col_letter = openpyxl.utils.get_column_letter(index)
+            sheet.column_dimensions[col_letter].width = min((max_length + 2) * 1.2, self.max_width_px / 7)
+
 
 class ExcelCreator:
-    def __init__(self, commits_file, analysis_file, keyword_search_file, excel_file, file_path=""):
+    activity_sheets = ("activity_by_period", "activity_by_repo", "activity_by_author")
+    patch_search_sheet = "patch_search_results"
+
+    def __init__(self, commits_store, analysis_file, keyword_search_file, excel_file, file_path="", streaming=False,
+                 width_sample_rows=1000, activity_file=None, patch_search_file=None, watchlist_files=None):
         self.analysis_file = file_path + analysis_file
         self.excel_file = file_path + excel_file
-        self.commits_file = file_path + commits_file
+        self.commits_store = file_path + commits_store
         self.keyword_search_file = file_path + keyword_search_file
         self.sheet_name = os.path.splitext(os.path.basename(analysis_file))[0]  # Sheet named after the file
         self.max_column_width_px = 800  # Maximum column width in pixels for the organization_commits sheet
+        self.streaming = streaming
+        self.width_sample_rows = width_sample_rows
+        # Activity sheets are only written when an activity report is given
+        self.activity_file = file_path + activity_file if activity_file else None
+        # Same for the patch search sheet and patch search results
+        self.patch_search_file = file_path + patch_search_file if patch_search_file else None
+        # Watchlist name -> results file, each written to a sheet laid out like keyword_search_results
+        self.watchlist_files = {name: file_path + file for name, file in (watchlist_files or {}).items()}
 
     def create_workbook(self):
+        if self.can_stream():
+            self.create_workbook_streaming()
+            return
+        if self.streaming:
+            print(f"Sheets {', '.join(self.kept_sheets())} are kept from the existing workbook, exporting in memory")
+
         # Load or create a workbook
         if os.path.exists(self.excel_file):
             workbook = openpyxl.load_workbook(self.excel_file, keep_vba=True)  # Load existing .xlsm with macros
@@ -35,8 +85,18 @@ class ExcelCreator:
         # Step 2: Add organization commits data
         self.add_organization_commits_sheet(workbook)
 
-        # Step 3: Add keyword search results data
+        # Step 3: Add keyword search results data, and the results of each watchlist
         self.add_keyword_search_results_sheet(workbook)
+        for name, watchlist_file in self.watchlist_files.items():
+            self.add_keyword_search_results_sheet(workbook, self.watchlist_sheet(name), watchlist_file)
+
+        # Step 4: Add activity analysis data
+        if self.activity_file:
+            self.add_activity_sheets(workbook)
+
+        # Step 5: Add patch search results data
+        if self.patch_search_file:
+            self.add_patch_search_sheet(workbook)
 
         # Check and remove 'Sheet3' if it exists
         if 'Sheet3' in workbook.sheetnames:
@@ -45,9 +105,25 @@ class ExcelCreator:
             print("Removed unused Sheet3")
 
         # Save the workbook as a macro-enabled workbook (.xlsm)
-        workbook.save(self.excel_file)
+        with metrics.timer("workbook_save"):
+            workbook.save(self.excel_file)
         print(f"Excel file '{self.excel_file}' updated successfully.")
 
+    @staticmethod
+    def recreate_sheet(workbook, name):
+        # A new empty sheet in place of the old one, at the same position and with the same codeName so the VBA
+        # document module of the sheet still belongs to it
+        if name not in workbook.sheetnames:
+            print(f"Created new sheet: {name}")
+            return workbook.create_sheet(name)
+        old = workbook[name]
+        index, code_name = workbook.index(old), old.sheet_properties.codeName
+        workbook.remove(old)
+        sheet = workbook.create_sheet(name, index)
+        sheet.sheet_properties.codeName = code_name
+        print(f"Recreated sheet: {name}")
+        return sheet
+
     @staticmethod
     def clear_sheet(sheet):
         # Clear the contents of the sheet while keeping the sheet itself
@@ -143,6 +219,7 @@ class ExcelCreator:
 
         # Adjust column widths
         self.adjust_column_width(sheet, max_width_px=500)  # Adjust with a different max width for commit analysis
+        metrics.count("cells_written", sheet.max_row * sheet.max_column)
 
     @staticmethod
     def adjust_column_width(sheet, max_width_px):
@@ -168,9 +245,8 @@ class ExcelCreator:
             sheet = workbook.create_sheet(sheet_name)
             print(f"Created new sheet: {sheet_name}")
 
-        # Load the organization commits data
-        with open(self.commits_file, "r") as file:
-            commits_data = json.load(file)
+        # Stream the organization commits from the commit store
+        commits_data = CommitStore(self.commits_store)
 
         # Define headers
         headers = ["Repository", "Message", "Committer", "Author", "SHA", "Date"]
@@ -185,14 +261,12 @@ class ExcelCreator:
             for commit in commits:
                 if commit:
                     # Extract fields safely
-                    commit_message = commit.get("commit", {}).get("message", "unknown")
-                    committer_info = commit.get("commit", {}).get("committer", {})
-                    committer = committer_info.get("name", "unknown") if committer_info else "unknown"
-                    author_info = commit.get("commit", {}).get("author", {})
-                    author = author_info.get("name", "unknown") if author_info else "unknown"
-                    commit_date = committer_info.get("date", "unknown") if committer_info else "unknown"
+                    commit_message = commit.message or "unknown"
+                    committer = commit.committer_name or "unknown"
+                    author = commit.author_name or "unknown"
+                    commit_date = commit.committer_date or "unknown"
                     commit_date = commit_date.replace("T", " ").replace("Z", "")
-                    sha = commit.get("sha", "unknown")
+                    sha = commit.sha or "unknown"
 
                     # Write values to the sheet
                     sheet.cell(row=row_num, column=1, value=repo)
@@ -209,10 +283,16 @@ class ExcelCreator:
 
         # Adjust column widths with word wrapping
         self.adjust_column_width(sheet, max_width_px=self.max_column_width_px)
+        metrics.count("commit_rows_written", row_num - 2)
+        metrics.count("cells_written", sheet.max_row * sheet.max_column)
+
+    @staticmethod
+    def watchlist_sheet(name):
+        # Sheet names are at most 31 characters and cannot hold []:*?/\
+        return re.sub(r"[\[\]:*?/\\]", "_", f"watchlist_{name}")[:31]
 
-    def add_keyword_search_results_sheet(self, workbook):
+    def add_keyword_search_results_sheet(self, workbook, sheet_name="keyword_search_results", keyword_search_file=None):
         # Create or clear the sheet for keyword search results
-        sheet_name = "keyword_search_results"
         if sheet_name in workbook.sheetnames:
             sheet = workbook[sheet_name]
             self.clear_sheet(sheet)
@@ -222,13 +302,14 @@ class ExcelCreator:
             print(f"Created new sheet: {sheet_name}")
 
         # Load the keyword search results data
-        keyword_search_file = self.keyword_search_file
+        keyword_search_file = keyword_search_file or self.keyword_search_file
         with open(keyword_search_file, "r") as file:
             search_results_data = json.load(file)
 
         # Define headers
         headers = [
-            "Commit Date", "Repository", "Message", "Unique Finds", "Total Instances", "Committer", "Author", "SHA"
+            "Commit Date", "Repository", "Message", "Unique Finds", "Total Instances", "Committer", "Author", "SHA",
+            "Fuzzy Matches"
         ]
 
         # Write headers
@@ -238,7 +319,7 @@ class ExcelCreator:
         # Write data rows
         row_num = 2
         for sha, data in search_results_data.items():
-            repo = data.get("repo", "unknown")
+            repo = self.result_repos(data)
             commit_data = data.get("commit", {})
 
             # Extract commit information
@@ -259,6 +340,7 @@ class ExcelCreator:
             sheet.cell(row=row_num, column=6, value=committer)
             sheet.cell(row=row_num, column=7, value=author)
             sheet.cell(row=row_num, column=8, value=sha)
+            sheet.cell(row=row_num, column=9, value=self.fuzzy_matches(commit_data))
 
             # Enable word wrapping for the message column
             sheet.cell(row=row_num, column=3).alignment = Alignment(wrap_text=True)
@@ -267,3 +349,330 @@ class ExcelCreator:
 
         # Adjust column widths with word wrapping
         self.adjust_column_width(sheet, max_width_px=self.max_column_width_px)
+        metrics.count("cells_written", sheet.max_row * sheet.max_column)
+
+    # --- Activity analysis ---
+    def load_activity(self):
+        with open(self.activity_file, "r") as file:
+            return json.load(file)
+
+    def activity_rows(self, activity):
+        # Rows of each activity sheet, shared by the in-memory and the streaming export
+        periods = [period["period"] for period in activity["periods"]]
+        rolling = f"Rolling Commits ({activity['rolling_window']} {activity['period']}s)"
+        recent = f"Commits (last {activity['hotspot_periods']} {activity['period']}s)"
+        previous = f"Commits (previous {activity['hotspot_periods']} {activity['period']}s)"
+
+        def period_rows():
+            yield ["Period", "Commits", "Active Authors", "New Authors", "Churned Authors", rolling]
+            for period in activity["periods"]:
+                yield [period["period"], period["commits"], period["active_authors"], period["new_authors"],
+                       period["churned_authors"], period["rolling_commits"]]
+
+        def repo_rows():
+            yield ["Repository", "Commits", "Authors", "First Period", "Last Period", recent, previous,
+                   "Growth"] + periods
+            for repo in activity["repositories"]:
+                yield [repo["repository"], repo["commits"], repo["authors"], repo["first_period"],
+                       repo["last_period"], repo["recent_commits"], repo["previous_commits"],
+                       repo["growth"]] + repo["commits_per_period"]
+
+        def author_rows():
+            yield ["Author", "Commits", "Repositories", "First Period", "Last Period", "Active Periods"]
+            for author in activity["authors"]:
+                yield [author["author"], author["commits"], author["repositories"], author["first_period"],
+                       author["last_period"], author["active_periods"]]
+
+        return dict(zip(self.activity_sheets, (period_rows(), repo_rows(), author_rows())))
+
+    def add_activity_sheets(self, workbook):
+        for name, rows in self.activity_rows(self.load_activity()).items():
+            # Recreated rather than cleared, the number of period columns changes between runs
+            sheet = self.recreate_sheet(workbook, name)
+            for row in rows:
+                sheet.append(row)
+            self.adjust_column_width(sheet, max_width_px=self.max_column_width_px)
+            metrics.count("cells_written", sheet.max_row * sheet.max_column)
+
+    # --- Patch search ---
+    def load_patch_search(self):
+        with open(self.patch_search_file, "r") as file:
+            return json.load(file)
+
+    def patch_search_rows(self, results):
+        # One row per matching file, shared by the in-memory and the streaming export
+        yield ["Repository", "SHA", "File", "Status", "Added Lines", "Removed Lines", "Unique Finds",
+               "File Instances", "Commit Instances"]
+        for sha, data in results.items():
+            commit_data = data.get("commit", {})
+            repos = self.result_repos(data)
+            for filename, file_data in commit_data.get("files", {}).items():
+                yield [repos, sha, filename, file_data.get("status", "unknown"), file_data.get("added_lines", 0),
+                       file_data.get("removed_lines", 0), file_data.get("unique_finds", 0),
+                       file_data.get("total_instances", 0), commit_data.get("total_instances", 0)]
+
+    def add_patch_search_sheet(self, workbook):
+        # Recreated rather than cleared, rows are appended after the last row the sheet ever had
+        sheet = self.recreate_sheet(workbook, self.patch_search_sheet)
+        for row in self.patch_search_rows(self.load_patch_search()):
+            sheet.append(row)
+        self.adjust_column_width(sheet, max_width_px=self.max_column_width_px)
+        metrics.count("cells_written", sheet.max_row * sheet.max_column)
+
+    # --- Streaming export ---
+    def create_workbook_streaming(self):
+        workbook, template, sheets = self.open_streaming_workbook()
+        self.write_commit_analysis_streaming(sheets[self.sheet_name])
+        self.write_organization_commits_streaming(sheets["organization_commits"])
+        self.write_keyword_search_results_streaming(sheets["keyword_search_results"])
+        self.write_watchlists_streaming(sheets)
+        if self.activity_file:
+            self.write_activity_streaming(sheets)
+        if self.patch_search_file:
+            self.write_patch_search_streaming(sheets[self.patch_search_sheet])
+        self.save_streaming_workbook(workbook, template)
+
+    def generated_sheets(self):
+        sheets = [self.sheet_name, "organization_commits", "keyword_search_results"]
+        sheets.extend(self.watchlist_sheet(name) for name in self.watchlist_files)
+        if self.activity_file:
+            sheets.extend(self.activity_sheets)
+        if self.patch_search_file:
+            sheets.append(self.patch_search_sheet)
+        return sheets
+
+    def template_code_names(self):
+        # Sheet name -> codeName of every sheet of the existing workbook, in workbook order. Read from the sheetPr
+        # element at the top of each sheet part, the sheets themselves are not loaded
+        with zipfile.ZipFile(self.excel_file) as archive:
+            targets = {relationship.get("Id"): relationship.get("Target") for relationship in
+                       ElementTree.fromstring(archive.read("xl/_rels/workbook.xml.rels"))}
+            code_names = {}
+            for sheet in ElementTree.fromstring(archive.read("xl/workbook.xml")).iter(f"{SHEET_NS}sheet"):
+                target = targets.get(sheet.get(RELATIONSHIP_ID), "")
+                part = target.lstrip("/") if target.startswith("/") else posixpath.normpath("xl/" + target)
+                code_names[sheet.get("name")] = None
+                if part not in archive.namelist():
+                    continue
+                with archive.open(part) as sheet_file:
+                    # sheetPr comes first when the sheet has one, parsing stops at the first element inside the sheet
+                    elements = ElementTree.iterparse(sheet_file, events=("start",))
+                    next(elements, None)
+                    for _, element in elements:
+                        if element.tag == f"{SHEET_NS}sheetPr":
+                            code_names[sheet.get("name")] = element.get("codeName")
+                        break
+        return code_names
+
+    def kept_sheets(self):
+        # Sheets of the existing workbook the export does not generate (Sheet3 is dropped)
+        if not os.path.exists(self.excel_file):
+            return []
+        generated = set(self.generated_sheets())
+        return [name for name in self.template_code_names() if name not in generated and name != "Sheet3"]
+
+    def can_stream(self):
+        # A write-only workbook cannot carry over the formatting, merged cells, drawings and validation of sheets we
+        # do not generate, a workbook holding such sheets is updated in memory instead
+        return self.streaming and not self.kept_sheets()
+
+    def open_streaming_workbook(self):
+        # Write-only workbook: rows go straight to disk and sheets we generate are recreated rather than cleared.
+        # Each write-only sheet has its own buffer, so the generated sheets can be filled in any order once created.
+        # Only for workbooks without sheets of their own (can_stream)
+        template = None
+        code_names = {}
+        if os.path.exists(self.excel_file):
+            template = openpyxl.load_workbook(self.excel_file, keep_vba=True, read_only=True)
+            code_names = self.template_code_names()
+            print(f"Loaded existing Excel file: {self.excel_file}")
+        else:
+            print(f"Created new Excel file: {self.excel_file}")
+
+        workbook = openpyxl.Workbook(write_only=True)
+        self.add_named_styles(workbook)
+        generated = self.generated_sheets()
+        sheets = {}
+
+        if template is not None:
+            # Keep the VBA project, each sheet keeps the codeName its document module refers to
+            workbook.vba_archive = template.vba_archive
+            workbook.code_name = template.code_name
+            for name, code_name in code_names.items():
+                if name == "Sheet3":
+                    print("Removed unused Sheet3")
+                elif name in generated:
+                    sheets[name] = workbook.create_sheet(name)
+                    sheets[name].sheet_properties.codeName = code_name
+                    print(f"Recreated sheet: {name}")
+                else:
+                    raise ValueError(f"Sheet {name} of {self.excel_file} cannot be kept by the streaming export")
+
+        for name in generated:
+            if name not in sheets:
+                sheets[name] = workbook.create_sheet(name)
+                print(f"Created new sheet: {name}")
+
+        return workbook, template, sheets
+
+    def save_streaming_workbook(self, workbook, template):
+        if template is not None:
+            template.close()
+
+        # Save next to the target first, the template stayed open while its sheets were copied
+        tmp_file = self.excel_file + ".tmp"
+        with metrics.timer("workbook_save"):
+            workbook.save(tmp_file)
+        os.replace(tmp_file, self.excel_file)
+        print(f"Excel file '{self.excel_file}' updated successfully.")
+
+    @staticmethod
+    def add_named_styles(workbook):
+        # Shared named styles, so every cell references one style instead of carrying its own objects
+        thin = Side(style='thin')
+        workbook.add_named_style(NamedStyle(
+            name="analysis_header", font=Font(bold=True),
+            fill=PatternFill(start_color="D3D3D3", end_color="D3D3D3", fill_type="solid"),
+            border=Border(left=thin, right=thin, top=thin, bottom=thin)
+        ))
+        workbook.add_named_style(NamedStyle(
+            name="analysis_cell", border=Border(left=thin, right=thin, top=thin, bottom=thin),
+            alignment=Alignment(horizontal="center")
+        ))
+        workbook.add_named_style(NamedStyle(
+            name="analysis_summary", font=Font(italic=True), alignment=Alignment(horizontal="center")
+        ))
+        workbook.add_named_style(NamedStyle(
+            name="analysis_summary_first", font=Font(italic=True), alignment=Alignment(horizontal="center"),
+            border=Border(top=Side(style='thick'))
+        ))
+        workbook.add_named_style(NamedStyle(name="wrapped_text", alignment=Alignment(wrap_text=True)))
+
+    @staticmethod
+    def styled_cell(sheet, value, style):
+        cell = WriteOnlyCell(sheet, value=value)
+        cell.style = style
+        return cell
+
+    def write_streaming_rows(self, sheet, rows, max_width_px, counter="rows_written", report_every=10000):
+        # Column widths have to be written before the first row, so they are measured on a leading sample
+        widths = ColumnWidths(max_width_px)
+        rows = iter(rows)
+        sample = []
+        for row in rows:
+            sample.append(row)
+            widths.track(row)
+            if len(sample) >= self.width_sample_rows:
+                break
+        widths.apply(sheet)
+
+        written, cells = 0, 0
+        for row in chain(sample, rows):
+            sheet.append(row)
+            written += 1
+            cells += len(row)
+            if written % report_every == 0:
+                metrics.count(counter, report_every)
+        metrics.count(counter, written % report_every)
+        metrics.count("cells_written", cells)
+
+    def write_commit_analysis_streaming(self, sheet, analysis=None):
+        # analysis is (data, summary) as load_commit_analysis returns it, the report file is read when not given
+        data, summary = analysis if analysis is not None else self.load_commit_analysis()
+
+        headers = ["Repository", "Total Commits", "Unique Committers", "Unique Authors"]
+        rows = [[self.styled_cell(sheet, header, "analysis_header") for header in headers]]
+        for repo_data in data:
+            values = [repo_data["repository"], repo_data["commit_count"], repo_data["committer_count"],
+                      repo_data["author_count"]]
+            rows.append([self.styled_cell(sheet, value, "analysis_cell") for value in values])
+
+        # Summary in a single row with thick top border, after one empty row
+        rows.append([])
+        summary_data = ["Summary"] + summary[:3]  # Ensure only three summary elements
+        rows.append([self.styled_cell(sheet, item, "analysis_summary_first" if col_num == 1 else "analysis_summary")
+                     for col_num, item in enumerate(summary_data, 1)])
+
+        # The whole sheet is small, all of it counts for the widths
+        widths = ColumnWidths(max_width_px=500)
+        for row in rows:
+            widths.track(row)
+        widths.apply(sheet)
+        for row in rows:
+            sheet.append(row)
+        metrics.count("rows_written", len(rows))
+        metrics.count("cells_written", sum(len(row) for row in rows))
+
+    def write_organization_commits_streaming(self, sheet, commits=None):
+        # commits yields (repo, commit) pairs, by default every commit of the store
+        store = CommitStore(self.commits_store)
+        if commits is None:
+            commits = ((repo, commit) for repo, repo_commits in store.items() for commit in repo_commits)
+        metrics.progress("commit_rows_written", store.total_count())
+
+        def rows():
+            yield ["Repository", "Message", "Committer", "Author", "SHA", "Date"]
+            for repo, commit in commits:
+                commit_date = (commit.committer_date or "unknown").replace("T", " ").replace("Z", "")
+                yield [
+                    repo,
+                    self.styled_cell(sheet, commit.message or "unknown", "wrapped_text"),
+                    commit.committer_name or "unknown",
+                    commit.author_name or "unknown",
+                    commit.sha or "unknown",
+                    commit_date
+                ]
+
+        self.write_streaming_rows(sheet, rows(), self.max_column_width_px, counter="commit_rows_written")
+
+    @staticmethod
+    def result_repos(data):
+        # Every repository holding the commit (forks, mirrors), results saved by older versions only have one
+        return ", ".join(data.get("repos") or [data.get("repo", "unknown")])
+
+    @staticmethod
+    def fuzzy_matches(commit_data):
+        # Typos matched by a fuzzy search with their edit distance, e.g. "digibyt (1)", empty for exact matches only
+        return ", ".join(f"{match['variant']} ({match['distance']})"
+                         for matches in commit_data.get("fuzzy_matches", {}).values() for match in matches)
+
+    def write_keyword_search_results_streaming(self, sheet, search_results_data=None, keyword_search_file=None):
+        if search_results_data is None:
+            with open(keyword_search_file or self.keyword_search_file, "r") as file:
+                search_results_data = json.load(file)
+
+        def rows():
+            yield ["Commit Date", "Repository", "Message", "Unique Finds", "Total Instances", "Committer", "Author",
+                   "SHA", "Fuzzy Matches"]
+            for sha, data in search_results_data.items():
+                commit_data = data.get("commit", {})
+                yield [
+                    commit_data.get("commit_date", "unknown"),
+                    self.result_repos(data),
+                    self.styled_cell(sheet, commit_data.get("message", "unknown"), "wrapped_text"),
+                    commit_data.get("unique_finds", 0),
+                    commit_data.get("total_instances", 0),
+                    commit_data.get("committer", "unknown"),
+                    commit_data.get("author", "unknown"),
+                    sha,
+                    self.fuzzy_matches(commit_data)
+                ]
+
+        self.write_streaming_rows(sheet, rows(), self.max_column_width_px)
+
+    def write_watchlists_streaming(self, sheets, watchlist_results=None):
+        # watchlist_results holds the results of the pass, otherwise they are read from the watchlist files
+        for name, watchlist_file in self.watchlist_files.items():
+            self.write_keyword_search_results_streaming(sheets[self.watchlist_sheet(name)],
+                                                        (watchlist_results or {}).get(name), watchlist_file)
+
+    def write_activity_streaming(self, sheets, activity=None):
+        if activity is None:
+            activity = self.load_activity()
+        for name, rows in self.activity_rows(activity).items():
+            self.write_streaming_rows(sheets[name], rows, self.max_column_width_px)
+
+    def write_patch_search_streaming(self, sheet, results=None):
+        if results is None:
+            results = self.load_patch_search()
+        self.write_streaming_rows(sheet, self.patch_search_rows(results), self.max_column_width_px)
@@ -0,0 +1,105 @@
+import base64
+import hashlib
+import math
+
+
+class DistinctCounter:
+    # Counts distinct values. It keeps the exact set until it holds more than exact_limit values, then switches to a
+    # HyperLogLog sketch of 2 ** precision one byte registers. The sketch has a relative standard error of
+    # 1.04 / sqrt(2 ** precision), about 0.81% for the default precision of 14 (16 KiB), so an estimate falls
+    # within 2.4% of the true count in 99.7% of cases. exact_limit=None never switches. Counters of the same
+    # settings merge with |=, and to_state/from_state round trip them through JSON
+    def __init__(self, exact_limit=None, precision=14):
+        if not 4 <= precision <= 18:
+            raise ValueError(f"HyperLogLog precision must be between 4 and 18, got {precision}")
+        self.exact_limit = exact_limit
+        self.precision = precision
+        self.values = set()
+        self.registers = None
+
+    @property
+    def is_exact(self):
+        return self.registers is None
+
+    @staticmethod
+    def hash_value(value):
+        # Stable across processes and runs, unlike hash()
+        return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+
+    def add_hash(self, hashed):
+        index = hashed >> (64 - self.precision)
+        remaining_bits = 64 - self.precision
+        rank = remaining_bits - (hashed & ((1 << remaining_bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def to_sketch(self):
+        self.registers = bytearray(1 << self.precision)
+        for value in self.values:
+            self.add_hash(self.hash_value(value))
+        self.values = None
+
+    def add(self, value):
+        if self.registers is not None:
+            self.add_hash(self.hash_value(value))
+            return
+        self.values.add(value)
+        if self.exact_limit is not None and len(self.values) > self.exact_limit:
+            self.to_sketch()
+
+    def __ior__(self, other):
+        # Merges another counter, or any iterable of values
+        if not isinstance(other, DistinctCounter):
+            if self.registers is not None:
+                for value in other:
+                    self.add_hash(self.hash_value(value))
+                return self
+            self.values.update(other)
+            if self.exact_limit is not None and len(self.values) > self.exact_limit:
+                self.to_sketch()
+            return self
+
+        if other.precision != self.precision:
+            raise ValueError("Only counters with the same HyperLogLog precision can be merged")
+        if other.registers is None:
+            self |= other.values
+            return self
+        if self.registers is None:
+            self.to_sketch()
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def intern(self, strings):
+        # Swaps the values for the copies held by a StringPool, counters kept side by side then share them
+        if self.registers is None:
+            self.values = {strings(value) for value in self.values}
+
+    def estimate(self):
+        if self.registers is None:
+            return len(self.values)
+        registers = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / registers)
+        raw = alpha * registers * registers / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * registers and zeros:
+            # Linear counting is more accurate while many registers are still empty
+            return registers * math.log(registers / zeros)
+        return raw
+
+    def __len__(self):
+        return int(round(self.estimate()))
+
+    def to_state(self):
+        if self.registers is None:
+            return {"values": sorted(self.values)}
+        return {"precision": self.precision, "registers": base64.b64encode(bytes(self.registers)).decode("ascii")}
+
+    @classmethod
+    def from_state(cls, state, exact_limit=None, precision=14):
+        counter = cls(exact_limit, state.get("precision", precision))
+        if "registers" in state:
+            counter.values = None
+            counter.registers = bytearray(base64.b64decode(state["registers"]))
+        else:
+            counter |= state["values"]
+        return counter
@@ -0,0 +1,90 @@
+from collections import defaultdict
+from generators_commit_analysis.keyword_index import TOKEN_PATTERN, trigrams
+
+
+def bounded_distance(a, b, limit):
+    # Optimal string alignment distance (an adjacent transposition is one edit, "crytpo" is one away from "crypto"),
+    # or limit + 1 as soon as every alignment needs more than limit edits
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                value = min(value, before[j - 2] + 1)
+            current[j] = value
+        # No later cell of the table gets below the lowest one of this row
+        if min(current) > limit:
+            return limit + 1
+        before, previous = previous, current
+    return min(previous[-1], limit + 1)
+
+
+class FuzzyMatcher:
+    # Typo tolerant matching of message words against keywords, case insensitive. A trigram index over the keywords
+    # narrows each word down to the keywords it shares enough trigrams with, which are then checked with a bounded
+    # edit distance. Each distinct word is looked up once and cached, messages repeat a small vocabulary
+    def __init__(self, patterns, max_distance=1, cache_size=1 << 18):
+        self.keywords = {}  # pattern -> (lowercased pattern, edits allowed, its trigrams)
+        self.grams = defaultdict(list)  # trigram -> patterns having it
+        for pattern in dict.fromkeys(patterns):
+            folded = pattern.lower()
+            limit = self.allowed_distance(folded, max_distance)
+            if limit:
+                self.keywords[pattern] = (folded, limit, trigrams(folded))
+                for gram in self.keywords[pattern][2]:
+                    self.grams[gram].append(pattern)
+        self.cache_size = cache_size
+        self.cache = {}
+
+    @staticmethod
+    def allowed_distance(folded, max_distance):
+        # An edit changes at most 4 of the padded trigrams (a transposition spans two characters), so a word within
+        # limit edits shares at least len(trigrams) - 4 * limit of them. Limits keep that positive: keywords under 5
+        # characters get no edits and 9 characters are needed for 2, short words would otherwise match too much
+        if not TOKEN_PATTERN.fullmatch(folded):
+            return 0
+        return max(0, min(max_distance, (len(trigrams(folded)) - 1) // 4))
+
+    @staticmethod
+    def required_trigrams(keyword):
+        folded, limit, grams = keyword
+        return len(grams) - 4 * limit
+
+    def match(self, token):
+        # [(pattern, distance)] of the keywords the lowercased token is a typo of, exact matches are left out
+        found = self.cache.get(token)
+        if found is not None:
+            return found
+        shared = defaultdict(int)
+        for gram in trigrams(token):
+            for pattern in self.grams.get(gram, ()):
+                shared[pattern] += 1
+        found = []
+        for pattern, count in shared.items():
+            keyword = self.keywords[pattern]
+            if count < self.required_trigrams(keyword):
+                continue
+            distance = bounded_distance(token, keyword[0], keyword[1])
+            if 0 < distance <= keyword[1]:
+                found.append((pattern, distance))
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[token] = found
+        return found
+
+    def scan(self, message, whole_word=False):
+        # Returns {pattern: {variant: [distance, count]}}. Outside whole word mode a word containing the keyword is
+        # already counted by the exact search and is not reported again
+        found = {}
+        if not self.keywords:
+            return found
+        for token in TOKEN_PATTERN.findall(message.lower()):
+            for pattern, distance in self.match(token):
+                if not whole_word and self.keywords[pattern][0] in token:
+                    continue
+                variant = found.setdefault(pattern, {}).setdefault(token, [distance, 0])
+                variant[1] += 1
+        return found
@@ -0,0 +1,215 @@
+import base64
+import os
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from generators_commit_analysis.commit_record import CommitRecord
+from generators_commit_analysis.commit_retriever import CommitRetriever
+from generators_commit_analysis.commit_store import CommitStore
+from generators_commit_analysis.metrics import metrics
+
+# One commit per NUL terminated record, fields separated by the unit separator. The message comes last so a stray
+# separator inside it cannot shift the other fields
+LOG_FIELDS = ("%H", "%an", "%ae", "%ad", "%cn", "%ce", "%cd", "%B")
+LOG_FORMAT = "%x1f".join(LOG_FIELDS)
+# Dates in UTC with a Z suffix, the format the REST API returns and the analysis stages expect (git runs with TZ=UTC)
+LOG_DATE = "--date=format-local:%Y-%m-%dT%H:%M:%SZ"
+GIT_ENV = dict(os.environ, TZ="UTC", GIT_TERMINAL_PROMPT="0")
+
+
+class GitError(Exception):
+    pass
+
+
+class GitMirrorRetriever:
+    # Alternative to CommitRetriever for large organisations: every repository is kept as a bare mirror of its branches,
+    # updated with one fetch, and its commits are read with git log instead of paging through the REST API. The commit
+    # store and the state file are the same as CommitRetriever's, so the analysis stages and incremental runs work
+    # with either
+    def __init__(self, org_name, mirror_dir, clone_url="https://github.com/{org}/{repo}.git", token=None, repos=(),
+                 repo_lister=None, workers=1):
+        self.org_name = org_name
+        self.mirror_dir = mirror_dir
+        self.clone_url = clone_url  # {org} and {repo} are filled in, a local path works for testing
+        self.token = token
+        self.repos = tuple(repos)  # Repositories to mirror, listed through repo_lister (the REST API) when empty
+        self.repo_lister = repo_lister
+        self.workers = max(1, workers)
+
+    # --- git ---
+    def git(self, *args, mirror=None, check=True):
+        command = ["git"]
+        env = GIT_ENV
+        if self.token and self.clone_url.startswith("https://"):
+            # The token goes in a header of this command only, never into the URL saved in the mirror config. It is
+            # passed through the environment (git 2.31+), the command line can be read by any local user
+            credentials = base64.b64encode(f"x-access-token:{self.token}".encode()).decode()
+            env = dict(GIT_ENV, GIT_CONFIG_COUNT="1", GIT_CONFIG_KEY_0="http.extraHeader",
+                       GIT_CONFIG_VALUE_0=f"Authorization: Basic {credentials}")
+        if mirror is not None:
+            command += ["-C", mirror]
+        result = subprocess.run(command + list(args), capture_output=True, text=True, env=env)
+        if check and result.returncode != 0:
+            raise GitError(f"git {' '.join(args)} failed: {result.stderr.strip()}")
+        return result
+
+    def mirror_path(self, repo_name):
+        return os.path.join(self.mirror_dir, f"{repo_name}.git")
+
+    def update_mirror(self, repo_name):
+        # Clones the repository the first time, afterwards a fetch brings in new commits and drops deleted branches.
+        # Rather than clone --mirror, which on GitHub also pulls every pull request ref, the mirror is a bare clone of
+        # the branches without trees or blobs (filter=tree:0): the log walk only reads commit objects
+        mirror = self.mirror_path(repo_name)
+        with metrics.timer("git_fetch"):
+            if os.path.exists(mirror):
+                self.git("fetch", "--prune", "--quiet", mirror=mirror)
+            else:
+                os.makedirs(self.mirror_dir, exist_ok=True)
+                url = self.clone_url.format(org=self.org_name, repo=repo_name)
+                tmp_path = mirror + ".tmp"
+                shutil.rmtree(tmp_path, ignore_errors=True)  # Left behind by an interrupted clone
+                self.git("clone", "--bare", "--quiet", "--filter=tree:0", url, tmp_path)
+                self.git("config", "remote.origin.fetch", "+refs/heads/*:refs/heads/*", mirror=tmp_path)
+                os.replace(tmp_path, mirror)
+        return mirror
+
+    def head(self, mirror):
+        # SHA of the default branch, None for a repository without commits
+        result = self.git("rev-parse", "--verify", "--quiet", "HEAD^{commit}", mirror=mirror, check=False)
+        return result.stdout.strip() if result.returncode == 0 else None
+
+    def is_ancestor(self, mirror, sha, head):
+        return self.git("merge-base", "--is-ancestor", sha, head, mirror=mirror, check=False).returncode == 0
+
+    def iter_log(self, mirror, revision):
+        # Streams git log newest first, as the REST API lists commits, without holding the output in memory
+        command = ["git", "-C", mirror, "log", "--no-mailmap", "-z", f"--format={LOG_FORMAT}", LOG_DATE, revision]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=GIT_ENV)
+        pending = b""
+        finished = False
+        try:
+            for block in iter(lambda: process.stdout.read(1 << 20), b""):
+                records = (pending + block).split(b"\0")
+                pending = records.pop()
+                for record in records:
+                    yield self.parse_record(record)
+            if pending:
+                yield self.parse_record(pending)
+            finished = True
+        finally:
+            process.stdout.close()
+            stderr = process.stderr.read().decode("utf-8", "replace")
+            process.stderr.close()
+            # git exits with an error when the reader stops early and closes the pipe, that is not a failure
+            if process.wait() != 0 and finished:
+                raise GitError(f"git log {revision} failed with exit code {process.returncode}: {stderr.strip()}")
+
+    @staticmethod
+    def parse_record(record):
+        # Messages that are not valid UTF-8 are kept with replacement characters rather than failing the repository
+        sha, author_name, author_email, author_date, committer_name, committer_email, committer_date, message = \
+            record.decode("utf-8", "replace").split("\x1f", 7)
+        # git keeps the final newline of the message, the REST API does not
+        return CommitRecord(sha=sha, message=message.rstrip("\n"), author_name=author_name,
+                            author_email=author_email, author_date=author_date, committer_name=committer_name,
+                            committer_email=committer_email, committer_date=committer_date)
+
+    # --- Store ---
+    def write_repo(self, repo_name, mirror, head, store):
+        # Every commit of the default branch goes straight from git log into a new shard
+        print(f"Reading commits of repository: {repo_name}")
+        with store.open_repo(repo_name) as writer:
+            if head is not None:
+                with metrics.timer("git_log"):
+                    writer.write(self.iter_log(mirror, head))
+        metrics.count("commits_extracted", writer.count)
+        return self.repo_state(mirror, head)
+
+    def repo_state(self, mirror, head):
+        # Same shape as CommitRetriever's state, so either backend can pick up after the other
+        if head is None:
+            return CommitRetriever.get_repo_state(None)
+        date = self.git("log", "-1", "--format=%cd", LOG_DATE, head, mirror=mirror).stdout.strip()
+        return {"sha": head, "date": date, "etag": None}
+
+    def update_repo(self, repo_name, repo_state, store):
+        mirror = self.update_mirror(repo_name)
+        head = self.head(mirror)
+        if not repo_state or not os.path.exists(store.shard_path(repo_name)):
+            return self.write_repo(repo_name, mirror, head, store)
+        known = repo_state.get("sha")
+        if head == known:
+            print(f"No new commits for repository: {repo_name}")
+            return repo_state
+        if known is None:
+            return self.write_repo(repo_name, mirror, head, store)
+
+        # A head we already hold is an ancestor of the new one, unless the history was rewritten (force push)
+        if head is None or not self.is_ancestor(mirror, known, head):
+            print(f"History of repository {repo_name} was rewritten, reading it again")
+            return self.write_repo(repo_name, mirror, head, store)
+
+        print(f"Reading new commits of repository: {repo_name}")
+        with metrics.timer("git_log"):
+            new_commits = list(self.iter_log(mirror, f"{known}..{head}"))
+        store.append_commits(repo_name, new_commits)
+        metrics.count("commits_extracted", len(new_commits))
+        return self.repo_state(mirror, head)
+
+    def list_repos(self):
+        if self.repos:
+            return list(self.repos)
+        if self.repo_lister is None:
+            raise ValueError("No repositories given and no way to list them, set repos or repo_lister")
+        return self.repo_lister()
+
+    def retrieve_commits(self, store_dir="organization_commits/", file_path="", incremental=False,
+                         state_file="retrieve_state.json"):
+        state_path = file_path + state_file
+        store = CommitStore(file_path + store_dir)
+
+        # Incremental runs start from the previous state, any run resumes the repos an interrupted run finished
+        state = CommitRetriever.load_json(state_path, {})
+        completed = store.start_run()
+        state_lock = threading.Lock()
+        failed = []
+
+        def process_repo(repo_name):
+            if repo_name in completed:
+                print(f"Already retrieved in the interrupted run: {repo_name}")
+                return
+
+            try:
+                repo_state = self.update_repo(repo_name, state.get(repo_name) if incremental else None, store)
+            except GitError as e:
+                # Left out of this run's state and not marked completed, the next run fetches it again
+                print(f"Giving up on repository {repo_name} for this run: {e}")
+                failed.append(repo_name)
+                metrics.count("repositories_failed")
+                return
+            with state_lock:
+                state[repo_name] = repo_state
+                CommitRetriever.write_json_atomic(state_path, state, indent=4)
+            store.mark_completed(repo_name)
+            metrics.count("repositories_retrieved")
+
+        repo_names = self.list_repos()
+        print(f"Found {len(repo_names)} repositories.")
+
+        store.set_repos(repo_names)
+        metrics.progress("repositories_retrieved", len(repo_names))
+        if self.workers > 1:
+            # Fetches and log walks run in git processes, threads are enough to keep several going
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(executor.map(process_repo, repo_names))
+        else:
+            for repo_name in repo_names:
+                process_repo(repo_name)
+
+        store.finish_run()
+
+        if failed:
+            print(f"{len(failed)} repositories could not be retrieved and are kept as they were: {', '.join(failed)}")
+        print(f"All {store.total_count()} commits have been saved to {store_dir}")
@@ -0,0 +1,270 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache
+from generators_commit_analysis.commit_record import CommitRecord
+from generators_commit_analysis.commit_retriever import CommitRetriever, RetrievalError
+from generators_commit_analysis.commit_store import CommitStore
+from generators_commit_analysis.metrics import metrics
+import os
+
+# Repository names with the SHA their default branch points at, enough to tell which repositories changed
+REPOS_QUERY = """
+query($org: String!, $first: Int!, $after: String) {
+  rateLimit { cost remaining resetAt }
+  organization(login: $org) {
+    repositories(first: $first, after: $after, orderBy: {field: CREATED_AT, direction: DESC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes { name defaultBranchRef { target { oid } } }
+    }
+  }
+}
+"""
+
+# Only the fields CommitRecord keeps, the REST pages carry several times more (URLs, trees, verification, ...)
+HISTORY_FRAGMENT = """
+fragment HistoryPage on CommitHistoryConnection {
+  pageInfo { hasNextPage endCursor }
+  nodes {
+    oid
+    message
+    author { name email date user { name } }
+    committer { name email date }
+  }
+}
+"""
+
+
+@lru_cache(maxsize=None)
+def history_query(count):
+    # One aliased repository field (r0, r1, ...) per repository of the batch, each with its own cursor and since date
+    variables = ", ".join(f"$n{i}: String!, $a{i}: String, $s{i}: GitTimestamp" for i in range(count))
+    fields = "\n".join(
+        f"  r{i}: repository(owner: $owner, name: $n{i}) {{ defaultBranchRef {{ target {{ ... on Commit {{ "
+        f"history(first: $first, after: $a{i}, since: $s{i}) {{ ...HistoryPage }} }} }} }} }}"
+        for i in range(count)
+    )
+    return (f"query($owner: String!, $first: Int!, {variables}) {{\n  rateLimit {{ cost remaining resetAt }}\n"
+            f"{fields}\n}}\n{HISTORY_FRAGMENT}")
+
+
+def query_cost(connections):
+    # GitHub charges the connections a query asks for divided by 100, at least one point
+    return max(1, round(connections / 100))
+
+
+def graphql_endpoint(base_url):
+    # GitHub Enterprise Server serves the REST API under /api/v3 and GraphQL at /api/graphql, api.github.com (and the
+    # mock server) serve GraphQL at the root of the REST API
+    base_url = base_url.rstrip("/")
+    if base_url.endswith("/api/v3"):
+        return base_url[:-len("/v3")] + "/graphql"
+    return f"{base_url}/graphql"
+
+
+def utc_date(date):
+    # GraphQL dates keep the committer's offset, the store holds them in UTC with a Z suffix like the REST API
+    if not date:
+        return date
+    return datetime.fromisoformat(date.replace("Z", "+00:00")).astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class RepoFetch:
+    # A repository whose history is being paged through, across as many batched queries as it takes
+    def __init__(self, name, head, since=None):
+        self.name = name
+        self.head = head  # SHA of the default branch when the repositories were listed
+        self.since = since  # Date of the newest commit we hold, None reads the whole history into a new shard
+        self.cursor = None
+        self.writer = None
+        self.new_commits = []
+        self.newest = None
+
+
+class GraphQLRetriever(CommitRetriever):
+    # GraphQL backend of CommitRetriever. The repositories are listed a hundred per query with the SHA of their default
+    # branch, so unchanged repositories cost nothing on incremental runs. Histories are then read repos_per_query
+    # repositories per query, one aliased history connection each, and the batches are sent concurrently. The scheduler
+    # charges every query its point cost, and the store and state file are the same as the REST backend's
+    def __init__(self, org_name, token, repos_per_query=10, **kwargs):
+        super().__init__(org_name, token, **kwargs)
+        self.repos_per_query = max(1, repos_per_query)
+        self.graphql_url = graphql_endpoint(self.base_url)
+
+    def query(self, query, variables, cost=1, errors=None):
+        # errors, when given, collects the errors of the payload
+        response = self.scheduler.request(self.session, self.graphql_url,
+                                          json={"query": query, "variables": variables}, cost=cost)
+        if response.status_code != 200:
+            print(f"Error running GraphQL query: {response.status_code}, {response.text}")
+            return None
+        with metrics.timer("json_parse"):
+            payload = response.json()
+        # Errors on one repository (deleted, renamed) come back next to the data of the others
+        for error in payload.get("errors") or ():
+            print(f"GraphQL error: {error.get('message')}")
+            if errors is not None:
+                errors.append(error)
+        data = payload.get("data")
+        if data and data.get("rateLimit"):
+            metrics.count("graphql_points", data["rateLimit"]["cost"])
+        return data
+
+    def get_all_repos(self):
+        # Raises RetrievalError like the REST listing when a page cannot be read
+        repos = []
+        after = None
+        while True:
+            data = self.query(REPOS_QUERY, {"org": self.org_name, "first": self.per_page, "after": after})
+            if not data or not data.get("organization"):
+                raise RetrievalError(f"Could not list the repositories of {self.org_name}")
+            connection = data["organization"]["repositories"]
+            for node in connection["nodes"]:
+                target = (node.get("defaultBranchRef") or {}).get("target") or {}
+                repos.append({"name": node["name"], "head": target.get("oid")})
+            if not connection["pageInfo"]["hasNextPage"]:
+                break
+            after = connection["pageInfo"]["endCursor"]
+        return repos
+
+    # --- History ---
+    def fetch_pages(self, fetches):
+        # Next page of every repository of the batch, None for each when the query failed. A repository whose alias
+        # came back null or named by an error (timeout, deleted since the listing) is None on its own: a failed page
+        # is never mistaken for the end of the history
+        variables = {"owner": self.org_name, "first": self.per_page}
+        for i, fetch in enumerate(fetches):
+            variables.update({f"n{i}": fetch.name, f"a{i}": fetch.cursor, f"s{i}": fetch.since})
+        errors = []
+        data = self.query(history_query(len(fetches)), variables, cost=query_cost(len(fetches)), errors=errors)
+        if data is None:
+            return None
+        failed = {error["path"][0] for error in errors if error.get("path")}
+        return [None if alias in failed or data.get(alias) is None else self.history(data[alias])
+                for alias in (f"r{i}" for i in range(len(fetches)))]
+
+    @staticmethod
+    def history(repository):
+        # Empty when the repository has no default branch
+        target = (repository.get("defaultBranchRef") or {}).get("target") or {}
+        return target.get("history") or {"nodes": [], "pageInfo": {"hasNextPage": False}}
+
+    @staticmethod
+    def to_record(node):
+        author = node.get("author") or {}
+        committer = node.get("committer") or {}
+        return CommitRecord(
+            sha=node.get("oid"),
+            message=node.get("message"),
+            author_name=author.get("name"),
+            author_email=author.get("email"),
+            author_date=utc_date(author.get("date")),
+            committer_name=committer.get("name"),
+            committer_email=committer.get("email"),
+            committer_date=utc_date(committer.get("date")),
+            account_name=(author.get("user") or {}).get("name"),
+        )
+
+    def start_fetch(self, fetch, store):
+        if fetch.since is None:
+            print(f"Fetching commits for repository: {fetch.name}")
+            fetch.writer = store.open_repo(fetch.name)
+        else:
+            print(f"Fetching new commits for repository: {fetch.name} since {fetch.since}")
+        return fetch
+
+    def add_page(self, fetch, history):
+        # Returns whether the repository has more pages
+        records = [self.to_record(node) for node in history["nodes"]]
+        metrics.count("commits_downloaded", len(records))
+        fetch.newest = fetch.newest or (records[0] if records else None)
+        if fetch.writer is not None:
+            with metrics.timer("store_write"):
+                fetch.writer.write(records)
+        else:
+            fetch.new_commits.extend(records)
+        fetch.cursor = history["pageInfo"].get("endCursor")
+        return history["pageInfo"]["hasNextPage"]
+
+    @staticmethod
+    def drop_fetch(fetch):
+        if fetch.writer is not None:
+            fetch.writer.abort()
+
+    def finish_fetch(self, fetch, store, repo_state):
+        if fetch.writer is not None:
+            fetch.writer.commit()
+        else:
+            # since is inclusive, so commits we already hold are filtered out by SHA before appending
+            known_shas = {commit.sha for commit in store.iter_commits(fetch.name)}
+            store.append_commits(fetch.name, [commit for commit in fetch.new_commits if commit.sha not in known_shas])
+        if fetch.newest is None:
+            return {"sha": fetch.head, "date": (repo_state or {}).get("date"), "etag": None}
+        return {"sha": fetch.newest.sha, "date": fetch.newest.committer_date, "etag": None}
+
+    def retrieve_commits(self, store_dir="organization_commits/", file_path="", incremental=False,
+                         state_file="retrieve_state.json"):
+        state_path = file_path + state_file
+        store = CommitStore(file_path + store_dir)
+
+        # Incremental runs start from the previous state, any run resumes the repos an interrupted run finished
+        state = self.load_json(state_path, {})
+        completed = store.start_run()
+
+        repos = self.get_all_repos()
+        print(f"Found {len(repos)} repositories.")
+
+        repo_names = [repo["name"] for repo in repos]
+        store.set_repos(repo_names)
+        metrics.progress("repositories_retrieved", len(repo_names))
+
+        def save_state(repo_name, repo_state):
+            state[repo_name] = repo_state
+            self.write_json_atomic(state_path, state, indent=4)
+            store.mark_completed(repo_name)
+            metrics.count("repositories_retrieved")
+
+        waiting = deque()
+        for repo in repos:
+            repo_name = repo["name"]
+            if repo_name in completed:
+                print(f"Already retrieved in the interrupted run: {repo_name}")
+                continue
+            repo_state = state.get(repo_name) if incremental else None
+            has_shard = os.path.exists(store.shard_path(repo_name))
+            if repo_state and has_shard and repo_state.get("sha") == repo["head"]:
+                print(f"No new commits for repository: {repo_name}")
+                save_state(repo_name, repo_state)
+                continue
+            since = repo_state["date"] if repo_state and repo_state.get("sha") and has_shard else None
+            waiting.append(RepoFetch(repo_name, repo["head"], since))
+
+        # Each round sends one query per batch of active repositories and moves every one of them a page further.
+        # Active repositories are capped so the number of open shard writers stays bounded on large organisations
+        max_active = self.workers * self.repos_per_query
+        active = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                while waiting or active:
+                    while waiting and len(active) < max_active:
+                        active.append(self.start_fetch(waiting.popleft(), store))
+                    batches = [active[i:i + self.repos_per_query] for i in range(0, len(active), self.repos_per_query)]
+                    for batch, pages in zip(batches, executor.map(self.fetch_pages, batches)):
+                        for fetch, history in zip(batch, pages or [None] * len(batch)):
+                            if history is None:
+                                # Left out of this run's state, the next run fetches it again
+                                print(f"Giving up on repository {fetch.name} for this run")
+                                metrics.count("repositories_failed")
+                                self.drop_fetch(fetch)
+                                active.remove(fetch)
+                            elif not self.add_page(fetch, history):
+                                save_state(fetch.name, self.finish_fetch(fetch, store, state.get(fetch.name)))
+                                active.remove(fetch)
+            finally:
+                for fetch in active:
+                    self.drop_fetch(fetch)
+
+        store.finish_run()
+
+        print(f"All {store.total_count()} commits have been saved to {store_dir}")
+        self.scheduler.print_report()
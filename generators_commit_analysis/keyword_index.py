@@ -0,0 +1,202 @@
+from generators_commit_analysis.commit_record import CommitRecord
+from collections import defaultdict
+import sqlite3
+import re
+
+TOKEN_PATTERN = re.compile(r"\w+")
+SIGMAS = set("Σσς")  # Lowercasing sigma depends on context, such keywords are left to the scan
+
+
+def trigrams(token):
+    # Distinct trigrams of the token padded at both ends, so the first and last characters count as much as the others
+    padded = f"^{token}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class KeywordIndex:
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.connection = sqlite3.connect(index_file)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS docs (
+                doc_id INTEGER PRIMARY KEY,
+                repo TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                sha TEXT,
+                message TEXT,
+                committer_date TEXT,
+                committer_name TEXT,
+                account_name TEXT
+            );
+            CREATE INDEX IF NOT EXISTS docs_repo ON docs (repo, position);
+            CREATE TABLE IF NOT EXISTS vocab (
+                token_id INTEGER PRIMARY KEY,
+                token TEXT NOT NULL UNIQUE
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                token_id INTEGER NOT NULL,
+                doc_id INTEGER NOT NULL,
+                positions TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS postings_token ON postings (token_id);
+            CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc_id);
+            CREATE TABLE IF NOT EXISTS trigrams (
+                trigram TEXT NOT NULL,
+                token_id INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS trigrams_trigram ON trigrams (trigram);
+            CREATE TABLE IF NOT EXISTS indexed_repos (
+                repo TEXT PRIMARY KEY,
+                generation INTEGER NOT NULL,
+                count INTEGER NOT NULL
+            );
+        """)
+
+    def close(self):
+        self.connection.close()
+
+    # --- Building ---
+    def update(self, store, batch_size=5000):
+        # Shards only grow between generations, so new commits are indexed from where the last update stopped;
+        # a rewritten shard (new generation) or a removed repository is dropped and indexed again
+        indexed = {repo: (generation, count) for repo, generation, count
+                   in self.connection.execute("SELECT repo, generation, count FROM indexed_repos")}
+        vocab = dict(self.connection.execute("SELECT token, token_id FROM vocab"))
+        added = 0
+
+        # Indexes built before the trigrams were kept get them for the tokens they lack, once
+        self.add_trigrams(self.connection.execute(
+            "SELECT token, token_id FROM vocab WHERE token_id > (SELECT COALESCE(MAX(token_id), 0) FROM trigrams)"
+        ).fetchall())
+
+        for repo in set(indexed) - set(store.repo_names()):
+            self.drop_repo(repo)
+
+        for repo in store.repo_names():
+            generation, count = indexed.get(repo, (None, 0))
+            if generation != store.generation(repo):
+                self.drop_repo(repo)
+                count = 0
+            elif count >= store.count(repo):
+                continue
+
+            batch = []
+            indexed_count = count
+            for position, commit in enumerate(store.iter_commits(repo, start=count), start=count):
+                batch.append((position, commit))
+                indexed_count = position + 1
+                if len(batch) >= batch_size:
+                    self.add_commits(repo, batch, vocab)
+                    batch = []
+            self.add_commits(repo, batch, vocab)
+
+            added += indexed_count - count
+            self.connection.execute("INSERT OR REPLACE INTO indexed_repos VALUES (?, ?, ?)",
+                                    (repo, store.generation(repo), indexed_count))
+            self.connection.commit()
+
+        self.connection.commit()
+        return added
+
+    def drop_repo(self, repo):
+        self.connection.execute("DELETE FROM postings WHERE doc_id IN (SELECT doc_id FROM docs WHERE repo = ?)",
+                                (repo,))
+        self.connection.execute("DELETE FROM docs WHERE repo = ?", (repo,))
+        self.connection.execute("DELETE FROM indexed_repos WHERE repo = ?", (repo,))
+
+    def add_commits(self, repo, batch, vocab):
+        if not batch:
+            return
+        next_doc_id = self.connection.execute("SELECT COALESCE(MAX(doc_id), 0) + 1 FROM docs").fetchone()[0]
+        docs = []
+        postings = []
+        new_tokens = []
+        for doc_id, (position, commit) in enumerate(batch, start=next_doc_id):
+            docs.append((doc_id, repo, position, commit.sha, commit.message, commit.committer_date,
+                         commit.committer_name, commit.account_name))
+
+            token_positions = defaultdict(list)
+            for token_position, token in enumerate(TOKEN_PATTERN.findall((commit.message or "").lower())):
+                token_positions[token].append(token_position)
+
+            for token, positions in token_positions.items():
+                if token not in vocab:
+                    vocab[token] = self.connection.execute(
+                        "INSERT INTO vocab (token) VALUES (?)", (token,)).lastrowid
+                    new_tokens.append((token, vocab[token]))
+                postings.append((vocab[token], doc_id, ",".join(map(str, positions))))
+
+        self.connection.executemany("INSERT INTO docs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", docs)
+        self.connection.executemany("INSERT INTO postings VALUES (?, ?, ?)", postings)
+        self.add_trigrams(new_tokens)
+
+    def add_trigrams(self, tokens):
+        self.connection.executemany("INSERT INTO trigrams VALUES (?, ?)",
+                                    ((gram, token_id) for token, token_id in tokens for gram in trigrams(token)))
+
+    # --- Querying ---
+    @staticmethod
+    def can_serve(keyword):
+        # A keyword made only of word characters always falls inside a single lowercased token
+        return bool(keyword) and TOKEN_PATTERN.fullmatch(keyword.lower()) is not None and not SIGMAS & set(keyword)
+
+    def token_ids(self, keyword, whole_word):
+        token = keyword.lower()
+        if whole_word:
+            rows = self.connection.execute("SELECT token_id FROM vocab WHERE token = ?", (token,))
+        else:
+            # Substring modes only need a pass over the vocabulary, not over the messages
+            rows = self.connection.execute("SELECT token_id FROM vocab WHERE instr(token, ?) > 0", (token,))
+        return [row[0] for row in rows]
+
+    def fuzzy_token_ids(self, fuzzy):
+        # Tokens a keyword of the FuzzyMatcher may be a typo of: those sharing enough trigrams with it, checked by
+        # the matcher's edit distance. Only the vocabulary is looked at, never the messages
+        token_ids = set()
+        for pattern, keyword in fuzzy.keywords.items():
+            grams = sorted(keyword[2])
+            rows = self.connection.execute(
+                "SELECT vocab.token_id, vocab.token FROM vocab JOIN ("
+                f"SELECT token_id FROM trigrams WHERE trigram IN ({','.join('?' * len(grams))}) "
+                "GROUP BY token_id HAVING COUNT(*) >= ?) AS shared ON shared.token_id = vocab.token_id",
+                grams + [fuzzy.required_trigrams(keyword)])
+            token_ids.update(token_id for token_id, token in rows
+                             if any(found == pattern for found, _ in fuzzy.match(token)))
+        return token_ids
+
+    def candidate_commits(self, keywords, whole_word, exclude_repos=(), repo_order=None, fuzzy=None):
+        # Every commit that could match one of the keywords, or None when a keyword needs a full scan.
+        # Candidates are a superset; the searcher still checks each message with its own matcher.
+        # fuzzy (FuzzyMatcher) adds the commits holding a typo of a keyword
+        if not all(self.can_serve(keyword) for keyword in keywords):
+            return None
+
+        token_ids = {token_id for keyword in keywords for token_id in self.token_ids(keyword, whole_word)}
+        if fuzzy is not None:
+            token_ids |= self.fuzzy_token_ids(fuzzy)
+        token_ids = sorted(token_ids)
+        doc_ids = set()
+        for start in range(0, len(token_ids), 500):
+            chunk = token_ids[start:start + 500]
+            doc_ids.update(row[0] for row in self.connection.execute(
+                f"SELECT doc_id FROM postings WHERE token_id IN ({','.join('?' * len(chunk))})", chunk))
+
+        doc_ids = sorted(doc_ids)
+        rows = []
+        for start in range(0, len(doc_ids), 500):
+            chunk = doc_ids[start:start + 500]
+            rows.extend(self.connection.execute(
+                "SELECT repo, position, sha, message, committer_date, committer_name, account_name FROM docs "
+                f"WHERE doc_id IN ({','.join('?' * len(chunk))})", chunk))
+
+        # Return them in commit store order so results line up with a scan
+        repo_order = {repo: index for index, repo in enumerate(repo_order or ())}
+        rows.sort(key=lambda row: (repo_order.get(row[0], len(repo_order)), row[0], row[1]))
+
+        candidates = []
+        for repo, _, sha, message, committer_date, committer_name, account_name in rows:
+            if repo in exclude_repos:
+                continue
+            candidates.append((repo, CommitRecord(sha=sha, message=message, committer_date=committer_date,
+                                                  committer_name=committer_name, account_name=account_name)))
+        return candidates
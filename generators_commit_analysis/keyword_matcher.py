@@ -0,0 +1,82 @@
+import re
+
+
+class KeywordMatcher:
+    def __init__(self, patterns):
+        self.patterns = list(dict.fromkeys(patterns))
+        non_empty = [pattern for pattern in self.patterns if pattern]
+        self.has_empty = len(non_empty) < len(self.patterns)
+
+        # Every pattern starting at a position is a prefix of the longest one starting there
+        pattern_set = set(non_empty)
+        self.prefixes = {
+            pattern: [pattern[:i] for i in range(1, len(pattern) + 1) if pattern[:i] in pattern_set]
+            for pattern in non_empty
+        }
+
+        # One trie shaped alternation finds the longest pattern at the next start position, so a message is
+        # scanned once by the regex engine whatever the number of keywords
+        self.regex = re.compile(self.build_trie_regex(non_empty)) if non_empty else None
+
+    @staticmethod
+    def build_trie_regex(patterns):
+        trie = {}
+        for pattern in patterns:
+            node = trie
+            for char in pattern:
+                node = node.setdefault(char, {})
+            node[None] = True
+
+        def to_regex(node):
+            branches = [re.escape(char) + to_regex(child) for char, child in sorted(
+                (item for item in node.items() if item[0] is not None), key=lambda item: item[0])]
+            terminal = None in node
+            if not branches:
+                return ""
+            if len(branches) == 1 and not terminal:
+                return branches[0]
+            group = "(?:" + "|".join(branches) + ")"
+            # Greedy optional group, longer patterns win over the shorter ones ending here
+            return group + "?" if terminal else group
+
+        return to_regex(trie)
+
+    @staticmethod
+    def is_word_char(message, index):
+        # Same definition of a word character as \b in the re module
+        if index < 0 or index >= len(message):
+            return False
+        char = message[index]
+        return char.isalnum() or char == "_"
+
+    def is_boundary(self, message, index):
+        return self.is_word_char(message, index - 1) != self.is_word_char(message, index)
+
+    def scan(self, message, whole_word=False):
+        # Returns {pattern: count}. Counts follow str.count (non-overlapping), whole word mode reports 1 per pattern
+        # found between \b boundaries like re.search(rf"\b{pattern}\b") would
+        found = {}
+        if self.regex:
+            last_end = {}
+            search = self.regex.search
+            match = search(message)
+            while match:
+                start = match.start()
+                for pattern in self.prefixes[match.group()]:
+                    end = start + len(pattern)
+                    if whole_word:
+                        if pattern not in found and self.is_boundary(message, start) \
+                                and self.is_boundary(message, end):
+                            found[pattern] = 1
+                    elif start >= last_end.get(pattern, 0):
+                        found[pattern] = found.get(pattern, 0) + 1
+                        last_end[pattern] = end
+                # Restart right after the match start, keywords may overlap
+                match = search(message, start + 1)
+
+        if self.has_empty:
+            if not whole_word:
+                found[""] = len(message) + 1
+            elif re.search(r"\b", message):
+                found[""] = 1
+        return found
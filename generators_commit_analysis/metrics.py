@@ -0,0 +1,219 @@
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, peak RSS is then left out
+    resource = None
+
+
+def peak_rss_mb(who=None):
+    # High water mark of the resident set size, of this process or (RUSAGE_CHILDREN) of its largest worker
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF if who is None else who).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (2 ** 20 if sys.platform == "darwin" else 2 ** 10), 1)
+
+
+def total_commits(commits_data):
+    # Commit count of a store or of a {repo: commits} dict, used as the progress total
+    if hasattr(commits_data, "total_count"):
+        return commits_data.total_count()
+    return sum(len(commits) for commits in commits_data.values())
+
+
+class Metrics:
+    # Timers and counters of a run, grouped by stage. Hot paths report in bulk (per request, page, repository or
+    # chunk of commits) so the bookkeeping stays out of the per commit loops. Counters and timers recorded in worker
+    # processes are sent back with each result by run_parallel and merged here, timers therefore add up the time of
+    # every thread and worker and can exceed the wall time of their stage
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.progress_interval = 5.0
+        self.profile_stages = ()
+        self.trace_memory_stages = ()
+        self.profile_path = ""
+        self.reset()
+
+    def configure(self, progress_interval=5.0, profile_stages=(), trace_memory_stages=(), profile_path=""):
+        self.progress_interval = progress_interval
+        self.profile_stages = profile_stages
+        self.trace_memory_stages = trace_memory_stages
+        self.profile_path = profile_path
+
+    def reset(self):
+        self.started = time.time()
+        self.stages = []
+        self.stage_name = None
+        self.counters = {}
+        self.timers = {}
+        self.watch = None  # (counter, total, stage start, next print time)
+
+    def local(self):
+        # A forked worker inherits the counts of its parent, it starts over so only its own work is sent back
+        if os.getpid() != self.pid:
+            self.pid = os.getpid()
+            self.counters, self.timers, self.watch = {}, {}, None
+
+    # --- Recording ---
+    def count(self, name, value=1):
+        with self.lock:
+            self.local()
+            self.counters[name] = self.counters.get(name, 0) + value
+            if self.watch is not None and self.watch[0] == name:
+                self.print_progress()
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.local()
+            self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def take(self):
+        # Counters and timers recorded since the last call, for a worker to send back to the parent
+        with self.lock:
+            self.local()
+            recorded = self.counters, self.timers
+            self.counters, self.timers = {}, {}
+            return recorded
+
+    def merge(self, recorded):
+        counters, timers = recorded
+        for name, seconds in timers.items():
+            self.add_time(name, seconds)
+        for name, value in counters.items():
+            self.count(name, value)
+
+    # --- Progress ---
+    def progress(self, counter, total=None):
+        # Prints a progress line for the current stage every progress_interval seconds while counter grows
+        if not self.progress_interval or self.stage_name is None:
+            return
+        with self.lock:
+            now = time.perf_counter()
+            self.watch = (counter, total, now, now + self.progress_interval)
+
+    def print_progress(self):
+        counter, total, start, next_print = self.watch
+        now = time.perf_counter()
+        if now < next_print:
+            return
+        self.watch = (counter, total, start, now + self.progress_interval)
+        value = self.counters.get(counter, 0)
+        percent = f" of {total:,} ({100 * value / total:.0f}%)" if total else ""
+        print(f"  {self.stage_name}: {value:,}{percent} {counter.replace('_', ' ')}, "
+              f"{value / max(now - start, 1e-9):,.0f}/s")
+
+    # --- Stages ---
+    @contextmanager
+    def stage(self, name):
+        # Everything counted while the stage runs is reported under it, optionally under cProfile or tracemalloc
+        self.stage_name = name
+        outer = self.counters, self.timers
+        self.counters, self.timers, self.watch = {}, {}, None
+        entry = {"stage": name, "reused": False}
+
+        profiler = cProfile.Profile() if name in self.profile_stages else None
+        tracing = name in self.trace_memory_stages and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        start, cpu_start = time.perf_counter(), time.process_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            seconds = time.perf_counter() - start
+            entry["seconds"] = round(seconds, 3)
+            entry["cpu_seconds"] = round(time.process_time() - cpu_start, 3)
+            entry["peak_rss_mb"] = peak_rss_mb()
+            if resource is not None:
+                entry["workers_peak_rss_mb"] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+            if tracing:
+                entry["tracemalloc_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+                tracemalloc.stop()
+            if profiler is not None:
+                entry.update(self.profile_report(name, profiler))
+
+            with self.lock:
+                entry["counters"] = self.counters
+                entry["timers"] = {timer: round(value, 3) for timer, value in self.timers.items()}
+                entry["rates"] = {f"{counter}_per_second": round(value / seconds, 1)
+                                  for counter, value in self.counters.items() if seconds > 0}
+                self.counters, self.timers = outer
+                self.stage_name, self.watch = None, None
+            self.stages.append(entry)
+
+    def reuse(self, name):
+        self.stages.append({"stage": name, "reused": True, "seconds": 0.0})
+
+    def profile_report(self, name, profiler, top=20):
+        # The full profile is saved for pstats/snakeviz, the functions with the most cumulative time go in the report
+        profile_file = f"{self.profile_path}profile_{name}.prof"
+        profiler.dump_stats(profile_file)
+        stats = pstats.Stats(profiler).stats
+        functions = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+        return {
+            "profile_file": profile_file,
+            "top_functions": [
+                {
+                    "function": f"{os.path.basename(file)}:{line}({function})",
+                    "calls": calls,
+                    "own_seconds": round(own, 4),
+                    "cumulative_seconds": round(cumulative, 4),
+                }
+                for (file, line, function), (_, calls, own, cumulative, _) in functions
+            ],
+        }
+
+    # --- Output ---
+    def report(self):
+        return {
+            "started": datetime.fromtimestamp(self.started, timezone.utc).isoformat(timespec="seconds"),
+            "seconds": round(time.time() - self.started, 3),
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": self.stages,
+            # Work done outside of any stage, e.g. opening the commit store
+            "counters": self.counters,
+            "timers": {timer: round(value, 3) for timer, value in self.timers.items()},
+        }
+
+    def save(self, metrics_file):
+        tmp_path = metrics_file + ".tmp"
+        with open(tmp_path, "w") as json_file:
+            json.dump(self.report(), json_file, indent=4)
+        os.replace(tmp_path, metrics_file)
+
+    def print_summary(self):
+        ran = [entry for entry in self.stages if not entry["reused"]]
+        if not ran:
+            return
+        print("Stage metrics:")
+        for entry in ran:
+            counters = ", ".join(f"{value:,} {counter.replace('_', ' ')}"
+                                 for counter, value in entry["counters"].items())
+            print(f" - {entry['stage']}: {entry['seconds']:.1f}s wall, {entry['cpu_seconds']:.1f}s CPU, "
+                  f"peak RSS {entry['peak_rss_mb']} MB" + (f" ({counters})" if counters else ""))
+
+
+# Shared by every stage of a run, like settings
+metrics = Metrics()
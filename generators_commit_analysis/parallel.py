@@ -0,0 +1,66 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from generators_commit_analysis.commit_store import CommitStore
+from generators_commit_analysis.metrics import metrics
+
+_stores = {}
+
+
+class WorkUnit:
+    # One repository, or a commit range of a very large one. Store backed units only carry the shard location,
+    # so workers stream the commits themselves instead of receiving them pickled
+    def __init__(self, repo_name, start, stop, store_path=None, commits=None, skip=None, store_class=CommitStore):
+        self.repo_name = repo_name
+        self.start = start
+        self.stop = stop
+        self.store_path = store_path
+        self.commit_list = commits
+        self.skip = skip  # SHAs of the range left to another repository (SharedCommits)
+        self.store_class = store_class  # CommitStore, or a store in the same layout such as PatchStore
+
+    def commits(self):
+        if self.store_path is None:
+            return self.commit_list
+        if self.store_path not in _stores:
+            _stores[self.store_path] = self.store_class(self.store_path)
+        return _stores[self.store_path].iter_commits(self.repo_name, self.start, self.stop, skip=self.skip)
+
+
+def split_work(commits_data, chunk_size, exclude_repos=(), starts=None, references=None):
+    # starts optionally maps a repository to the first commit position to work on, references to the SHAs it skips
+    units = []
+    store_path = commits_data.store_path if isinstance(commits_data, CommitStore) else None
+    for repo_name, commits in commits_data.items():
+        if repo_name in exclude_repos:
+            continue
+        count = len(commits)
+        if store_path is None:
+            commits = list(commits)
+        first = (starts or {}).get(repo_name, 0)
+        skip = (references or {}).get(repo_name)
+        for start in range(first, max(count, first + 1), chunk_size):
+            # The last range stays open ended so a shard never loses its tail to a stale count
+            stop = start + chunk_size if start + chunk_size < count else None
+            if store_path is None:
+                chunk = commits[start:stop]
+                if skip:
+                    chunk = [commit for commit in chunk if commit.sha not in skip]
+                units.append(WorkUnit(repo_name, start, stop, commits=chunk))
+            else:
+                units.append(WorkUnit(repo_name, start, stop, store_path=store_path, skip=skip,
+                                      store_class=type(commits_data)))
+    return units
+
+
+def run_measured(function, unit):
+    # The counters and timers a worker recorded for a unit travel back with its result
+    result = function(unit)
+    return result, metrics.take()
+
+
+def run_parallel(function, units, workers, initializer=None, initargs=()):
+    # Results come back in unit order whatever order the workers finish in, so merges are deterministic
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+        for result, recorded in executor.map(partial(run_measured, function), units):
+            metrics.merge(recorded)
+            yield result
@@ -0,0 +1,32 @@
+from generators_commit_analysis.commit_store import CommitStore
+import json
+
+
+class PatchRecord:
+    # Files changed by one commit, each as [filename, status, additions, deletions, patch]. GitHub leaves the patch
+    # out (None) for binary files and very large diffs
+    __slots__ = ("sha", "files")
+
+    def __init__(self, sha=None, files=()):
+        self.sha = sha
+        self.files = files
+
+    @classmethod
+    def from_api(cls, sha, files):
+        return cls(sha, [[file.get("filename"), file.get("status"), file.get("additions", 0), file.get("deletions", 0),
+                          file.get("patch")] for file in files])
+
+    def __repr__(self):
+        return f"PatchRecord(sha={self.sha!r}, files={len(self.files)})"
+
+
+class PatchStore(CommitStore):
+    # Patch cache next to the commit store, in the same layout: one gzip NDJSON shard per repository and a manifest.
+    # Patches are fetched once per SHA, a commit shared by forks and mirrors is kept in the shard of the repository
+    # it was first fetched for
+    def encode(self, record):
+        return json.dumps([record.sha, record.files], separators=(",", ":")) + "\n"
+
+    @staticmethod
+    def decode(row, keep_raw=False):
+        return PatchRecord(*row)
@@ -0,0 +1,101 @@
+from generators_commit_analysis.simple_analysis import CommitAnalyzer, AnalysisTotals
+from generators_commit_analysis.metrics import metrics
+
+
+class SinglePassPipeline:
+    # Simple analysis, advanced search and the organization_commits sheet in one pass over the commit store.
+    # The sheet writer pulls the commits, each one is counted and searched on the way through, and the other sheets
+    # are then written from the collected results instead of the report files. The reports are still written
+    def __init__(self, commits_data, excel_creator, analyze=True, searcher=None, exact_limit=None, precision=14,
+                 activity=None, shared=None):
+        self.commits_data = commits_data
+        self.excel_creator = excel_creator
+        self.analyze = analyze
+        self.searcher = searcher
+        self.activity = activity  # ActivityAnalyzer fed on the same pass
+        # SharedCommits: a commit held by several repositories is searched once and counted once in the total
+        self.shared = shared
+        self.totals = AnalysisTotals(exact_limit, precision)
+        self.search_results = None  # Sink of the searcher, opened by run
+
+    def iter_commits(self):
+        references = {}
+        if self.searcher is not None:
+            references = self.searcher.references(self.shared)
+        for repo, commits in self.commits_data.items():
+            searching = self.searcher is not None and repo not in self.searcher.exclude_repos
+            skip = references.get(repo, ())
+            scanned = 0
+            if self.activity is not None:
+                self.activity.add_repo(repo)
+            commit_count, committers, authors = 0, self.totals.new_counter(), self.totals.new_counter()
+
+            for commit in commits:
+                if self.analyze:
+                    commit_count += 1
+                    CommitAnalyzer.add_commit(commit, committers, authors)
+                if searching and commit.sha not in skip:
+                    scanned += 1
+                    found = self.searcher.search_commit(repo, commit)
+                    if found is not None:
+                        self.searcher.add_result(self.search_results, *found)
+                if self.activity is not None:
+                    self.activity.add_commit(repo, commit)
+                yield repo, commit
+
+            if self.analyze:
+                self.totals.add(repo, commit_count, committers, authors)
+                metrics.count("commits_analyzed", commit_count)
+            if searching:
+                metrics.count("commits_scanned", scanned)
+
+    def run(self, analysis_file="commit_analysis.txt", keyword_search_file="keyword_search_results.json",
+            file_path="", activity_file="activity_analysis.json", stream_file=None):
+        if self.searcher is not None:
+            self.search_results = self.searcher.open_results(self.shared, stream_file)
+        workbook, template, sheets = self.excel_creator.open_streaming_workbook()
+        self.excel_creator.write_organization_commits_streaming(sheets["organization_commits"], self.iter_commits())
+
+        # Stages that did not run leave their sheet to be filled from the previous report file
+        analysis = None
+        if self.analyze:
+            repo_analysis, total_commits, total_committers, total_authors = self.totals.result()
+            if self.shared is not None:
+                total_commits = self.shared.unique_count
+            CommitAnalyzer.print_and_save_results(
+                repo_analysis=repo_analysis,
+                total_commits=total_commits,
+                total_committers=total_committers,
+                total_authors=total_authors,
+                output_file=analysis_file,
+                file_path=file_path,
+                deduplicated=self.shared is not None
+            )
+            analysis = repo_analysis, CommitAnalyzer.summary_lines(total_commits, total_committers, total_authors,
+                                                                   self.shared is not None)
+        self.excel_creator.write_commit_analysis_streaming(sheets[self.excel_creator.sheet_name], analysis)
+
+        search_results = watchlist_results = None
+        if self.searcher is not None:
+            self.searcher.list_repos(self.search_results, self.shared)
+            search_results = self.searcher.save_results(self.search_results, keyword_search_file, file_path)
+            if self.excel_creator.watchlist_files:
+                # Watchlists are searched on the same pass, keyword_search_file then maps each query to its file and
+                # the query named None holds the search keywords
+                watchlist_results = search_results
+                search_results = watchlist_results[None]
+        self.excel_creator.write_keyword_search_results_streaming(sheets["keyword_search_results"], search_results)
+        self.excel_creator.write_watchlists_streaming(sheets, watchlist_results)
+
+        if self.excel_creator.activity_file:
+            activity = None
+            if self.activity is not None:
+                activity = self.activity.analyze()
+                self.activity.print_and_save_results(activity, activity_file, file_path)
+            self.excel_creator.write_activity_streaming(sheets, activity)
+
+        # Patches are searched over their own store before the pass, their sheet comes from the report file
+        if self.excel_creator.patch_search_file:
+            self.excel_creator.write_patch_search_streaming(sheets[self.excel_creator.patch_search_sheet])
+
+        self.excel_creator.save_streaming_workbook(workbook, template)
@@ -0,0 +1,173 @@
+import threading
+import time
+from generators_commit_analysis.metrics import metrics
+
+
+class TokenState:
+    def __init__(self, token, limit, burst):
+        self.token = token
+        self.limit = limit
+        self.remaining = limit
+        self.reset = time.time() + 3600
+        self.bucket = float(burst)
+        self.refilled_at = time.time()
+        self.blocked_until = 0.0
+        self.sent = 0
+        self.spent = 0  # Budget used, the same as sent unless requests cost more than one point (GraphQL)
+
+
+class RequestScheduler:
+    def __init__(self, tokens, requests_per_hour=5000, burst=100, max_retries=5, secondary_backoff=60):
+        # Duplicate or empty tokens are dropped, an empty pool still works unauthenticated
+        unique_tokens = list(dict.fromkeys(token for token in tokens if token)) or [None]
+        self.states = [TokenState(token, requests_per_hour, burst) for token in unique_tokens]
+        self.burst = burst
+        self.max_retries = max_retries
+        self.secondary_backoff = secondary_backoff
+        self.lock = threading.Lock()
+        self.sleep_seconds = 0.0
+        self.retries = 0
+
+    def refill(self, state, now):
+        if now >= state.reset:
+            # The window rolled over without a response telling us, assume the full budget is back
+            state.remaining = state.limit
+            state.reset = now + 3600
+        # Refill rate spreads whatever is left of the budget over the time remaining until reset
+        rate = max(state.remaining, 0) / max(state.reset - now, 1)
+        state.bucket = min(self.burst, state.bucket + (now - state.refilled_at) * rate)
+        state.refilled_at = now
+        return rate
+
+    def wait_time(self, state, now, cost=1):
+        rate = self.refill(state, now)
+        cost = min(cost, self.burst)  # A request costing more than the burst would otherwise never fit
+        if state.blocked_until > now:
+            return state.blocked_until - now
+        if state.remaining < cost:
+            return max(state.reset - now, 1)
+        if state.bucket >= cost:
+            return 0
+        return (cost - state.bucket) / rate if rate else max(state.reset - now, 1)
+
+    def acquire(self, cost=1):
+        while True:
+            with self.lock:
+                now = time.time()
+                # Rotate to whichever token can send soonest, preferring the one with the most budget left
+                best = min(self.states, key=lambda state: (self.wait_time(state, now, cost), -state.remaining))
+                wait = self.wait_time(best, now, cost)
+                if wait <= 0:
+                    best.bucket -= cost
+                    best.remaining -= cost
+                    best.sent += 1
+                    best.spent += cost
+                    return best
+                self.sleep_seconds += wait
+            metrics.count("rate_limit_sleeps")
+            metrics.add_time("rate_limit_sleep", wait)
+            time.sleep(wait)
+
+    def refund(self, state, cost=1):
+        # GitHub does not charge a 304 (conditional request, nothing changed), its token goes back in the bucket
+        with self.lock:
+            state.bucket = min(self.burst, state.bucket + cost)
+            state.remaining += cost
+            state.spent -= cost
+
+    def update(self, state, response):
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        limit = response.headers.get("X-RateLimit-Limit")
+        reset = response.headers.get("X-RateLimit-Reset")
+        with self.lock:
+            if limit is not None:
+                state.limit = int(limit)
+            if remaining is None:
+                return
+            if reset is not None and int(reset) > state.reset + 1:
+                # A new window started, the header is the fresh budget
+                state.reset = int(reset)
+                state.remaining = int(remaining)
+            elif response.status_code == 304:
+                # Not charged, so the header may be higher than our count: GitHub's count is the one to follow
+                state.remaining = int(remaining)
+                if reset is not None:
+                    state.reset = int(reset)
+            else:
+                # Responses arrive out of order between threads, keep the lowest count seen
+                state.remaining = min(state.remaining, int(remaining))
+                if reset is not None:
+                    state.reset = int(reset)
+
+    def retry_delay(self, state, response, attempt):
+        # GraphQL answers an exhausted point budget with a 200 and a RATE_LIMITED error
+        if response.status_code == 200 and response.headers.get("X-RateLimit-Remaining") == "0" \
+                and "RATE_LIMITED" in response.text:
+            return max(state.reset - time.time(), 1)
+        if response.status_code not in (403, 429):
+            return None
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None:
+            return max(int(retry_after), 1)
+        if response.headers.get("X-RateLimit-Remaining") == "0":
+            return max(state.reset - time.time(), 1)
+        if "secondary rate limit" in response.text.lower():
+            return self.secondary_backoff * 2 ** attempt
+        return None  # Plain permission error, nothing to wait for
+
+    def request(self, session, url, params=None, headers=None, json=None, cost=1):
+        # A json body is POSTed (GraphQL), cost is what the request takes from the budget
+        response = None
+        for attempt in range(self.max_retries + 1):
+            state = self.acquire(cost)
+            request_headers = dict(headers or {})
+            if state.token:
+                request_headers["Authorization"] = f"token {state.token}"
+            with metrics.timer("http_wait"):
+                if json is None:
+                    response = session.get(url, params=params, headers=request_headers)
+                else:
+                    response = session.post(url, json=json, headers=request_headers)
+            metrics.count("http_requests")
+            metrics.count("http_bytes", len(response.content))
+            if response.status_code == 304:
+                metrics.count("http_not_modified")
+                self.refund(state, cost)
+            self.update(state, response)
+
+            delay = self.retry_delay(state, response, attempt)
+            if delay is None:
+                return response
+            print(f"Rate limited on {url}, token ...{str(state.token)[-4:]} paused for {int(delay)}s")
+            metrics.count("http_retries")
+            with self.lock:
+                state.blocked_until = time.time() + delay
+                self.retries += 1
+        return response
+
+    def report(self):
+        with self.lock:
+            tokens = [
+                {
+                    "token": f"...{str(state.token)[-4:]}",
+                    "requests": state.sent,
+                    "limit": state.limit,
+                    "remaining": state.remaining,
+                    "budget_used_percent": round(100 * state.spent / state.limit, 2) if state.limit else 0.0,
+                }
+                for state in self.states
+            ]
+            return {
+                "requests": sum(state.sent for state in self.states),
+                "retries": self.retries,
+                "sleep_seconds": round(self.sleep_seconds, 2),
+                "tokens": tokens,
+            }
+
+    def print_report(self):
+        report = self.report()
+        print(f"Rate limit usage: {report['requests']} requests, {report['retries']} retries, "
+              f"{report['sleep_seconds']}s spent waiting")
+        for token in report["tokens"]:
+            print(f" - Token {token['token']}: {token['requests']} of {token['limit']} requests "
+                  f"({token['budget_used_percent']}% of budget), {token['remaining']} remaining")
@@ -0,0 +1,84 @@
+import heapq
+import json
+
+SORT_FIELDS = {"total_instances": 0, "unique_finds": 0, "commit_date": ""}  # Sortable commit fields, their defaults
+
+
+class ResultSink:
+    # Search results as they are found, with the dict operations AdvancedCommitSearcher.add_result uses. With top_k
+    # only the best top_k results by sort_by are kept, in a heap, so memory follows top_k and not the number of
+    # matches. With stream_file every new result is also written to an NDJSON file as soon as it is found.
+    # unique_shas tells every SHA is given once (shared commits deduplicated, one repository, the patch store).
+    # Otherwise a SHA dropped from the top_k is remembered, so finding it again in another repository neither brings
+    # it back with that repository alone nor streams it twice: memory then also grows with the dropped SHAs
+    def __init__(self, sort_by=("total_instances",), top_k=None, stream_file=None, repos=None, unique_shas=False):
+        unknown = set(sort_by) - set(SORT_FIELDS)
+        if unknown:
+            raise ValueError(f"Cannot sort results by {', '.join(sorted(unknown))}, use {', '.join(SORT_FIELDS)}")
+        self.sort_by = tuple(sort_by)
+        self.top_k = top_k
+        self.results = {}  # sha -> result, the kept ones
+        self.heap = []  # (key, -found order, sha) of the kept results when top_k is set, the worst one first
+        self.dropped = None if top_k is None or unique_shas else set()  # SHAs left out of the top_k
+        self.found = 0
+        self.repos = repos  # (sha, result) -> every repository holding the commit, for the stream
+        self.stream = open(stream_file, "w") if stream_file else None
+
+    def key(self, result):
+        # Fields in priority order, each one highest first
+        commit = result["commit"]
+        return tuple(commit.get(field, SORT_FIELDS[field]) for field in self.sort_by)
+
+    def get(self, sha):
+        return self.results.get(sha)
+
+    def __contains__(self, sha):
+        return sha in self.results or self.dropped is not None and sha in self.dropped
+
+    def __len__(self):
+        return len(self.results)
+
+    def items(self):
+        return self.results.items()
+
+    def __setitem__(self, sha, result):
+        self.found += 1
+        if self.stream is not None:
+            self.write(sha, result)
+        if self.top_k is None:
+            self.results[sha] = result
+            return
+
+        # Results with equal keys rank in the order they were found, a later one is the first to go
+        entry = (self.key(result), -self.found, sha)
+        if len(self.heap) < self.top_k:
+            heapq.heappush(self.heap, entry)
+        elif self.heap and entry > self.heap[0]:
+            self.drop(heapq.heapreplace(self.heap, entry)[2])
+        else:
+            self.drop(sha, kept=False)
+            return
+        self.results[sha] = result
+
+    def drop(self, sha, kept=True):
+        if kept:
+            del self.results[sha]
+        if self.dropped is not None:
+            self.dropped.add(sha)
+
+    def write(self, sha, result):
+        repos = self.repos(sha, result) if self.repos is not None else result["repos"]
+        self.stream.write(json.dumps({"sha": sha, **result, "repos": repos}, separators=(",", ":")) + "\n")
+
+    def sorted_results(self):
+        # Highest first, results with equal keys in the order they were found (sorted() with reverse keeps ties)
+        if self.top_k is not None:
+            return {sha: self.results[sha] for _, _, sha in sorted(self.heap, reverse=True)}
+        if not self.sort_by:
+            return dict(self.results)
+        return dict(sorted(self.results.items(), key=lambda item: self.key(item[1]), reverse=True))
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
@@ -0,0 +1,98 @@
+from collections import defaultdict
+from generators_commit_analysis.metrics import metrics, total_commits
+
+
+class StringPool:
+    # Keeps one copy of each repeated string (names, emails, dates) held by results that stay in memory
+    def __init__(self):
+        self.strings = {}
+
+    def __call__(self, value):
+        if not isinstance(value, str):
+            return value
+        return self.strings.setdefault(value, value)
+
+
+class SharedCommits:
+    # Content addressed view of the commit store. Forks and mirrors hold the same commits in several repositories:
+    # each SHA belongs to the first repository (in store order) that has it and the later ones only reference it, so
+    # the scans read it once and report every repository holding it. Only SHAs found in several repositories are
+    # kept: a first read of the SHAs marks them in a bitmap of two bytes per commit, and a second read only follows
+    # the SHAs whose bit was already set (the shared ones and a few collisions), so memory grows with the overlap
+    # between repositories and not with the organisation
+    BITS_PER_COMMIT = 16
+    MIN_BITS = 1 << 16
+
+    def __init__(self, holders, unique_count):
+        self.holders = holders  # SHA -> repositories holding it in store order, shared SHAs only
+        self.unique_count = unique_count
+
+    @staticmethod
+    def iter_shas(commits_data, repo_name, commits):
+        # The store reads the SHAs without decoding the rows
+        if hasattr(commits_data, "iter_shas"):
+            return commits_data.iter_shas(repo_name)
+        return (commit.sha for commit in commits)
+
+    @classmethod
+    def build(cls, commits_data):
+        size = max(cls.MIN_BITS, total_commits(commits_data) * cls.BITS_PER_COMMIT)
+        bitmap = bytearray(size // 8 + 1)
+        candidates, known, unknown = set(), 0, 0
+        for repo_name, commits in commits_data.items():
+            for sha in cls.iter_shas(commits_data, repo_name, commits):
+                if sha is None:
+                    unknown += 1  # Nothing to tell these apart by, each one counts
+                    continue
+                known += 1
+                bit = hash(sha) % size
+                if bitmap[bit >> 3] & (1 << (bit & 7)):
+                    candidates.add(sha)
+                else:
+                    bitmap[bit >> 3] |= 1 << (bit & 7)
+        del bitmap
+
+        # A SHA that is not a candidate was seen once. Candidates seen once were collisions and get no holders
+        owners, holders, repeated = {}, {}, 0
+        if candidates:
+            for repo_name, commits in commits_data.items():
+                for sha in cls.iter_shas(commits_data, repo_name, commits):
+                    if sha not in candidates:
+                        continue
+                    owner = owners.get(sha)
+                    if owner is None:
+                        owners[sha] = repo_name
+                        continue
+                    repeated += 1
+                    if owner == repo_name:
+                        continue
+                    repos = holders.setdefault(sha, [owner])
+                    if repos[-1] != repo_name:
+                        repos.append(repo_name)
+        metrics.count("shared_commits", len(holders))
+        return cls(holders, known - repeated + unknown)
+
+    def references(self, exclude_repos=()):
+        # repo -> SHAs it leaves to an earlier repository, among the repositories that are not excluded
+        references = defaultdict(set)
+        for sha, repos in self.holders.items():
+            included = [repo for repo in repos if repo not in exclude_repos]
+            for repo in included[1:]:
+                references[repo].add(sha)
+        return {repo: frozenset(shas) for repo, shas in references.items()}
+
+    def repos(self, sha, repo, exclude_repos=()):
+        # Every repository holding the commit, repo alone when no other one has it
+        repos = self.holders.get(sha)
+        if repos is None:
+            return [repo]
+        return [holder for holder in repos if holder not in exclude_repos]
+
+    @staticmethod
+    def owned(commits_data, repo_name, commits, references):
+        # The commits of a repository minus those it references, a store skips them before decoding the rows
+        if not references:
+            return commits
+        if hasattr(commits_data, "iter_commits"):
+            return commits_data.iter_commits(repo_name, skip=references)
+        return (commit for commit in commits if commit.sha not in references)
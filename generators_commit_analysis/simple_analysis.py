@@ -1,43 +1,217 @@
+import json
+import os
+from functools import partial
+from generators_commit_analysis.commit_store import CommitStore
+from generators_commit_analysis.distinct_count import DistinctCounter
+from generators_commit_analysis.parallel import split_work, run_parallel
+from generators_commit_analysis.shared_commits import SharedCommits, StringPool
+from generators_commit_analysis.metrics import metrics, total_commits
+
+
+def analyze_unit(unit, exact_limit=None, precision=14):
+    # Runs in a worker process
+    return unit.repo_name, CommitAnalyzer.analyze_repo(unit.commits(), exact_limit, precision)
+
+
+class AnalysisTotals:
+    # Collects per repository stats into the report. Chunks of a large repository arrive one after another and are
+    # merged before the repository is reported
+    def __init__(self, exact_limit=None, precision=14, keep_repo_stats=False):
+        self.exact_limit = exact_limit
+        self.precision = precision
+        self.total_commits = 0
+        self.total_committers = self.new_counter()
+        self.total_authors = self.new_counter()
+        self.repo_analysis = []
+        # Merged stats of every repository, kept when they are saved for the next run. Their emails are interned,
+        # the same people turn up in most repositories
+        self.repo_stats = {} if keep_repo_stats else None
+        self.strings = StringPool()
+        self.current_repo = None
+        self.reset_repo()
+
+    def new_counter(self):
+        return DistinctCounter(self.exact_limit, self.precision)
+
+    def reset_repo(self):
+        self.repo_commit_count, self.repo_committers, self.repo_authors = 0, self.new_counter(), self.new_counter()
+
+    def add(self, repo_name, commit_count, committers, authors):
+        if repo_name != self.current_repo:
+            self.flush()
+            self.current_repo = repo_name
+
+        if self.repo_stats is not None:
+            committers.intern(self.strings)
+            authors.intern(self.strings)
+        self.repo_commit_count += commit_count
+        self.repo_committers |= committers
+        self.repo_authors |= authors
+        self.total_commits += commit_count
+        self.total_committers |= committers
+        self.total_authors |= authors
+
+    def flush(self):
+        if self.current_repo is not None:
+            self.repo_analysis.append(CommitAnalyzer.repo_summary(self.current_repo, self.repo_commit_count,
+                                                                  self.repo_committers, self.repo_authors))
+            if self.repo_stats is not None:
+                self.repo_stats[self.current_repo] = (self.repo_commit_count, self.repo_committers, self.repo_authors)
+        self.current_repo = None
+        self.reset_repo()
+
+    def result(self):
+        self.flush()
+        return self.repo_analysis, self.total_commits, len(self.total_committers), len(self.total_authors)
+
+
 class CommitAnalyzer:
-    def __init__(self, commits_data):
+    def __init__(self, commits_data, workers=1, chunk_size=50000, warehouse=None, exact_limit=None, precision=14,
+                 state_file=None, deduplicate=False, shared=None):
         self.commits_data = commits_data
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.warehouse = warehouse
+        # Distinct counts stay exact up to exact_limit emails, None keeps them exact whatever their size
+        self.exact_limit = exact_limit
+        self.precision = precision
+        # Per repository stats are saved here, the next run only reads the commits added since
+        self.state_file = state_file
+        # Repositories keep counting every commit they hold, the total counts a commit shared by forks and mirrors
+        # once. shared is the run's SharedCommits, built here when it is not given
+        self.deduplicate = deduplicate
+        self.shared = shared
+
+    @staticmethod
+    def analyze_repo(commits, exact_limit=None, precision=14):
+        commit_count = 0
+        committers = set()
+        authors = set()
+
+        # Commits may be streamed from the commit store, so they are counted while iterating
+        for commit in commits:
+            commit_count += 1
+            CommitAnalyzer.add_commit(commit, committers, authors)
+
+        # Plain sets while scanning a chunk, the counters are what gets merged and saved
+        committer_counter = DistinctCounter(exact_limit, precision)
+        committer_counter |= committers
+        author_counter = DistinctCounter(exact_limit, precision)
+        author_counter |= authors
+        metrics.count("commits_analyzed", commit_count)
+        return commit_count, committer_counter, author_counter
+
+    @staticmethod
+    def add_commit(commit, committers, authors):
+        if commit.committer_email:
+            committers.add(commit.committer_email)
+        if commit.author_email:
+            authors.add(commit.author_email)
+
+    @staticmethod
+    def repo_summary(repo_name, commit_count, committers, authors):
+        return {
+            'repository': repo_name,
+            'commit_count': commit_count,
+            'committer_count': len(committers),
+            'author_count': len(authors),
+        }
+
+    def iter_repo_stats(self, saved=None):
+        # Saved stats of a repository come first, followed by the stats of the commits added since they were saved
+        saved = saved or {}
+        if self.workers > 1:
+            starts = {repo_name: stats[0] for repo_name, stats in saved.items()}
+            units = split_work(self.commits_data, self.chunk_size, starts=starts)
+            function = partial(analyze_unit, exact_limit=self.exact_limit, precision=self.precision)
+            previous_repo = None
+            for repo_name, stats in run_parallel(function, units, self.workers):
+                if repo_name != previous_repo and repo_name in saved:
+                    yield repo_name, saved[repo_name]
+                previous_repo = repo_name
+                yield repo_name, stats
+        else:
+            for repo_name, commits in self.commits_data.items():
+                if repo_name in saved:
+                    yield repo_name, saved[repo_name]
+                    commits = self.commits_data.iter_commits(repo_name, start=saved[repo_name][0])
+                yield repo_name, self.analyze_repo(commits, self.exact_limit, self.precision)
+
+    def counter_settings(self):
+        return {"exact_limit": self.exact_limit, "precision": self.precision}
+
+    def load_state(self):
+        # Saved stats are reused for shards that only grew since, within the same generation and counter settings
+        if self.state_file is None or not isinstance(self.commits_data, CommitStore) \
+                or not os.path.exists(self.state_file):
+            return {}
+        with open(self.state_file, "r") as state_file:
+            state = json.load(state_file)
+        if state.get("counters") != self.counter_settings():
+            return {}
+
+        saved = {}
+        for repo_name in self.commits_data.repo_names():
+            repo_state = state["repos"].get(repo_name)
+            if repo_state is None or repo_state["generation"] != self.commits_data.generation(repo_name) \
+                    or repo_state["commit_count"] > self.commits_data.count(repo_name):
+                continue
+            saved[repo_name] = (
+                repo_state["commit_count"],
+                DistinctCounter.from_state(repo_state["committers"], self.exact_limit, self.precision),
+                DistinctCounter.from_state(repo_state["authors"], self.exact_limit, self.precision),
+            )
+        return saved
+
+    def save_state(self, repo_stats):
+        if self.state_file is None or not isinstance(self.commits_data, CommitStore):
+            return
+        state = {"counters": self.counter_settings(), "repos": {
+            repo_name: {
+                "generation": self.commits_data.generation(repo_name),
+                "commit_count": commit_count,
+                "committers": committers.to_state(),
+                "authors": authors.to_state(),
+            }
+            for repo_name, (commit_count, committers, authors) in repo_stats.items()
+        }}
+        tmp_path = self.state_file + ".tmp"
+        with open(tmp_path, "w") as state_file:
+            json.dump(state, state_file)
+        os.replace(tmp_path, self.state_file)
 
     def analyze_commits(self):
-        total_commits = 0
-        total_committers = set()
-        total_authors = set()
-        repo_analysis = []
-
-        for repo_name, commits in self.commits_data.items():
-            repo_commit_count = len(commits)
-            repo_committers = set()
-            repo_authors = set()
-
-            for commit in commits:
-                committer = commit.get('commit', {}).get('committer', {}).get('email')
-                author = commit.get('commit', {}).get('author', {}).get('email')
-
-                if committer:
-                    repo_committers.add(committer)
-                    total_committers.add(committer)
-                if author:
-                    repo_authors.add(author)
-                    total_authors.add(author)
-
-            repo_analysis.append({
-                'repository': repo_name,
-                'commit_count': repo_commit_count,
-                'committer_count': len(repo_committers),
-                'author_count': len(repo_authors),
-            })
-
-            total_commits += repo_commit_count
-
-        return repo_analysis, total_commits, len(total_committers), len(total_authors)
+        # The warehouse answers the same counts with one grouped query
+        if self.warehouse is not None:
+            return self.warehouse.analyze_commits(self.deduplicate)
+
+        saved = self.load_state()
+        reused = sum(stats[0] for stats in saved.values())
+        if reused:
+            metrics.count("commits_reused", reused)
+        metrics.progress("commits_analyzed", total_commits(self.commits_data) - reused)
+        totals = AnalysisTotals(self.exact_limit, self.precision, keep_repo_stats=self.state_file is not None)
+        for repo_name, (commit_count, committers, authors) in self.iter_repo_stats(saved):
+            totals.add(repo_name, commit_count, committers, authors)
+        repo_analysis, commit_count, committer_count, author_count = totals.result()
+        self.save_state(totals.repo_stats)
+        if self.deduplicate:
+            commit_count = (self.shared or SharedCommits.build(self.commits_data)).unique_count
+        return repo_analysis, commit_count, committer_count, author_count
+
+    @staticmethod
+    def summary_lines(total_commits, total_committers, total_authors, deduplicated=False):
+        # A deduplicated total counts commits shared by forks and mirrors once, it is less than the sum of the rows
+        return [
+            f"- Total distinct commits across all repositories (shared commits counted once): {total_commits}"
+            if deduplicated else f"- Total commits across all repositories: {total_commits}",
+            f"- Total unique committers across all repositories: {total_committers}",
+            f"- Total unique authors across all repositories: {total_authors}",
+        ]
 
     @staticmethod
     def print_and_save_results(repo_analysis, total_commits, total_committers,
-                               total_authors, output_file="commit_analysis.txt", file_path=""):
+                               total_authors, output_file="commit_analysis.txt", file_path="", deduplicated=False):
         with open(file_path + output_file, "w") as f:
             f.write("Commit Analysis Report:\n\n")
 
@@ -51,11 +225,7 @@ class CommitAnalyzer:
                 print(repo_info)
                 f.write(repo_info)
 
-            total_info = (
-                f"Overall Summary:\n"
-                f" - Total commits across all repositories: {total_commits}\n"
-                f" - Total unique committers across all repositories: {total_committers}\n"
-                f" - Total unique authors across all repositories: {total_authors}\n"
-            )
+            summary = CommitAnalyzer.summary_lines(total_commits, total_committers, total_authors, deduplicated)
+            total_info = "Overall Summary:\n" + "".join(f" {line}\n" for line in summary)
             print(total_info)
             f.write(total_info)
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+
+
+class StageCache:
+    # Remembers, per stage, a hash of its input files and settings together with the hashes of the outputs it wrote.
+    # A stage whose key is unchanged and whose outputs are still on disk untouched does not need to run again
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.state = {"stages": {}, "files": {}}
+        if os.path.exists(cache_file):
+            with open(cache_file, "r") as json_file:
+                self.state = json.load(json_file)
+        self.summary = []  # (stage, reused, seconds)
+
+    def save(self):
+        tmp_path = self.cache_file + ".tmp"
+        with open(tmp_path, "w") as json_file:
+            json.dump(self.state, json_file, indent=4)
+        os.replace(tmp_path, self.cache_file)
+
+    # --- Hashing ---
+    def file_digest(self, path):
+        # Content hashes are remembered by size and modification time, so unchanged shards are not read again
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        cached = self.state["files"].get(path)
+        if cached is not None and cached["signature"] == signature:
+            return cached["digest"]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+        self.state["files"][path] = {"signature": signature, "digest": digest.hexdigest()}
+        return digest.hexdigest()
+
+    def path_digest(self, path):
+        # A directory (the commit store) hashes every file in it by name, a missing path hashes as missing
+        if os.path.isdir(path):
+            digest = hashlib.sha256()
+            for name in sorted(os.listdir(path)):
+                full_path = os.path.join(path, name)
+                if name.endswith(".tmp") or not os.path.isfile(full_path):
+                    continue
+                digest.update(f"{name}:{self.file_digest(full_path)}\n".encode())
+            return digest.hexdigest()
+        if os.path.isfile(path):
+            return self.file_digest(path)
+        return "missing"
+
+    def stage_key(self, stage, inputs=(), stage_settings=None, outputs=()):
+        payload = json.dumps({
+            "stage": stage,
+            "inputs": {path: self.path_digest(path) for path in inputs},
+            "settings": stage_settings,
+            "outputs": list(outputs),
+        }, sort_keys=True, default=list)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    # --- Stages ---
+    def is_fresh(self, stage, key, outputs=()):
+        entry = self.state["stages"].get(stage)
+        return entry is not None and entry["key"] == key and all(
+            self.path_digest(path) == entry["outputs"].get(path) for path in outputs)
+
+    def reuse(self, stage):
+        print(f"{stage} is up to date, reusing its outputs")
+        self.summary.append((stage, True, self.state["stages"][stage]["seconds"]))
+
+    def ran(self, stage, seconds):
+        self.summary.append((stage, False, seconds))
+
+    def record(self, stage, key, outputs, seconds):
+        self.state["stages"][stage] = {
+            "key": key,
+            "outputs": {path: self.path_digest(path) for path in outputs},
+            "seconds": seconds,
+        }
+        self.ran(stage, seconds)
+        self.save()
+
+    def print_summary(self):
+        if not self.summary:
+            return
+        print("Stage summary:")
+        for stage, reused, seconds in self.summary:
+            if reused:
+                print(f" - {stage}: reused (took {seconds:.1f}s when it last ran)")
+            else:
+                print(f" - {stage}: ran in {seconds:.1f}s")
+        reused = [seconds for _, was_reused, seconds in self.summary if was_reused]
+        print(f"Reused {len(reused)} of {len(self.summary)} stages, saving about {sum(reused):.1f}s")
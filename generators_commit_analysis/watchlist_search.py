@@ -0,0 +1,96 @@
+from generators_commit_analysis.advanced_search import AdvancedCommitSearcher
+
+
+class WatchlistSearcher(AdvancedCommitSearcher):
+    # Several named searches (watchlists), each an AdvancedCommitSearcher with its own keywords, options and excluded
+    # repositories, answered by one scan of the commits. The matcher is built over the lowercased keywords of every
+    # query: each message is scanned once, and only the queries owning a keyword found in it check the message with
+    # their own options. Matches are rare, so N queries cost about one scan. Results are {name: {sha: result}}, each
+    # query's results are those it would find on its own
+    def __init__(self, queries, workers=1, chunk_size=50000):
+        self.queries = queries
+        keywords = tuple(dict.fromkeys(keyword.lower() for query in queries.values() for keyword in query.keywords))
+        # Only the repositories every query excludes are left out of the scan
+        excluded = set.intersection(*(set(query.exclude_repos) for query in queries.values())) if queries else set()
+        # Typos are looked for up to the largest distance a query allows, each query then applies its own
+        fuzzy_distance = max((query.fuzzy_distance for query in queries.values()), default=0)
+        super().__init__(keywords, exclude_repos=tuple(excluded), workers=workers, chunk_size=chunk_size,
+                         fuzzy_distance=fuzzy_distance)
+
+        # query_bits[pattern] has the bit of every query with a keyword lowercasing to pattern
+        self.query_bits = dict.fromkeys(self.keyword_patterns, 0)
+        for bit, query in enumerate(queries.values()):
+            for keyword in query.keywords:
+                self.query_bits[keyword.lower()] |= 1 << bit
+        self.query_references = {}
+
+    def references(self, shared=None):
+        # Each query leaves a shared SHA to the first repository it does not exclude. The scan skips a SHA in a
+        # repository only when every query leaves it, the queries then skip the others themselves
+        self.query_references = {name: query.references(shared) for name, query in self.queries.items()}
+        if shared is None:
+            return {}
+        references = {}
+        for repo in set().union(*self.query_references.values()):
+            common = frozenset.intersection(*(refs.get(repo, frozenset()) for refs in self.query_references.values()))
+            if common:
+                references[repo] = common
+        return references
+
+    def search_commit(self, repo, commit):
+        # Returns (commit_hash, {name: result}) when a query finds a keyword in the commit, otherwise None
+        message = (commit.message or "").lower()
+        hits = self.matcher.scan(message)
+        if self.fuzzy is not None:
+            hits.update(self.fuzzy.scan(message))
+        if not hits:
+            return None
+        mask = 0
+        for pattern in hits:
+            mask |= self.query_bits[pattern]
+
+        found = {}
+        sha = commit.sha
+        for bit, (name, query) in enumerate(self.queries.items()):
+            if not mask >> bit & 1 or repo in query.exclude_repos \
+                    or sha in self.query_references.get(name, {}).get(repo, ()):
+                continue
+            result = query.search_commit(repo, commit)
+            if result is not None:
+                sha, found[name] = result
+        return (sha, found) if found else None
+
+    def add_result(self, results, sha, found):
+        for name, result in found.items():
+            self.queries[name].add_result(results.setdefault(name, {}), sha, result)
+
+    def merge_results(self, results, repo_results):
+        for name, query_results in repo_results.items():
+            self.queries[name].merge_results(results[name], query_results)
+
+    def open_results(self, shared=None, stream_file=None, keep_all=False, unique_shas=False):
+        # One sink per query, each sorted and cut to top_k its own way. stream_file maps a query to its stream
+        stream_file = stream_file or {}
+        return {name: query.open_results(shared, stream_file.get(name), keep_all, unique_shas)
+                for name, query in self.queries.items()}
+
+    def streams(self, results):
+        return any(query.streams(results[name]) for name, query in self.queries.items())
+
+    def kept_results(self, results):
+        return {name: query.kept_results(results[name]) for name, query in self.queries.items()}
+
+    def list_repos(self, results, shared=None):
+        for name, query in self.queries.items():
+            query.list_repos(results[name], shared)
+        return results
+
+    def search_and_save_results(self, commits_data, output_files, file_path="", index=None, shared=None,
+                                stream_file=None):
+        results = self.process_commits(commits_data, index, shared, self.open_results(shared, stream_file))
+        return self.save_results(results, output_files, file_path)
+
+    def save_results(self, results, output_files, file_path=""):
+        # output_files maps each query to its results file, a query without matches still gets an empty one
+        return {name: query.save_results(results[name], output_files[name], file_path)
+                for name, query in self.queries.items()}
@@ -1,97 +1,509 @@
 import os
-import json
+import re
 import sys
+import time
+from functools import lru_cache
 from settings import settings
-from generators_commit_analysis.commit_retriever import CommitRetriever
+from generators_commit_analysis.commit_store import CommitStore
+from generators_commit_analysis.patch_store import PatchStore
+from generators_commit_analysis.commit_retriever import CommitRetriever, RetrievalError
+from generators_commit_analysis.git_mirror import GitMirrorRetriever
+from generators_commit_analysis.graphql_retriever import GraphQLRetriever
 from generators_commit_analysis.simple_analysis import CommitAnalyzer
+from generators_commit_analysis.activity_analysis import ActivityAnalyzer
 from generators_commit_analysis.advanced_search import AdvancedCommitSearcher
+from generators_commit_analysis.watchlist_search import WatchlistSearcher
+from generators_commit_analysis.keyword_index import KeywordIndex
+from generators_commit_analysis.commit_warehouse import CommitWarehouse
+from generators_commit_analysis.shared_commits import SharedCommits
 from generators_commit_analysis.create_xlsm import ExcelCreator
+from generators_commit_analysis.pipeline import SinglePassPipeline
+from generators_commit_analysis.stage_cache import StageCache
+from generators_commit_analysis.metrics import metrics
 
 
 # --- Helper Functions ---
 def check_commits_file():
-    if not os.path.exists(settings["files"]["file_path"] + settings["files"]["commits_file"]):
-        raise FileNotFoundError(
-            f"{settings['files']['commits_file']} does not exist. Run commit_retriever.py first to retrieve commits."
+    store = CommitStore(
+        settings["files"]["file_path"] + settings["files"]["commits_store"],
+        keep_raw=settings["retrieve_commits"]["keep_raw_payload"]
+    )
+    if store.exists():
+        if not store.is_compact():
+            print(f"Converting {settings['files']['commits_store']} to compact commit records...")
+            store.compact()
+        return store
+
+    # Convert a dump written by older versions instead of retrieving everything again
+    legacy_file = settings["files"]["file_path"] + settings["files"]["commits_file"]
+    if os.path.exists(legacy_file):
+        print(f"Importing {settings['files']['commits_file']} into {settings['files']['commits_store']}...")
+        store.import_json(legacy_file)
+        return store
+
+    raise FileNotFoundError(
+        f"{settings['files']['commits_store']} does not exist. Run commit_retriever.py first to retrieve commits."
+    )
+
+
+def check_patch_store():
+    store = PatchStore(settings["files"]["file_path"] + settings["files"]["patch_store"])
+    if store.exists():
+        return store
+    raise FileNotFoundError(
+        f"{settings['files']['patch_store']} does not exist. Enable retrieve_patches to retrieve commit patches first."
+    )
+
+
+def create_retriever(backend=None):
+    backend = backend or settings["retrieve_commits"]["backend"]
+    options = dict(
+        base_url=settings["retrieve_commits"]["base_url"],
+        workers=settings["retrieve_commits"]["workers"],
+        token_pool=settings["base_settings"]["token_pool"],
+        requests_per_hour=settings["retrieve_commits"]["requests_per_hour"],
+        burst=settings["retrieve_commits"]["burst"],
+        max_retries=settings["retrieve_commits"]["max_retries"],
+        keep_raw=settings["retrieve_commits"]["keep_raw_payload"]
+    )
+    if backend == "graphql":
+        return GraphQLRetriever(
+            settings["retrieve_commits"]["org_name"],
+            settings["base_settings"]["token"],
+            repos_per_query=settings["retrieve_commits"]["graphql_repos_per_query"],
+            **options
         )
+    retriever = CommitRetriever(settings["retrieve_commits"]["org_name"], settings["base_settings"]["token"], **options)
+    if backend != "git":
+        return retriever
+
+    # The mirrors replace the commit pages, the API is only used to list the repositories when none are given
+    return GitMirrorRetriever(
+        settings["retrieve_commits"]["org_name"],
+        settings["files"]["file_path"] + settings["files"]["git_mirror_dir"],
+        clone_url=settings["retrieve_commits"]["git_clone_url"],
+        token=settings["base_settings"]["token"],
+        repos=settings["retrieve_commits"]["git_repos"],
+        repo_lister=lambda: [repo["name"] for repo in retriever.get_all_repos()],
+        workers=settings["retrieve_commits"]["workers"]
+    )
+
+
+def create_query(watchlist=None):
+    # A watchlist overrides the search settings it names
+    options = dict(settings["advanced_search"], **(watchlist or {}))
+    return AdvancedCommitSearcher(
+        keywords=options["keywords"],
+        exclude_repos=options["exclude_repos"],
+        include_committer=options["include_committer"],
+        include_author=options["include_author"],
+        match_whole_word=options["match_whole_word"],
+        match_case=options["match_case"],
+        contained_words=options["contained_words"],
+        same_words=options["same_words"],
+        fuzzy_distance=options["fuzzy_distance"],
+        sort_by=options["sort_by"],
+        top_k=options["top_k"],
+        workers=settings["parallel"]["workers"],
+        chunk_size=settings["parallel"]["chunk_size"]
+    )
+
+
+def create_searcher():
+    watchlists = settings["advanced_search"]["watchlists"]
+    if not watchlists:
+        return create_query()
+    # The search keywords are the query named None, every query is answered by the same scan
+    queries = {None: create_query()}
+    queries.update((name, create_query(watchlist)) for name, watchlist in watchlists.items())
+    return WatchlistSearcher(queries, workers=settings["parallel"]["workers"],
+                             chunk_size=settings["parallel"]["chunk_size"])
+
+
+def watchlist_files():
+    # Characters other than letters, digits, dots and dashes are replaced in the file names
+    return {name: settings["files"]["watchlist_file"].format(name=re.sub(r"[^\w.-]", "_", name))
+            for name in settings["advanced_search"]["watchlists"]}
+
+
+def search_output_file():
+    # The results file, or with watchlists the results file of each query
+    if not settings["advanced_search"]["watchlists"]:
+        return settings["files"]["keyword_search_file"]
+    return dict({None: settings["files"]["keyword_search_file"]}, **watchlist_files())
+
+
+def stream_files(output_files):
+    # Path of the NDJSON stream kept next to each results file, None when results are not streamed
+    if not settings["advanced_search"]["stream_results"]:
+        return None
+    if isinstance(output_files, dict):
+        return {name: stream_files(output_file) for name, output_file in output_files.items()}
+    return settings["files"]["file_path"] + os.path.splitext(output_files)[0] + ".ndjson"
+
+
+def create_excel_creator():
+    return ExcelCreator(
+        commits_store=settings["files"]["commits_store"],
+        analysis_file=settings["files"]["commits_analysis_file"],
+        keyword_search_file=settings["files"]["keyword_search_file"],
+        excel_file=settings["files"]["excel_file"],
+        file_path=settings["files"]["file_path"],
+        streaming=settings["create_xlsm"]["streaming"],
+        activity_file=settings["files"]["activity_file"] if settings["activity_analysis"]["run"] else None,
+        patch_search_file=settings["files"]["patch_search_file"] if search_patches() else None,
+        watchlist_files=watchlist_files() if settings["advanced_search"]["run"] else None
+    )
+
+
+def search_patches():
+    return settings["advanced_search"]["run"] and settings["advanced_search"]["search_patches"]
+
+
+def stage_settings(section, ignore=("run",)):
+    # The part of a settings section the stage outputs depend on
+    return {key: value for key, value in settings[section].items() if key not in ignore}
+
+
+def create_activity_analyzer():
+    return ActivityAnalyzer(
+        period=settings["activity_analysis"]["period"],
+        rolling_window=settings["activity_analysis"]["rolling_window"],
+        hotspot_periods=settings["activity_analysis"]["hotspot_periods"]
+    )
+
+
+def stage_graph():
+    # Each stage with the files it reads, the settings its outputs depend on and the files it writes.
+    # create_xlsm depends on the reports of the stages before it
+    file_path = settings["files"]["file_path"]
+    commits_store = file_path + settings["files"]["commits_store"]
+    analysis_file = file_path + settings["files"]["commits_analysis_file"]
+    keyword_search_file = file_path + settings["files"]["keyword_search_file"]
+    activity_file = file_path + settings["files"]["activity_file"]
+    patch_store = file_path + settings["files"]["patch_store"]
+    patch_search_file = file_path + settings["files"]["patch_search_file"]
+    search_files = [keyword_search_file] + [file_path + file for file in watchlist_files().values()]
+    xlsm_inputs = [commits_store, analysis_file] + search_files
+    patch_search_files = [patch_search_file]
+    if settings["advanced_search"]["stream_results"]:
+        # The NDJSON streams are outputs too, the export only reads the sorted results
+        search_files = search_files + [os.path.splitext(file)[0] + ".ndjson" for file in search_files]
+        patch_search_files.append(os.path.splitext(patch_search_file)[0] + ".ndjson")
+    if settings["activity_analysis"]["run"]:
+        xlsm_inputs.append(activity_file)
+    if search_patches():
+        xlsm_inputs.append(patch_search_file)
+    return {
+        "simple_analysis": ([commits_store], dict(stage_settings("simple_analysis"),
+                                                  deduplicate_commits=settings["pipeline"]["deduplicate_commits"]),
+                            [analysis_file]),
+        "activity_analysis": ([commits_store], stage_settings("activity_analysis"), [activity_file]),
+        # The index only changes how the search runs, not what it finds
+        "advanced_search": ([commits_store], stage_settings("advanced_search", ("run", "use_index")), search_files),
+        # The commits store only lists the other repositories holding a commit
+        "patch_search": ([patch_store, commits_store],
+                         dict(stage_settings("advanced_search", ("run", "use_index", "watchlists")),
+                              deduplicate_commits=settings["pipeline"]["deduplicate_commits"]),
+                         patch_search_files),
+        "create_xlsm": (xlsm_inputs, stage_settings("create_xlsm"), [file_path + settings["files"]["excel_file"]]),
+    }
+
+
+def run_stage(cache, stage, function):
+    # Runs the stage unless the cache holds its outputs for the same inputs and settings
+    if cache is None:
+        with metrics.stage(stage):
+            function()
+        return
+    inputs, config, outputs = stage_graph()[stage]
+    key = cache.stage_key(stage, inputs, config, outputs)
+    if cache.is_fresh(stage, key, outputs):
+        cache.reuse(stage)
+        metrics.reuse(stage)
+        return
+    start = time.perf_counter()
+    with metrics.stage(stage):
+        function()
+    cache.record(stage, key, outputs, time.perf_counter() - start)
+
+
+def open_warehouse(commits_data):
+    # Bring the warehouse up to date with the commit store, None when it is not used
+    if not settings["warehouse"]["use"]:
+        return None
+    warehouse = CommitWarehouse(settings["files"]["file_path"] + settings["files"]["warehouse_file"])
+    with metrics.stage("warehouse_update"):
+        loaded = warehouse.update(commits_data)
+        metrics.count("commits_loaded", loaded)
+    print(f"Commit warehouse updated with {loaded} new commits")
+    return warehouse
+
+
+@lru_cache(maxsize=None)
+def shared_commits(commits_data):
+    # Commits held by several repositories, worked out on first use and shared by the stages of the run
+    if not settings["pipeline"]["deduplicate_commits"]:
+        return None
+    with metrics.timer("shared_commits"):
+        return SharedCommits.build(commits_data)
+
+
+def distinct_count_settings():
+    # exact_limit None keeps the distinct counts exact
+    return {
+        "exact_limit": settings["simple_analysis"]["exact_limit"] if settings["simple_analysis"]["approximate_counts"]
+        else None,
+        "precision": settings["simple_analysis"]["hll_precision"],
+    }
+
+
+def run_simple_analysis(commits_data, warehouse=None):
+    print("Running simple analysis...")
+    # Create an instance of CommitAnalyzer
+    analyzer = CommitAnalyzer(
+        commits_data,
+        workers=settings["parallel"]["workers"],
+        chunk_size=settings["parallel"]["chunk_size"],
+        warehouse=warehouse,
+        state_file=settings["files"]["file_path"] + settings["files"]["analysis_state_file"]
+        if settings["simple_analysis"]["incremental"] else None,
+        deduplicate=settings["pipeline"]["deduplicate_commits"],
+        shared=shared_commits(commits_data) if warehouse is None else None,
+        **distinct_count_settings()
+    )
+
+    # Perform analysis and print/save the results
+    repo_analysis, total_commits, total_committers, total_authors = analyzer.analyze_commits()
+    analyzer.print_and_save_results(
+        repo_analysis=repo_analysis,
+        total_commits=total_commits,
+        total_committers=total_committers,
+        total_authors=total_authors,
+        output_file=settings["files"]["commits_analysis_file"],
+        file_path=settings["files"]["file_path"],
+        deduplicated=settings["pipeline"]["deduplicate_commits"]
+    )
+    print("Simple analysis completed!")
+
+
+def run_activity_analysis(commits_data):
+    print("Running activity analysis...")
+    activity_analyzer = create_activity_analyzer()
+    activity_analyzer.collect(commits_data)
+    activity_analyzer.print_and_save_results(
+        activity_analyzer.analyze(),
+        output_file=settings["files"]["activity_file"],
+        file_path=settings["files"]["file_path"]
+    )
+    print("Activity analysis completed!")
+
+
+def run_advanced_search(commits_data, warehouse=None):
+    print("Running advanced search...")
+    # Create an instance of AdvancedCommitSearcher
+    searcher = create_searcher()
+
+    # Bring the keyword index up to date with the commit store, the warehouse takes its place when it is used
+    index = warehouse
+    if warehouse is None and settings["advanced_search"]["use_index"]:
+        index = KeywordIndex(settings["files"]["file_path"] + settings["files"]["keyword_index_file"])
+        with metrics.timer("keyword_index_update"):
+            indexed = index.update(commits_data)
+        metrics.count("commits_indexed", indexed)
+        print(f"Keyword index updated with {indexed} new commits")
+
+    # Perform search and save results
+    searcher.search_and_save_results(
+        commits_data,
+        search_output_file(),
+        file_path=settings["files"]["file_path"],
+        index=index,
+        # The index only hands over candidates, each one is checked once per repository holding it
+        shared=shared_commits(commits_data) if index is None else None,
+        stream_file=stream_files(search_output_file())
+    )
+    if index is not None and index is not warehouse:
+        index.close()
+    print("Advanced search completed!")
+
+
+def run_patch_search(commits_data, patches):
+    print("Running patch search...")
+    # Patches are searched for the search keywords, watchlists only cover the messages
+    searcher = create_query()
+    searcher.search_and_save_patches(
+        patches,
+        output_file=settings["files"]["patch_search_file"],
+        file_path=settings["files"]["file_path"],
+        shared=shared_commits(commits_data),
+        stream_file=stream_files(settings["files"]["patch_search_file"])
+    )
+    print("Patch search completed!")
+
+
+def run_create_xlsm():
+    print("Creating Excel analysis...")
+    excel_creator = create_excel_creator()
+    excel_creator.create_workbook()
+    print("Excel analysis completed!")
+
+
+def run_single_pass(cache, commits_data):
+    # The fused pass covers the three stages at once; only the stale ones are recomputed, the export always runs
+    # when anything changed since its sheets are rebuilt from whatever the pass and the report files hold
+    graph = stage_graph()
+    enabled = [stage for stage in ("simple_analysis", "advanced_search", "activity_analysis") if settings[stage]["run"]]
+    keys = {stage: cache.stage_key(stage, *graph[stage]) for stage in enabled} if cache is not None else {}
+    stale = [stage for stage in enabled if cache is None or not cache.is_fresh(stage, keys[stage], graph[stage][2])]
+
+    if cache is not None and not stale:
+        inputs, config, outputs = graph["create_xlsm"]
+        if cache.is_fresh("create_xlsm", cache.stage_key("create_xlsm", inputs, config, outputs), outputs):
+            for stage in enabled + ["create_xlsm"]:
+                cache.reuse(stage)
+                metrics.reuse(stage)
+            return
+
+    print("Running simple analysis, advanced search and Excel export in a single pass...")
+    start = time.perf_counter()
+    pipeline = SinglePassPipeline(
+        commits_data,
+        create_excel_creator(),
+        analyze="simple_analysis" in stale,
+        searcher=create_searcher() if "advanced_search" in stale else None,
+        activity=create_activity_analyzer() if "activity_analysis" in stale else None,
+        shared=shared_commits(commits_data) if {"simple_analysis", "advanced_search"} & set(stale) else None,
+        **distinct_count_settings()
+    )
+    with metrics.stage("single_pass"):
+        pipeline.run(
+            analysis_file=settings["files"]["commits_analysis_file"],
+            keyword_search_file=search_output_file(),
+            file_path=settings["files"]["file_path"],
+            activity_file=settings["files"]["activity_file"],
+            stream_file=stream_files(search_output_file())
+        )
+    print("Single pass completed!")
+
+    if cache is not None:
+        # The pass cannot be timed per stage, each stage that ran is credited an even share of it
+        seconds = (time.perf_counter() - start) / (len(stale) + 1)
+        for stage in enabled:
+            if stage in stale:
+                cache.record(stage, keys[stage], graph[stage][2], seconds)
+            else:
+                cache.reuse(stage)
+                metrics.reuse(stage)
+        # The export key is taken now, over the reports the pass has just written
+        cache.record("create_xlsm", cache.stage_key("create_xlsm", *graph["create_xlsm"]), graph["create_xlsm"][2],
+                     seconds)
 
 
 # --- Main Execution ---
 def main():
-    # Step 1: Retrieve commits
+    # Timings and counters of every stage, with optional profiling, are written next to the outputs
+    os.makedirs(settings["files"]["file_path"], exist_ok=True)
+    metrics.configure(
+        progress_interval=settings["metrics"]["progress_interval"],
+        profile_stages=settings["metrics"]["profile_stages"],
+        trace_memory_stages=settings["metrics"]["trace_memory_stages"],
+        profile_path=settings["files"]["file_path"]
+    )
+
+    # Stage outputs are reused when their inputs and settings did not change since they were written
+    cache = None
+    if settings["pipeline"]["cache_stages"]:
+        cache = StageCache(settings["files"]["file_path"] + settings["files"]["stage_cache_file"])
+
+    # Step 1: Retrieve commits. It always runs when enabled, only GitHub knows whether there are new commits
     if settings["retrieve_commits"]["run"]:
-        # Create an instance of CommitRetriever
-        retriever = CommitRetriever(settings["retrieve_commits"]["org_name"], settings["base_settings"]["token"])
+        start = time.perf_counter()
+        # Create an instance of CommitRetriever, or of GitMirrorRetriever for the git backend
+        retriever = create_retriever()
+
+        # Retrieve and save commits, the store is left as it was when the repositories cannot be listed
+        try:
+            with metrics.stage("retrieve_commits"):
+                retriever.retrieve_commits(
+                    settings["files"]["commits_store"],
+                    settings["files"]["file_path"],
+                    incremental=settings["retrieve_commits"]["incremental"],
+                    state_file=settings["files"]["retrieve_state_file"]
+                )
+        except RetrievalError as e:
+            print(e)
+            sys.exit(1)
+        if cache is not None:
+            cache.ran("retrieve_commits", time.perf_counter() - start)
 
-        # Retrieve and save commits
-        retriever.retrieve_commits(settings["files"]["commits_file"], settings["files"]["file_path"])
+    # Step 1b: Retrieve the patches of the stored commits, only the commits not cached yet are fetched
+    if settings["retrieve_patches"]["run"]:
+        start = time.perf_counter()
+        # Patches are only served by the REST API, whatever backend retrieved the commits
+        retriever = create_retriever("rest")
+        with metrics.stage("retrieve_patches"):
+            retriever.retrieve_patches(
+                settings["files"]["commits_store"],
+                settings["files"]["patch_store"],
+                settings["files"]["file_path"],
+                since=settings["retrieve_patches"]["since"]
+            )
+        if cache is not None:
+            cache.ran("retrieve_patches", time.perf_counter() - start)
 
-    # Step 2: Run simple analysis
-    if settings["simple_analysis"]["run"] or settings["advanced_search"]["run"]:
+    # Steps 2 to 4 share a single pass over the commits when the export streams, unless the warehouse answers the
+    # analysis and search without reading the commits or the workbook has sheets of its own to keep
+    single_pass = settings["pipeline"]["single_pass"] and settings["create_xlsm"]["run"] \
+        and not settings["warehouse"]["use"] and create_excel_creator().can_stream()
+
+    if settings["simple_analysis"]["run"] or settings["advanced_search"]["run"] \
+            or settings["activity_analysis"]["run"] or single_pass:
         try:
-            check_commits_file()
+            # Commits are streamed from the store by each stage rather than loaded up front
+            commits_data = check_commits_file()
+            patches = check_patch_store() if search_patches() else None
         except FileNotFoundError as e:
             print(e)
             sys.exit(1)
 
-        # Load commits data from JSON file
-        with open(settings["files"]["file_path"] + settings["files"]["commits_file"], "r") as f:
-            commits_data = json.load(f)
-
-    if settings["simple_analysis"]["run"]:
-        print("Running simple analysis...")
-        # Create an instance of CommitAnalyzer
-        analyzer = CommitAnalyzer(commits_data)
-
-        # Perform analysis and print/save the results
-        repo_analysis, total_commits, total_committers, total_authors = analyzer.analyze_commits()
-        analyzer.print_and_save_results(
-            repo_analysis=repo_analysis,
-            total_commits=total_commits,
-            total_committers=total_committers,
-            total_authors=total_authors,
-            output_file=settings["files"]["commits_analysis_file"],
-            file_path=settings["files"]["file_path"]
-        )
-        print("Simple analysis completed!")
-
-    # Step 3: Run advanced search
-    if settings["advanced_search"]["run"]:
-        print("Running advanced search...")
-        # Create an instance of AdvancedCommitSearcher
-        searcher = AdvancedCommitSearcher(
-            keywords=settings["advanced_search"]["keywords"],
-            exclude_repos=settings["advanced_search"]["exclude_repos"],
-            include_committer=settings["advanced_search"]["include_committer"],
-            include_author=settings["advanced_search"]["include_author"],
-            match_whole_word=settings["advanced_search"]["match_whole_word"],
-            match_case=settings["advanced_search"]["match_case"],
-            contained_words=settings["advanced_search"]["contained_words"],
-            same_words=settings["advanced_search"]["same_words"]
-        )
+    # Step 3b: Search the patches, a pass over their own store ahead of the commit stages
+    if search_patches():
+        run_stage(cache, "patch_search", lambda: run_patch_search(commits_data, patches))
 
-        # Perform search and save results
-        searcher.search_and_save_results(
-            commits_data=commits_data,
-            output_file=settings["files"]["keyword_search_file"],
-            file_path=settings["files"]["file_path"],
-            sort_by_total_instances=settings["advanced_search"]["sort_by_total_instances"],
-            sort_by_unique_findings=settings["advanced_search"]["sort_by_unique_findings"]
-        )
-        print("Advanced search completed!")
+    if single_pass:
+        run_single_pass(cache, commits_data)
+    else:
+        warehouse = None
+        if settings["simple_analysis"]["run"] or settings["advanced_search"]["run"]:
+            warehouse = open_warehouse(commits_data)
 
-    # Step 4: Run create xlsm
-    if settings["create_xlsm"]["run"]:
-        print("Creating Excel analysis...")
-        excel_creator = ExcelCreator(
-            commits_file=settings["files"]["commits_file"],
-            analysis_file=settings["files"]["commits_analysis_file"],
-            keyword_search_file=settings["files"]["keyword_search_file"],
-            excel_file=settings["files"]["excel_file"],
-            file_path=settings["files"]["file_path"]
-        )
-        excel_creator.create_workbook()
-        print("Excel analysis completed!")
+        # Step 2: Run simple analysis
+        if settings["simple_analysis"]["run"]:
+            run_stage(cache, "simple_analysis", lambda: run_simple_analysis(commits_data, warehouse))
+
+        # Step 2b: Run activity analysis
+        if settings["activity_analysis"]["run"]:
+            run_stage(cache, "activity_analysis", lambda: run_activity_analysis(commits_data))
+
+        # Step 3: Run advanced search
+        if settings["advanced_search"]["run"]:
+            run_stage(cache, "advanced_search", lambda: run_advanced_search(commits_data, warehouse))
+
+        if warehouse is not None:
+            warehouse.close()
+
+        # Step 4: Run create xlsm
+        if settings["create_xlsm"]["run"]:
+            run_stage(cache, "create_xlsm", run_create_xlsm)
+
+    if cache is not None:
+        cache.save()
+        cache.print_summary()
+
+    if settings["metrics"]["save"]:
+        metrics.save(settings["files"]["file_path"] + settings["files"]["metrics_file"])
+    metrics.print_summary()
 
 
 if __name__ == "__main__":
@@ -4,23 +4,108 @@ settings = {
     "base_settings": {
         "token": os.getenv("GITHUB_TOKEN"),
         "gpt_key": os.getenv("OPENAI_API_KEY"),
+        # Optional extra GitHub tokens (comma separated) the retriever rotates through when one runs out
+        "token_pool": tuple(token for token in os.getenv("GITHUB_TOKEN_POOL", "").split(",") if token),
     },
 
     "files": {
         "file_path": "generated_files/",
-        "commits_file": "organization_commits.json",
+        "commits_store": "organization_commits/",   # Compressed per-repository NDJSON shards
+        "patch_store": "commit_patches/",   # Files and patches of each commit, same layout as the commits store
+        "commits_file": "organization_commits.json",   # Legacy single JSON dump, imported into the store if found
         "commits_analysis_file": "commit_analysis.txt",
         "keyword_search_file": "keyword_search_results.json",
+        "patch_search_file": "patch_search_results.json",
+        "watchlist_file": "keyword_search_results_{name}.json",   # Results of each watchlist, named after it
+        "activity_file": "activity_analysis.json",
+        "analysis_state_file": "commit_analysis_state.json",   # Per repository counts kept for incremental analysis
+        "retrieve_state_file": "retrieve_state.json",   # Newest SHA/date/ETag per repository for incremental runs
+        "keyword_index_file": "keyword_index.sqlite",   # Inverted index over commit messages for advanced search
+        "warehouse_file": "commit_warehouse.sqlite",   # SQLite copy of the commit store for SQL analyses
+        "git_mirror_dir": "git_mirrors/",   # Bare clones kept by the git retrieval backend
+        "stage_cache_file": "stage_cache.json",   # Input/output hashes of each stage, used to skip unchanged stages
+        "metrics_file": "run_metrics.json",   # Timings and counters of each stage of the last run
+        "ai_report_file": "ai_commit_report.txt",
+        "ai_report_cache_file": "ai_report_cache.json",   # Chunk summaries keyed by a hash of their commit SHAs
         "excel_file": "project_analysis.xlsm"
     },
 
     "retrieve_commits": {
         "run": False,   # Should commit_retriever.py run
         "org_name": "novaexchange",   # retrieve all repositories from targeted organisation
+        # https://<host>/api/v3 on GitHub Enterprise Server, GraphQL is then read from /api/graphql.
+        # Point at a local mock server for testing
+        "base_url": "https://api.github.com",
+        # "rest" pages through the commits API, "graphql" reads several repositories' histories per query with only the
+        # fields the store keeps (far fewer requests and bytes, no raw payload), "git" keeps a bare clone of each
+        # repository and reads its history with git log: one fetch per repository and no rate limit, but no GitHub
+        # account name (search "author" column)
+        "backend": "rest",
+        "graphql_repos_per_query": 10,   # Repositories whose next page of commits is asked for in one GraphQL query
+        "git_clone_url": "https://github.com/{org}/{repo}.git",   # A local path such as /srv/git/{repo}.git works too
+        "git_repos": (),   # Repositories to clone, listed through the API when empty
+        "workers": 1,   # Repositories (and their pages) fetched in parallel (e.g. 8), 1 keeps the old serial behaviour
+        "incremental": False,   # Only fetch commits newer than the previous run and merge them into the commits store
+        "keep_raw_payload": False,   # Also store the full GitHub API payload of every commit (much larger store)
+        "requests_per_hour": 5000,   # Assumed budget per token until GitHub reports the real one
+        "burst": 100,   # Requests allowed back to back before the scheduler starts spreading them out
+        "max_retries": 5,   # Retries of a rate limited request before giving up on it
+    },
+
+    "retrieve_patches": {
+        # Fetch the changed files and patches of the stored commits (one request per commit, on the retrieve_commits
+        # workers and rate limits, always through the REST API). Commits already cached are not fetched again
+        "run": False,
+        "since": None,   # Only commits dated since then, e.g. "2023-01-01T00:00:00Z". None fetches every commit
+    },
+
+    "parallel": {
+        # Processes used by simple analysis and advanced search (e.g. os.cpu_count()), 1 runs serially
+        "workers": 1,
+        "chunk_size": 50000,   # Repositories with more commits than this are split across several workers
+    },
+
+    "pipeline": {
+        # Run simple analysis, advanced search and the streaming Excel export in one pass over the commits, the sheets
+        # are filled from the results directly and the report files are only side outputs (the keyword index is unused)
+        "single_pass": False,
+        "cache_stages": False,   # Skip stages whose input files and settings did not change since their last run
+        # Search each commit once even when forks and mirrors hold it in several repositories (results list them all)
+        # and count it once in the analysis total, which is then labelled as such and is less than the sum of the
+        # repository rows. Costs two reads of the SHAs of the store per run
+        "deduplicate_commits": False,
+    },
+
+    "metrics": {
+        "save": True,   # Write stage timings, counters (requests, bytes, commits, cells) and peak RSS to metrics_file
+        "progress_interval": 5,   # Seconds between progress lines of long stages, 0 turns them off
+        # Stages to run under cProfile (e.g. ("advanced_search",)), saved as profile_<stage>.prof next to the outputs.
+        # Only the main thread is profiled, not retriever threads or worker processes
+        "profile_stages": (),
+        "trace_memory_stages": (),   # Stages to run under tracemalloc for their peak Python allocations (slower)
+    },
+
+    "warehouse": {
+        # Load the commit store into an indexed SQLite database (with full text search on messages) and run simple
+        # analysis and advanced search as queries against it. Replaces the keyword index and the single pass
+        "use": False,
     },
 
     "simple_analysis": {
-        "run": True
+        "run": True,
+        "incremental": False,   # Reuse the saved per repository counts and only read the commits added since
+        # Past exact_limit emails a distinct count switches to a HyperLogLog sketch of 2 ** hll_precision bytes. Its
+        # relative standard error is 1.04 / sqrt(2 ** hll_precision), about 0.81% at 14 (2.4% worst case in 99.7%)
+        "approximate_counts": False,
+        "exact_limit": 100000,
+        "hll_precision": 14,
+    },
+
+    "activity_analysis": {
+        "run": False,   # Needs NumPy. Commits per period, active/new/churned authors and hotspot repos, added as sheets
+        "period": "month",   # "week" (starting on Monday) or "month"
+        "rolling_window": 3,   # Periods averaged by the rolling commits column
+        "hotspot_periods": 3,   # Recent periods repositories are ranked by, compared with the periods before them
     },
 
     "advanced_search": {
@@ -30,18 +115,51 @@ settings = {
             "OnixCoin", "MotaCoin", "Nexus", "Unobtanium", "RYI", "Unityventures", "HempCoin", "cryptocurrency"
         ),
         "exclude_repos": (),   # Write repositories to exclude from search
+        # Named keyword searches run in the same scan as the keywords above, each written to its own watchlist_file and
+        # watchlist_<name> sheet. Each one sets its keywords and may override exclude_repos, include_committer,
+        # include_author, match_whole_word, match_case, contained_words, same_words, fuzzy_distance, sort_by and
+        # top_k, e.g. {"exchanges": {"keywords": ("Binance", "Kraken"), "match_whole_word": True}}
+        "watchlists": {},
+        # Also search the added and removed lines of the patches cached by retrieve_patches, with the same options.
+        # Results list the matching files and lines of each commit and get their own sheet
+        "search_patches": False,
+        "use_index": False,   # Answer searches from the keyword index, updated with new commits before each search
         "include_committer": True,
         "include_author": True,
         "match_whole_word": False,  # Set to True to match whole words only
         "match_case": False,        # Set to True to make letter case matter
         "contained_words": True,   # Skip counting shorter words contained within longer words
         "same_words": True,         # Skip counting the same word multiple times
-        # Sorting options (set only one to True at a time)
-        "sort_by_total_instances": True,   # todo convert into single variable with priority rather than chose one
-        "sort_by_unique_findings": False   # todo convert into single variable with priority rather than chose one
+        # Also count words within this many edits (insertion, deletion, substitution or swap of two neighbouring
+        # letters) of a keyword as instances of it, e.g. "Digibyt" or "crytpo". Case insensitive, 0 turns it off.
+        # Keywords under 5 characters get no edits and 9 characters are needed for 2. Results list each typo with its
+        # distance. The keyword index answers it from trigrams of its vocabulary, the warehouse falls back to a scan
+        "fuzzy_distance": 0,
+        # Result fields sorted on in priority order, each highest first: "total_instances", "unique_finds" and
+        # "commit_date" (newest first). () keeps the order commits were found in
+        "sort_by": ("total_instances",),
+        # Keep only this many best results, in a heap, instead of every match. None keeps them all. Memory follows
+        # top_k when pipeline.deduplicate_commits is on; without it a commit can be found again in a fork, so the SHAs
+        # of the matches left out of the top_k are also kept (a set of SHAs, it grows with the number of matches)
+        "top_k": None,
+        # Also write every match to an NDJSON file next to its results file (e.g. keyword_search_results.ndjson) as
+        # soon as it is found, whatever top_k keeps
+        "stream_results": False
+    },
+
+    "ai_report": {
+        # Used by generators_ai_powered/ai_commit_report.py, run from the project root with
+        # python -m generators_ai_powered.ai_commit_report
+        "model": "gpt-3.5-turbo",
+        "base_url": None,   # None uses OPENAI_BASE_URL or the OpenAI API, point at a local stub for testing
+        "max_chunk_tokens": 3000,   # Commit messages (or summaries) sent per request
+        "max_concurrency": 4,   # Requests in flight at once
     },
 
     "create_xlsm": {
-        "run": True
+        "run": True,
+        # Write-only export, flat memory on large organisations. A workbook with sheets the export does not generate
+        # is still updated in memory, so their formatting, merged cells, images and data validation are kept
+        "streaming": False,
     }
 }
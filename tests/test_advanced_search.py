@@ -0,0 +1,84 @@
+import json
+import os
+import tempfile
+import unittest
+from generators_commit_analysis.advanced_search import AdvancedCommitSearcher
+from generators_commit_analysis.commit_record import CommitRecord
+from generators_commit_analysis.commit_store import CommitStore
+from generators_commit_analysis.shared_commits import SharedCommits
+
+
+def commit(number, fixes):
+    return CommitRecord(sha=f"{number:040x}", message=" ".join(["fix"] * fixes) or "docs",
+                        committer_date=f"2024-01-{number % 28 + 1:02d}T00:00:00Z")
+
+
+class TopResultsTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name
+        self.store = CommitStore(os.path.join(self.path, "commits"), member_rows=50)
+
+    def write(self, repo, commits):
+        with self.store.open_repo(repo) as writer:
+            writer.write(commits)
+
+    def search(self, stream_name=None, **kwargs):
+        searcher = AdvancedCommitSearcher(["fix"], sort_by=("total_instances", "commit_date"), **kwargs)
+        stream_file = os.path.join(self.path, stream_name) if stream_name else None
+        results = searcher.search_and_save_results(self.store, "results.json", self.path + os.sep,
+                                                   stream_file=stream_file)
+        streamed = None
+        if stream_file:
+            with open(stream_file) as file:
+                streamed = [json.loads(line)["sha"] for line in file]
+        return results, streamed
+
+    def test_parallel_top_k_matches_serial(self):
+        for repo in range(4):
+            self.write(f"repo{repo}", [commit(repo * 1000 + number, (number * 7 + repo) % 9) for number in range(300)])
+        everything, _ = self.search()
+        expected = list(everything)[:10]
+        for workers in (1, 3):
+            for stream_name in (None, "stream.ndjson"):
+                with self.subTest(workers=workers, stream=stream_name):
+                    results, streamed = self.search(stream_name, top_k=10, workers=workers, chunk_size=70)
+                    self.assertEqual(list(results), expected)
+                    self.assertEqual(results, {sha: everything[sha] for sha in expected})
+                    if streamed is not None:
+                        self.assertEqual(sorted(streamed), sorted(everything))
+
+    def test_dropped_sha_is_not_brought_back(self):
+        # The low scoring commit leaves the top 3 before the fork holding it is scanned
+        low = commit(1, 1)
+        self.write("origin", [low] + [commit(number, 3) for number in range(2, 8)])
+        self.write("fork", [low])
+        for workers in (1, 2):
+            with self.subTest(workers=workers):
+                results, streamed = self.search("stream.ndjson", top_k=3, workers=workers, chunk_size=4)
+                self.assertNotIn(low.sha, results)
+                self.assertEqual(len(results), 3)
+                self.assertEqual(streamed.count(low.sha), 1)
+                self.assertEqual(len(streamed), 7)
+
+
+    def test_dropped_shas_are_only_kept_when_they_can_come_back(self):
+        low = commit(1, 1)
+        self.write("origin", [low] + [commit(number, 3) for number in range(2, 8)])
+        self.write("fork", [low])
+        searcher = AdvancedCommitSearcher(["fix"], sort_by=("total_instances", "commit_date"), top_k=3)
+        results = searcher.process_commits(self.store)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(len(results.dropped), 4)
+        self.assertFalse(results.dropped & set(results.results))
+
+        # Searched once with the shared commits, a SHA cannot be found again and nothing is remembered
+        shared = SharedCommits.build(self.store)
+        results = searcher.process_commits(self.store, shared=shared)
+        self.assertIsNone(results.dropped)
+        self.assertNotIn(low.sha, results.results)
+        self.assertEqual(len(results), 3)
+
+if __name__ == "__main__":
+    unittest.main()
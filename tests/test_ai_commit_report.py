@@ -0,0 +1,143 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from openai import AsyncOpenAI
+from generators_ai_powered.ai_commit_report import ReportEngine
+from generators_commit_analysis.commit_record import CommitRecord
+from generators_commit_analysis.commit_store import CommitStore
+
+
+class OpenAIStub(ThreadingHTTPServer):
+    # Answers /chat/completions with a made-up summary and records how many requests were in flight at once
+    daemon_threads = True
+
+    def __init__(self, delay=0.05):
+        super().__init__(("127.0.0.1", 0), OpenAIStubHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.prompts = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}/v1"
+
+
+class OpenAIStubHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        prompt = body["messages"][-1]["content"]
+        with server.lock:
+            server.prompts.append(prompt)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            number = len(server.prompts)
+        time.sleep(server.delay)
+        with server.lock:
+            server.in_flight -= 1
+
+        data = json.dumps({
+            "id": f"stub-{number}", "object": "chat.completion", "created": 0, "model": body["model"],
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": f"summary {number}"}}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def records(repo, start, stop):
+    # Oldest first, one commit a minute
+    return [CommitRecord(sha=f"{repo}{position:036x}", message=f"change number {position} of {repo}",
+                         committer_date=f"2024-01-01T{position // 60:02d}:{position % 60:02d}:00Z")
+            for position in range(start, stop)]
+
+
+class ReportEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.stub = OpenAIStub()
+        threading.Thread(target=self.stub.serve_forever, daemon=True).start()
+        self.addCleanup(self.stub.server_close)
+        self.addCleanup(self.stub.shutdown)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache_file = os.path.join(directory.name, "ai_report_cache.json")
+        self.store = CommitStore(os.path.join(directory.name, "commits"))
+        for repo in ("aaaa", "bbbb"):
+            with self.store.open_repo(repo) as writer:
+                writer.write(records(repo, 0, 200))
+
+    def generate(self, max_concurrency=4):
+        async def run():
+            client = AsyncOpenAI(api_key="stub", base_url=self.stub.url, max_retries=0)
+            engine = ReportEngine(client, "stub-model", max_chunk_tokens=200, max_concurrency=max_concurrency,
+                                  cache_file=self.cache_file)
+            report, repo_summaries = await engine.generate_report(self.store)
+            await client.close()
+            return engine, report, repo_summaries
+
+        return asyncio.run(run())
+
+    def test_report_is_built_from_concurrent_chunk_summaries(self):
+        engine, report, repo_summaries = self.generate(max_concurrency=3)
+        self.assertEqual(list(repo_summaries), ["aaaa", "bbbb"])
+        self.assertTrue(report.startswith("summary "))
+        self.assertEqual(engine.requests, len(self.stub.prompts))
+        self.assertEqual(engine.reused, 0)
+        chunk_prompts = [prompt for prompt in self.stub.prompts if prompt.startswith("Here are commit messages")]
+        self.assertGreater(len(chunk_prompts), 6)
+        self.assertEqual(sum(prompt.count("\n- ") for prompt in chunk_prompts), 400)
+        self.assertEqual(self.stub.max_in_flight, 3)
+
+    def test_rerun_reuses_the_cache(self):
+        first, report, repo_summaries = self.generate()
+        second, cached_report, cached_summaries = self.generate()
+        self.assertEqual(second.requests, 0)
+        self.assertEqual(second.reused, first.requests)
+        self.assertEqual((cached_report, cached_summaries), (report, repo_summaries))
+
+    def test_new_commits_only_resend_their_chunk(self):
+        first, _, _ = self.generate()
+        self.store.append_commits("bbbb", records("bbbb", 200, 201))
+        del self.stub.prompts[:]
+        second, _, repo_summaries = self.generate()
+        # The tail chunk of bbbb, the merge of bbbb and the organisation report
+        chunk_prompts = [prompt for prompt in self.stub.prompts if prompt.startswith("Here are commit messages")]
+        self.assertEqual(len(chunk_prompts), 1)
+        self.assertIn("change number 200 of bbbb", chunk_prompts[0])
+        self.assertEqual(second.requests, 3)
+        self.assertEqual(second.reused + second.requests, first.requests)
+        self.assertEqual(list(repo_summaries), ["aaaa", "bbbb"])
+
+    def test_new_commits_at_the_head_of_the_shard_only_resend_the_last_chunk(self):
+        # A full retrieval writes the newest commits first, new ones end up before those already summarized
+        for repo in ("aaaa", "bbbb"):
+            with self.store.open_repo(repo) as writer:
+                writer.write(records(repo, 0, 200)[::-1])
+        first, _, _ = self.generate()
+        with self.store.open_repo("bbbb") as writer:
+            writer.write(records("bbbb", 0, 203)[::-1])
+        del self.stub.prompts[:]
+        second, _, _ = self.generate()
+        chunk_prompts = [prompt for prompt in self.stub.prompts if prompt.startswith("Here are commit messages")]
+        self.assertEqual(len(chunk_prompts), 1)
+        self.assertIn("change number 202 of bbbb", chunk_prompts[0])
+        self.assertEqual(second.requests, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.mock_github import MockGitHub
+from benchmarks.synthetic_org import SyntheticOrg
+from generators_commit_analysis.commit_retriever import CommitRetriever, RetrievalError
+from generators_commit_analysis.commit_store import CommitStore
+from generators_commit_analysis.graphql_retriever import GraphQLRetriever, graphql_endpoint
+
+
+class MockGitHubTestCase(unittest.TestCase):
+    # Retrievers run against MockGitHub serving a small synthetic organisation, in a temporary directory
+    repos = 3
+    commits_per_repo = 350
+
+    def setUp(self):
+        self.org = SyntheticOrg(repos=self.repos, commits_per_repo=self.commits_per_repo)
+        self.mock = MockGitHub(self.org).start()
+        self.addCleanup(self.mock.stop)
+        self.new_output_dir()
+
+    def new_output_dir(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.file_path = directory.name + "/"
+
+    def retriever(self, cls=CommitRetriever, workers=1, **kwargs):
+        # A budget large enough that the scheduler never waits
+        return cls(self.org.name, "token", base_url=self.mock.url, workers=workers, requests_per_hour=10 ** 8,
+                   burst=10 ** 6, **kwargs)
+
+    def commits_path(self, repo_name):
+        return f"/repos/{self.org.name}/{repo_name}/commits"
+
+    def store(self):
+        return CommitStore(self.file_path + "organization_commits/")
+
+    def stored_shas(self, repo_name):
+        return [commit.sha for commit in self.store().iter_commits(repo_name)]
+
+    def expected_shas(self, repo_index):
+        return [self.org.commit(repo_index, position)["sha"] for position in self.org.newest_positions()]
+
+
+class CommitRetrieverTest(MockGitHubTestCase):
+    def test_retrieves_every_commit_in_order(self):
+        for workers in (1, 4):
+            with self.subTest(workers=workers):
+                self.retriever(workers=workers).retrieve_commits(file_path=self.file_path)
+                for repo_index, repo_name in enumerate(self.org.repo_names()):
+                    self.assertEqual(self.stored_shas(repo_name), self.expected_shas(repo_index))
+
+    def test_failed_page_fails_the_repository(self):
+        repo_name = self.org.repo_names()[0]
+        self.mock.fail_pages.add((self.commits_path(repo_name), 3))
+        retriever = self.retriever()
+        with self.assertRaises(RetrievalError):
+            list(retriever.iter_commit_pages(repo_name))
+        # Pages after the first one are fetched concurrently when the page count is known
+        with ThreadPoolExecutor(max_workers=4) as retriever.page_executor:
+            with self.assertRaises(RetrievalError):
+                list(retriever.iter_commit_pages(repo_name))
+
+    def test_failed_repository_is_fetched_again(self):
+        failing = self.org.repo_names()[0]
+        for workers in (1, 4):
+            with self.subTest(workers=workers):
+                self.new_output_dir()
+                self.mock.fail_pages = {(self.commits_path(failing), 3)}
+                self.retriever(workers=workers).retrieve_commits(file_path=self.file_path, incremental=True)
+                self.assertEqual(self.stored_shas(failing), [])
+                self.assertEqual(self.stored_shas(self.org.repo_names()[1]), self.expected_shas(1))
+
+                self.mock.fail_pages = set()
+                self.retriever(workers=workers).retrieve_commits(file_path=self.file_path, incremental=True)
+                self.assertEqual(self.stored_shas(failing), self.expected_shas(0))
+
+    def test_failed_graphql_history_is_fetched_again(self):
+        failing = self.org.repo_names()[0]
+        state_path = self.file_path + "retrieve_state.json"
+        self.mock.fail_pages = {(f"/graphql/{failing}", 3)}
+        self.retriever(GraphQLRetriever).retrieve_commits(file_path=self.file_path, incremental=True)
+        self.assertEqual(self.stored_shas(failing), [])
+        self.assertNotIn(failing, CommitRetriever.load_json(state_path, {}))
+        self.assertEqual(self.stored_shas(self.org.repo_names()[1]), self.expected_shas(1))
+
+        # A full refetch that fails part way keeps the shard and the state of the previous run
+        self.mock.fail_pages = set()
+        self.retriever(GraphQLRetriever).retrieve_commits(file_path=self.file_path, incremental=True)
+        self.assertEqual(self.stored_shas(failing), self.expected_shas(0))
+        state = CommitRetriever.load_json(state_path, {})
+        self.mock.fail_pages = {(f"/graphql/{failing}", 3)}
+        self.retriever(GraphQLRetriever).retrieve_commits(file_path=self.file_path)
+        self.assertEqual(self.stored_shas(failing), self.expected_shas(0))
+        self.assertEqual(CommitRetriever.load_json(state_path, {})[failing], state[failing])
+
+    def test_failed_update_keeps_the_state(self):
+        failing = self.org.repo_names()[0]
+        self.retriever().retrieve_commits(file_path=self.file_path, incremental=True)
+        state_path = self.file_path + "retrieve_state.json"
+        state = CommitRetriever.load_json(state_path, {})
+
+        # 150 new commits, the second page of the since= listing fails
+        self.org.commits_per_repo += 150
+        self.mock.fail_pages = {(self.commits_path(failing), 2)}
+        self.retriever().retrieve_commits(file_path=self.file_path, incremental=True)
+        self.assertEqual(CommitRetriever.load_json(state_path, {})[failing], state[failing])
+        self.assertEqual(len(self.stored_shas(failing)), 350)
+        # New commits are appended after the ones already held
+        self.assertEqual(sorted(self.stored_shas(self.org.repo_names()[1])), sorted(self.expected_shas(1)))
+
+        self.mock.fail_pages = set()
+        self.retriever().retrieve_commits(file_path=self.file_path, incremental=True)
+        self.assertEqual(sorted(self.stored_shas(failing)), sorted(self.expected_shas(0)))
+
+    def test_failed_listing_keeps_the_store(self):
+        self.retriever().retrieve_commits(file_path=self.file_path)
+        for cls, failed_path in ((CommitRetriever, f"/orgs/{self.org.name}/repos"), (GraphQLRetriever, "/graphql")):
+            with self.subTest(backend=cls.__name__):
+                # Two repositories per listing page, the second page fails
+                self.mock.fail_pages = {(failed_path, 2 if cls is CommitRetriever else 1)}
+                with self.assertRaises(RetrievalError):
+                    self.retriever(cls, per_page=2).retrieve_commits(file_path=self.file_path)
+                for repo_index, repo_name in enumerate(self.org.repo_names()):
+                    self.assertEqual(self.stored_shas(repo_name), self.expected_shas(repo_index))
+
+    def test_empty_repository(self):
+        self.org.commits_per_repo = 0
+        self.retriever().retrieve_commits(file_path=self.file_path)
+        store = self.store()
+        self.assertEqual(store.repo_names(), self.org.repo_names())
+        self.assertEqual(store.total_count(), 0)
+
+    def test_timeout_is_still_accepted(self):
+        with self.assertWarns(DeprecationWarning):
+            retriever = self.retriever(timeout=1)
+        self.assertEqual(retriever.timeout, 1)
+
+
+class GraphQLEndpointTest(unittest.TestCase):
+    def test_endpoint_follows_the_rest_base_url(self):
+        for base_url, expected in (("https://api.github.com", "https://api.github.com/graphql"),
+                                   ("https://github.example.com/api/v3", "https://github.example.com/api/graphql"),
+                                   ("https://github.example.com/api/v3/", "https://github.example.com/api/graphql"),
+                                   ("http://127.0.0.1:8000", "http://127.0.0.1:8000/graphql")):
+            with self.subTest(base_url=base_url):
+                self.assertEqual(graphql_endpoint(base_url), expected)
+                self.assertEqual(GraphQLRetriever("org", "token", base_url=base_url).graphql_url, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import gzip
+import os
+import tempfile
+import unittest
+from generators_commit_analysis.commit_record import CommitRecord
+from generators_commit_analysis.commit_store import CommitStore
+
+
+def records(start, stop):
+    return [CommitRecord(sha=f"{position:040x}", message=f"commit {position}") for position in range(start, stop)]
+
+
+class CommitStoreTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = CommitStore(directory.name, member_rows=100)
+        self.shas = [record.sha for record in records(0, 1000)]
+
+    def assert_ranges(self, repo_name, shas):
+        for start in range(0, len(shas) + 1, 37):
+            for stop in (None, start + 1, start + 150, start + 1000):
+                with self.subTest(start=start, stop=stop):
+                    self.assertEqual([commit.sha for commit in self.store.iter_commits(repo_name, start, stop)],
+                                     shas[start:stop])
+
+    def test_ranges_start_at_their_member(self):
+        with self.store.open_repo("repo") as writer:
+            writer.write(records(0, 1000))
+        self.assertEqual([row for row, _ in self.store.members("repo")], list(range(0, 1000, 100)))
+        self.assert_ranges("repo", self.shas)
+        self.assertEqual(list(self.store.iter_shas("repo")), self.shas)
+
+    def test_appended_members(self):
+        with self.store.open_repo("repo") as writer:
+            writer.write(records(0, 250))
+        self.store.append_commits("repo", records(250, 260))
+        self.store.append_commits("repo", records(260, 1000))
+        self.assertEqual(self.store.count("repo"), 1000)
+        self.assert_ranges("repo", self.shas)
+
+    def test_shard_without_members(self):
+        # Shards written before gzip members were recorded are read from the start, appends get members
+        os.makedirs(self.store.store_path, exist_ok=True)
+        with gzip.open(self.store.shard_path("repo"), "wt", encoding="utf-8") as shard:
+            for record in records(0, 400):
+                shard.write(self.store.encode(record))
+        self.store.set_repo("repo", 400)
+        self.store.append_commits("repo", records(400, 1000))
+        self.assertEqual([row for row, _ in self.store.members("repo")], [0] + list(range(400, 1000, 100)))
+        self.assert_ranges("repo", self.shas)
+
+
+if __name__ == "__main__":
+    unittest.main()
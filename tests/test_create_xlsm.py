@@ -0,0 +1,87 @@
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+import openpyxl
+from openpyxl.worksheet.datavalidation import DataValidation
+from benchmarks.synthetic_org import SyntheticOrg
+from generators_commit_analysis.advanced_search import AdvancedCommitSearcher
+from generators_commit_analysis.commit_store import CommitStore
+from generators_commit_analysis.create_xlsm import ExcelCreator
+from generators_commit_analysis.simple_analysis import CommitAnalyzer
+
+
+class ExcelCreatorTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.file_path = directory.name + "/"
+        org = SyntheticOrg(repos=2, commits_per_repo=50)
+        org.write_store(self.file_path + "organization_commits/")
+        store = CommitStore(self.file_path + "organization_commits/")
+        with contextlib.redirect_stdout(io.StringIO()):
+            CommitAnalyzer.print_and_save_results(*CommitAnalyzer(store).analyze_commits(),
+                                                  output_file="commit_analysis.txt", file_path=self.file_path)
+        AdvancedCommitSearcher(tuple(org.keywords[:20])).search_and_save_results(store, file_path=self.file_path)
+        self.excel_file = self.file_path + "project_analysis.xlsm"
+
+    def creator(self, streaming=True):
+        return ExcelCreator(commits_store="organization_commits/", analysis_file="commit_analysis.txt",
+                            keyword_search_file="keyword_search_results.json", excel_file="project_analysis.xlsm",
+                            file_path=self.file_path, streaming=streaming)
+
+    def save_template(self, extra_sheet=False):
+        # Generated sheets with codeNames (VBA document modules refer to sheets by them), optionally a sheet of its own
+        workbook = openpyxl.Workbook()
+        workbook.remove(workbook.active)
+        for index, name in enumerate(("commit_analysis", "organization_commits", "keyword_search_results")):
+            sheet = workbook.create_sheet(name)
+            sheet.sheet_properties.codeName = f"Module{index}"
+            sheet.append(["stale"])
+        if extra_sheet:
+            notes = workbook.create_sheet("notes", 1)
+            notes.sheet_properties.codeName = "NotesModule"
+            notes["A1"] = "Notes"
+            notes["A1"].font = openpyxl.styles.Font(bold=True)
+            notes.merge_cells("A1:C1")
+            validation = DataValidation(type="list", formula1='"yes,no"')
+            notes.add_data_validation(validation)
+            validation.add("B2")
+        workbook.save(self.excel_file)
+
+    def code_names(self):
+        workbook = openpyxl.load_workbook(self.excel_file)
+        return {sheet.title: sheet.sheet_properties.codeName for sheet in workbook}
+
+    def test_streaming_keeps_code_names(self):
+        self.save_template()
+        creator = self.creator()
+        self.assertTrue(creator.can_stream())
+        self.assertEqual(creator.template_code_names(), {"commit_analysis": "Module0",
+                                                         "organization_commits": "Module1",
+                                                         "keyword_search_results": "Module2"})
+        creator.create_workbook()
+        self.assertEqual(self.code_names(), {"commit_analysis": "Module0", "organization_commits": "Module1",
+                                             "keyword_search_results": "Module2"})
+        self.assertEqual(openpyxl.load_workbook(self.excel_file)["organization_commits"].max_row, 101)
+
+    def test_sheets_of_the_workbook_are_kept(self):
+        self.save_template(extra_sheet=True)
+        creator = self.creator()
+        self.assertEqual(creator.kept_sheets(), ["notes"])
+        self.assertFalse(creator.can_stream())
+        creator.create_workbook()
+
+        workbook = openpyxl.load_workbook(self.excel_file)
+        notes = workbook["notes"]
+        self.assertEqual(workbook.sheetnames.index("notes"), 1)
+        self.assertEqual(notes.sheet_properties.codeName, "NotesModule")
+        self.assertTrue(notes["A1"].font.bold)
+        self.assertEqual([str(cells) for cells in notes.merged_cells.ranges], ["A1:C1"])
+        self.assertEqual(len(notes.data_validations.dataValidation), 1)
+        self.assertEqual(self.code_names()["keyword_search_results"], "Module2")
+
+
+if __name__ == "__main__":
+    unittest.main()
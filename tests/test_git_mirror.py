@@ -0,0 +1,146 @@
+import os
+import subprocess
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+from generators_commit_analysis.commit_retriever import CommitRetriever
+from generators_commit_analysis.commit_store import CommitStore
+from generators_commit_analysis.git_mirror import GitMirrorRetriever, GitError
+
+
+class GitMirrorTest(unittest.TestCase):
+    # Bare repositories under a temporary directory stand in for the organisation, clone_url points at them
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        self.file_path = os.path.join(self.root, "output") + "/"
+        os.makedirs(self.file_path)
+        self.clock = 0
+
+    def run_git(self, *args, cwd=None, input=None):
+        self.clock += 60
+        date = f"{1700000000 + self.clock} +0200"
+        env = dict(os.environ, GIT_AUTHOR_NAME="Ann", GIT_AUTHOR_EMAIL="ann@example.com", GIT_AUTHOR_DATE=date,
+                   GIT_COMMITTER_NAME="Bob", GIT_COMMITTER_EMAIL="bob@example.com", GIT_COMMITTER_DATE=date,
+                   GIT_CONFIG_GLOBAL=os.devnull, GIT_CONFIG_SYSTEM=os.devnull)
+        return subprocess.run(["git"] + list(args), cwd=cwd, input=input, env=env, check=True, capture_output=True)
+
+    def bare_repo(self, name):
+        # An empty bare repository and a working clone to push to it from
+        bare = os.path.join(self.root, "remote", f"{name}.git")
+        self.run_git("init", "--bare", "--quiet", "--initial-branch=main", bare)
+        work = os.path.join(self.root, "work", name)
+        self.run_git("clone", "--quiet", bare, work)
+        self.run_git("checkout", "--quiet", "-b", "main", cwd=work)
+        return work
+
+    def commit(self, work, message, encoding=None):
+        # message is bytes in encoding when one is given, its header tells git how to read it
+        options = ["-c", f"i18n.commitEncoding={encoding}"] if encoding else []
+        self.run_git(*options, "commit", "--quiet", "--allow-empty", "-F", "-", cwd=work,
+                     input=message if encoding else message.encode())
+        return self.run_git("rev-parse", "HEAD", cwd=work).stdout.decode().strip()
+
+    def push(self, work, force=False):
+        self.run_git("push", "--quiet", "--force" if force else "--no-force", "origin", "main", cwd=work)
+
+    def retrieve(self, repos):
+        retriever = GitMirrorRetriever("org", os.path.join(self.file_path, "git_mirrors"),
+                                       clone_url=os.path.join(self.root, "remote", "{repo}.git"), repos=repos)
+        retriever.retrieve_commits(file_path=self.file_path, incremental=True)
+        return CommitStore(self.file_path + "organization_commits/")
+
+    def test_incremental_runs_and_force_push(self):
+        work = self.bare_repo("app")
+        first = [self.commit(work, f"commit {index}") for index in range(3)]
+        self.push(work)
+        store = self.retrieve(["app"])
+        self.assertEqual([commit.sha for commit in store.iter_commits("app")], first[::-1])
+        commit = next(store.iter_commits("app"))
+        self.assertEqual((commit.message, commit.author_name, commit.committer_email), ("commit 2", "Ann",
+                                                                                        "bob@example.com"))
+        # Dates are stored in UTC like the REST API returns them, the commits were made at +0200
+        timestamp = int(self.run_git("log", "-1", "--format=%ct", cwd=work).stdout)
+        self.assertEqual(commit.committer_date,
+                         datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"))
+
+        # New commits are appended
+        added = [self.commit(work, f"commit {index}") for index in range(3, 5)]
+        self.push(work)
+        store = self.retrieve(["app"])
+        self.assertEqual(sorted(commit.sha for commit in store.iter_commits("app")), sorted(first + added))
+
+        # A rewritten history replaces the shard
+        self.run_git("reset", "--quiet", "--hard", first[0], cwd=work)
+        rewritten = self.commit(work, "rewritten")
+        self.push(work, force=True)
+        store = self.retrieve(["app"])
+        self.assertEqual([commit.sha for commit in store.iter_commits("app")], [rewritten, first[0]])
+
+    def test_latin1_message(self):
+        work = self.bare_repo("legacy")
+        self.commit(work, "Caf\xe9 cr\xe8me".encode("latin-1"), encoding="ISO-8859-1")
+        self.push(work)
+        store = self.retrieve(["legacy"])
+        self.assertEqual([commit.message for commit in store.iter_commits("legacy")], ["Caf\xe9 cr\xe8me"])
+
+    def test_empty_repository(self):
+        self.bare_repo("empty")
+        work = self.bare_repo("app")
+        self.commit(work, "only commit")
+        self.push(work)
+        store = self.retrieve(["empty", "app"])
+        self.assertEqual(store.count("empty"), 0)
+        self.assertEqual(store.count("app"), 1)
+
+        # Commits pushed to it later are picked up
+        work = os.path.join(self.root, "work", "empty")
+        self.commit(work, "first commit")
+        self.push(work)
+        store = self.retrieve(["empty", "app"])
+        self.assertEqual([commit.message for commit in store.iter_commits("empty")], ["first commit"])
+
+    def test_failed_repository_does_not_stop_the_run(self):
+        for name in ("a", "c"):
+            work = self.bare_repo(name)
+            self.commit(work, f"commit of {name}")
+            self.push(work)
+        # b does not exist, its clone fails
+        store = self.retrieve(["a", "b", "c"])
+        self.assertEqual((store.count("a"), store.count("c")), (1, 1))
+        self.assertEqual(store.count("b"), 0)
+        state = CommitRetriever.load_json(self.file_path + "retrieve_state.json", {})
+        self.assertEqual(sorted(state), ["a", "c"])
+
+        work = self.bare_repo("b")
+        self.commit(work, "commit of b")
+        self.push(work)
+        store = self.retrieve(["a", "b", "c"])
+        self.assertEqual([commit.message for commit in store.iter_commits("b")], ["commit of b"])
+
+    def test_log_failure_raises(self):
+        work = self.bare_repo("app")
+        self.commit(work, "commit")
+        self.push(work)
+        retriever = GitMirrorRetriever("org", os.path.join(self.file_path, "git_mirrors"),
+                                       clone_url=os.path.join(self.root, "remote", "{repo}.git"))
+        mirror = retriever.update_mirror("app")
+        with self.assertRaises(GitError):
+            list(retriever.iter_log(mirror, "0" * 40))
+        # Stopping early is not a failure
+        self.assertEqual(len(list(zip(range(1), retriever.iter_log(mirror, "HEAD")))), 1)
+
+    def test_token_stays_off_the_command_line(self):
+        retriever = GitMirrorRetriever("org", self.root, clone_url="https://github.com/{org}/{repo}.git",
+                                       token="secret-token")
+        with mock.patch("subprocess.run", wraps=subprocess.run) as run:
+            header = retriever.git("config", "--get", "http.extraHeader").stdout
+        self.assertTrue(header.startswith("Authorization: Basic "))
+        command = run.call_args.args[0]
+        self.assertFalse(any("Authorization" in arg or "secret" in arg for arg in command))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import time
+import unittest
+from generators_commit_analysis.rate_limiter import RequestScheduler
+
+
+class Response:
+    def __init__(self, status_code, remaining, reset):
+        self.status_code = status_code
+        self.headers = {"X-RateLimit-Limit": "5000", "X-RateLimit-Remaining": str(remaining),
+                        "X-RateLimit-Reset": str(reset)}
+        self.content = b""
+        self.text = ""
+
+
+class Session:
+    # Answers like GitHub does for unchanged resources: a 304 that leaves the remaining budget as it was
+    def __init__(self, status_code, remaining=4990):
+        self.status_code = status_code
+        self.remaining = remaining
+        self.reset = int(time.time()) + 3000
+
+    def get(self, url, params=None, headers=None):
+        if self.status_code != 304:
+            self.remaining -= 1
+        return Response(self.status_code, self.remaining, self.reset)
+
+
+class RequestSchedulerTest(unittest.TestCase):
+    def test_not_modified_is_free(self):
+        scheduler = RequestScheduler(["token"], requests_per_hour=5000, burst=100)
+        session = Session(304)
+        for _ in range(400):
+            self.assertEqual(scheduler.request(session, "https://api.github.com/x").status_code, 304)
+        report = scheduler.report()
+        self.assertEqual(report["sleep_seconds"], 0)
+        self.assertEqual(report["requests"], 400)
+        self.assertEqual(report["tokens"][0]["budget_used_percent"], 0)
+        self.assertEqual(report["tokens"][0]["remaining"], 4990)
+
+    def test_charged_requests_follow_the_lowest_count(self):
+        scheduler = RequestScheduler(["token"], requests_per_hour=5000, burst=100)
+        session = Session(200)
+        for _ in range(50):
+            scheduler.request(session, "https://api.github.com/x")
+        report = scheduler.report()
+        self.assertEqual(report["tokens"][0]["remaining"], 4940)
+        self.assertEqual(report["tokens"][0]["budget_used_percent"], 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import random
+import tempfile
+import unittest
+from generators_commit_analysis.commit_record import CommitRecord
+from generators_commit_analysis.commit_store import CommitStore
+from generators_commit_analysis.shared_commits import SharedCommits
+
+
+class CrowdedSharedCommits(SharedCommits):
+    # A bitmap this small sets most bits, nearly every SHA goes through the second read
+    BITS_PER_COMMIT = 1
+    MIN_BITS = 8
+
+
+def repositories():
+    # Forks copy part of an earlier repository (sometimes twice) and add commits of their own
+    generator = random.Random(7)
+    shas = [f"{position:040x}" for position in range(3000)]
+    data, used = {}, 0
+    for number in range(8):
+        own = shas[used:used + 200]
+        used += 200
+        copied = generator.sample(shas[:used], 150) if number else []
+        data[f"repo{number}"] = [CommitRecord(sha=sha, message=sha) for sha in own + copied + copied[:5]] + \
+            [CommitRecord(sha=None, message="unknown")]
+    return data
+
+
+def expected(data):
+    owners, holders = {}, {}
+    for repo, commits in data.items():
+        for commit in commits:
+            if commit.sha is None:
+                continue
+            owner = owners.setdefault(commit.sha, repo)
+            if owner != repo and repo not in holders.setdefault(commit.sha, [owner]):
+                holders[commit.sha].append(repo)
+    unknown = sum(commit.sha is None for commits in data.values() for commit in commits)
+    return holders, len(owners) + unknown
+
+
+class SharedCommitsTest(unittest.TestCase):
+    def setUp(self):
+        self.data = repositories()
+        self.holders, self.unique_count = expected(self.data)
+
+    def assert_shared(self, shared):
+        self.assertEqual(shared.holders, self.holders)
+        self.assertEqual(shared.unique_count, self.unique_count)
+
+    def test_dict(self):
+        self.assert_shared(SharedCommits.build(self.data))
+
+    def test_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = CommitStore(os.path.join(directory, "commits"), member_rows=100)
+            for repo, commits in self.data.items():
+                with store.open_repo(repo) as writer:
+                    writer.write(commits)
+            self.assert_shared(SharedCommits.build(store))
+
+    def test_collisions_are_dropped(self):
+        self.assert_shared(CrowdedSharedCommits.build(self.data))
+
+
+if __name__ == "__main__":
+    unittest.main()